@@ -3,6 +3,8 @@ from past.builtins import xrange
 from builtins import input, bytes
 import six
 from operator import itemgetter
+from array import array
+from collections import deque
 
 import os
 import sys
@@ -16,6 +18,11 @@ import pickle
 import binascii
 
 from cancatlib import iso_tp
+from cancatlib import sessionfile
+from cancatlib import capture
+from cancatlib import sessionstats
+from cancatlib.msgstore import CanMsgStore, MsgEvictedError
+from cancatlib.advfilters import compileAdvFilters
 
 baud = 4000000
 
@@ -38,6 +45,7 @@ CMD_CAN_RECV_ISOTP_RESULT   = 0x39
 CMD_CAN_SENDRECV_ISOTP_RESULT = 0x3A
 CMD_SET_FILT_MASK_RESULT    = 0x3B
 CMD_PRINT_CAN_REGS          = 0x3C
+CMD_CAN_SEND_BATCH_RESULT   = 0x3D
 
 CMD_PING                    = 0x41
 CMD_CHANGE_BAUD             = 0x42
@@ -50,6 +58,7 @@ CMD_CAN_MODE_CITM           = 0x02  # Start CITM between can1 and can2
 CMD_CAN_SEND_ISOTP          = 0x46
 CMD_CAN_RECV_ISOTP          = 0x47
 CMD_CAN_SENDRECV_ISOTP      = 0x48
+CMD_CAN_SEND_BATCH          = 0x49
 
 
 CAN_RESP_OK                 = (0)
@@ -64,6 +73,17 @@ CAN_RESP_FAIL               = (0xff)
 
 CAN_RESPS = {v: k for k, v in globals().items() if k.startswith('CAN_RESP_')}
 
+# CANxmitBatch(): most frames in one CMD_CAN_SEND_BATCH, and how many commands
+# to keep in flight (batches, or single frames without batch support)
+CAN_SEND_BATCH_MAX          = 128
+CAN_BATCH_WINDOW            = 2
+CAN_XMIT_WINDOW             = 16
+
+# host side ISO-TP (CanInterface.host_isotp): frames are padded out to 8 bytes
+# like the transceiver does, and we ask for everything at once (BS=0, STmin=0)
+ISOTP_PAD                   = b'\x00'
+ISOTP_FLOWCONTROL           = b'\x30\x00\x00'
+
 # constants for setting baudrate for the CAN bus
 CAN_AUTOBPS  = 0
 CAN_5KBPS    = 1
@@ -85,6 +105,10 @@ CAN_500KBPS  = 16
 CAN_666KBPS  = 17
 CAN_1000KBPS = 18
 
+# bits per second for each of the above (matches the firmware's baud_rates_table)
+CAN_BITRATES = (0, 5000, 10000, 20000, 25000, 31250, 33000, 40000, 50000, 80000,
+                83300, 95000, 100000, 125000, 200000, 250000, 500000, 666000, 1000000)
+
 # Flag to indicate STD (11-bit) or EXT (29-bit) messages
 ARBID_11BIT = 0
 ARBID_29BIT = 1
@@ -184,7 +208,29 @@ class CanCatUnPickler(pickle.Unpickler):
         return super(CanCatUnPickler, self).find_class(module, name)
 
 
+# mailboxes holding raw CAN frames, these are kept in a CanMsgStore
+CAN_MSG_MBOXES = (CMD_CAN_RECV, CMD_ISO_RECV)
+
+
+def storeCanMailboxes(messages):
+    '''
+    Convert any CAN frame mailboxes that are still plain lists of
+    (ts, message) tuples (old session files, converted logs) into
+    CanMsgStore objects.  Modifies (and returns) the messages dict.
+    '''
+    for cmd in CAN_MSG_MBOXES:
+        mbox = messages.get(cmd)
+        if mbox is not None and not isinstance(mbox, CanMsgStore):
+            messages[cmd] = CanMsgStore(mbox)
+
+    return messages
+
+
 def loadCanSession(filename):
+    # binary session files are mmap'd, not read
+    if sessionfile.isSessionFile(filename):
+        return sessionfile.loadSession(filename)
+
     with open(filename, 'rb') as f:
         # gracefully handle python 2 to 3 conversion things
         unpickler = CanCatUnPickler(f, fix_imports=True, encoding='latin1')
@@ -193,6 +239,14 @@ def loadCanSession(filename):
     # Go through the msgs and turn them into bytes to ensure any logs saved
     # with python2 can be loaded in python3
     for cmd in data['messages']:
+        if isinstance(data['messages'][cmd], CanMsgStore):
+            continue
+
+        # CanMsgStore does the str->bytes conversion itself
+        if cmd in CAN_MSG_MBOXES:
+            data['messages'][cmd] = CanMsgStore(data['messages'][cmd])
+            continue
+
         for i in range(len(data['messages'][cmd])):
             entry = list(data['messages'][cmd][i])
             if isinstance(entry[-1], str):
@@ -219,12 +273,19 @@ DONT_PRINT_THIS_MESSAGE = SPECIAL_CASE
 
 class CanInterface(object):
     _msg_source_idx = CMD_CAN_RECV
+    # extra names available to advfilters: {name: expression on idx, ts, arbid, data}
+    _advfilter_fields = {'id': 'arbid'}
 
     def __init__(self, port=None, baud=baud, verbose=False, cmdhandlers=None, comment='', load_filename=None, orig_iface=None, max_msgs=None):
         '''
         CAN Analysis Workspace
         This can be subclassed by vendor to allow more vendor-specific code
         based on the way each vendor uses the varios Buses
+
+        max_msgs turns the CAN message mailbox into a ring buffer: only the
+        newest max_msgs messages are kept.  Message indexes keep counting up
+        (message 1000000 is still message 1000000 after the first ones are
+        gone), and asking for an evicted message says so.
         '''
         if orig_iface != None:
             self._consumeInterface(orig_iface)
@@ -234,12 +295,28 @@ class CanInterface(object):
         self.init(port, baud, verbose, cmdhandlers, comment, load_filename, orig_iface, max_msgs)
 
     def init(self, port=None, baud=baud, verbose=False, cmdhandlers=None, comment='', load_filename=None, orig_iface=None, max_msgs=None):
-        self._inbuf = b''
+        self._inbuf = bytearray()
         self._trash = []
         self._messages = {}
-        self._msg_events = {}
+        # cmd -> Condition (on _queuelock) notified when its mailbox grows
+        self._msg_conds = {}
         self._queuelock = threading.Lock()
+        # rx_arbid -> [IsoTpListener], fed from the receive thread
+        self._isotp_waiters = {}
+        self._isotp_cond = threading.Condition()
+        # do ISO-TP segmentation and flow control here instead of in the
+        # transceiver, which only keeps track of one ISO-TP session at a
+        # time.  lets exchanges with several ECUs be in flight at once
+        self.host_isotp = False
+        # called as cb(cmd, idx, (ts, msg)) from the receive thread (see addMsgListener)
+        self._msg_listeners = []
         self._config = {}
+        # the transceiver takes CMD_CAN_SEND_BATCH (M2_CAN_haz_bus).  there's
+        # no asking: firmware without it answers the unknown command with a
+        # BAD COMMAND packet that throws the receive parser off
+        self.batch_xmit = False
+        # held while waiting on CMD_CAN_SEND results, which only go by order
+        self._xmitlock = threading.Lock()
 
         self._config['shutdown'] = False
         self._config['go'] = False
@@ -257,9 +334,18 @@ class CanInterface(object):
         self.bookmarks = []
         self.bookmark_info = {}
 
+        # (filename, {cmd: (mailbox, mutations)}, {cmd: count}) of the last
+        # binary session save/load, so saving again can just append
+        self._session_saved = None
+        # CaptureWriter while capturing to segment files (startCapture())
+        self._capture = None
+        # running per-arbid stats of everything received (getLiveStats())
+        self._live_stats = sessionstats.LiveStats()
+
         self.comments = []
         if cmdhandlers == None:
-            cmdhandlers = default_cmdhandlers
+            # a copy: register_handler() mustn't leak into other interfaces
+            cmdhandlers = dict(default_cmdhandlers)
         self._cmdhandlers = cmdhandlers
 
         if load_filename != None:
@@ -348,9 +434,45 @@ class CanInterface(object):
             print("shutting down serial connection")
             self._io.close()
         self._config['shutdown'] = True
+        if getattr(self, '_capture', None) != None:
+            self.stopCapture()
         if self._commsthread != None:
             self._commsthread.wait()
 
+    def startCapture(self, basename, segment_bytes=capture.SEGMENT_BYTES, segment_secs=None, window=capture.WINDOW):
+        '''
+        Continuously save received CAN messages to rolling segment files
+        (<basename>.0000.cancat, <basename>.0001.cancat, ...) from a background
+        thread, so a long capture neither grows without bound in RAM nor gets
+        lost if we crash.
+
+        A new segment is started every segment_bytes bytes and/or every
+        segment_secs seconds.  Only the newest `window` messages are kept in
+        memory; older ones are read back from the segments when asked for, so
+        genCanMsgs(), printCanMsgs() and friends keep the same message indexes.
+        Each segment is a normal session file (see loadFromFile()).
+        '''
+        if self._capture != None:
+            raise Exception("Already capturing to %r, stopCapture() first" % self._capture.basename)
+
+        self._capture = capture.CaptureWriter(self, basename, CMD_CAN_RECV, segment_bytes=segment_bytes,
+                                              segment_secs=segment_secs, window=window)
+        self._capture.start()
+
+    def stopCapture(self):
+        '''
+        Write out anything not yet saved and stop capturing to segment files.
+        Messages already evicted can still be read back from the segments.
+        returns the list of segment filenames
+        '''
+        if self._capture == None:
+            return []
+
+        cap = self._capture
+        cap.stop()
+        self._capture = None
+        return cap.filenames
+
     def clearCanMsgs(self):
         '''
         Clear out all messages currently received on the CAN bus, allowing for
@@ -363,6 +485,7 @@ class CanInterface(object):
         # Clear the bookmarks as well because they are no longer meaningful
         self.bookmarks = []
         self.bookmark_info = {}
+        self._live_stats.clear()
 
         return allmsgs
 
@@ -396,9 +519,12 @@ class CanInterface(object):
                     continue
 
                 # fill the queue ##########################################
+                # pull in everything that has already arrived in one read.  if
+                # nothing is waiting, block on a single byte so we don't spin.
                 self._in_lock.acquire()
                 try:
-                    char = self._io.read()
+                    waiting = getattr(self._io, 'in_waiting', 0)
+                    chunk = self._io.read(max(1, waiting))
 
                 except serial.serialutil.SerialException as e:
                     self.errorcode = e
@@ -412,67 +538,85 @@ class CanInterface(object):
                     if self._in_lock.locked_lock():
                         self._in_lock.release()
 
-                self._inbuf += char
+                if not chunk:
+                    continue
+
+                self._inbuf += chunk
                 #self.log("RECV: %s" % repr(self._inbuf), 4)
                 ##########################################################
 
-                # FIXME: should we make the rest of this a separate thread, so we're not keeping messages from flowing?
-                # ====== it would require more locking/synchronizing...
+                self._processInbuf()
+
+            except:
+                if self.verbose:
+                    sys.excepthook(*sys.exc_info())
 
+    def _processInbuf(self):
+        '''
+        Parse every complete @<len><cmd> frame currently sitting in self._inbuf
+        and hand each one to its cmdhandler (or file it in its mailbox).
+
+        Works from an offset into the reusable bytearray and trims consumed
+        bytes once at the end, so a bulk read holding many frames costs one
+        buffer shift instead of one copy per frame.  Garbage between frames is
+        stashed in self._trash and we resync on the next '@'.
+        '''
+        inbuf = self._inbuf
+        buflen = len(inbuf)
+        off = 0
+
+        try:
+            while off < buflen:
                 # make sure we're synced
-                if self._rxtx_state == RXTX_SYNC:
-                    if self._inbuf.startswith(b'@') != True:
-                        self._queuelock.acquire()
-                        try:
-                            idx = self._inbuf.find(b'@')
-                            if idx == -1:
-                                self.log("sitting on garbage...", 3)
-                                continue
-
-                            trash = self._inbuf[:idx]
-                            self._trash.append(trash)
-
-                            self._inbuf = self._inbuf[idx:]
-                        finally:
-                            self._queuelock.release()
-
-                    self._rxtx_state = RXTX_GO
-
-                # handle buffer if we have anything in it
-                if self._rxtx_state == RXTX_GO:
-                    if len(self._inbuf) < 3: continue
-                    if self._inbuf.startswith(b'@') != True:
-                        self._rxtx_state = RXTX_SYNC
-                        continue
+                if inbuf[off] != 0x40:  # '@'
+                    self._rxtx_state = RXTX_SYNC
+                    idx = inbuf.find(b'@', off)
+                    if idx == -1:
+                        self.log("sitting on garbage...", 3)
+                        self._trash.append(bytes(inbuf[off:]))
+                        off = buflen
+                        break
+
+                    self._trash.append(bytes(inbuf[off:idx]))
+                    off = idx
+
+                self._rxtx_state = RXTX_GO
+                if buflen - off < 3:
+                    break
+
+                pktlen = inbuf[off+1] + 2        # <size>, doesn't include "@"
+                if pktlen < 3:
+                    # a frame can't be shorter than @<size><cmd>, so this '@'
+                    # wasn't really a frame start.  skip it and resync
+                    self._trash.append(bytes(inbuf[off:off+1]))
+                    off += 1
+                    continue
 
-                    pktlen = self._inbuf[1] + 2        # <size>, doesn't include "@"
+                if buflen - off < pktlen:
+                    break
 
-                    if len(self._inbuf) >= pktlen:
-                        self._queuelock.acquire()
-                        try:
-                            cmd = self._inbuf[2]                # first bytes are @<size>
-                            message = self._inbuf[3:pktlen]
-                            self._inbuf = self._inbuf[pktlen:]
-                        finally:
-                            self._queuelock.release()
+                cmd = inbuf[off+2]                  # first bytes are @<size>
+                message = bytes(inbuf[off+3:off+pktlen])
+                off += pktlen
 
-                        # generate the timestamp here
-                        timestamp = time.time()
-                        tsmsg = (timestamp, message)
+                # generate the timestamp here
+                timestamp = time.time()
+                tsmsg = (timestamp, message)
 
-                        #if we have a handler, use it
-                        cmdhandler = self._cmdhandlers.get(cmd)
-                        if cmdhandler != None:
-                            cmdhandler(tsmsg, self)
+                #if we have a handler, use it
+                cmdhandler = self._cmdhandlers.get(cmd)
+                if cmdhandler != None:
+                    cmdhandler(tsmsg, self)
 
-                        # otherwise, file it
-                        else:
-                            self._submitMessage(cmd, tsmsg)
-                        self._rxtx_state = RXTX_SYNC
+                # otherwise, file it
+                else:
+                    self._submitMessage(cmd, tsmsg)
 
-            except:
-                if self.verbose:
-                    sys.excepthook(*sys.exc_info())
+        finally:
+            # drop everything we've consumed (even if a handler blew up, so we
+            # don't process the same frames twice)
+            if off:
+                del inbuf[:off]
 
     def _submitMessage(self, cmd, tsmsg):
         '''
@@ -480,24 +624,125 @@ class CanInterface(object):
         *threadsafe*
         '''
 
-        mbox = self._messages.get(cmd)
-        if mbox == None:
-            mbox = []
-            self._messages[cmd] = mbox
-            self._msg_events[cmd] = threading.Event()
-
+        idx = None
         try:
             self._queuelock.acquire()
+            mbox = self._messages.get(cmd)
+            if mbox == None:
+                mbox = self._newMailbox(cmd)
+                self._messages[cmd] = mbox
+
             mbox.append(tsmsg)
-            self._msg_events[cmd].set()
+            idx = len(mbox) - 1
+
+            # ring buffer: drop the oldest (a capture evicts on its own, once it's on disk)
+            if cmd == CMD_CAN_RECV and self._max_msgs and self._capture == None:
+                excess = len(mbox) - mbox.getFirstIndex() - self._max_msgs
+                if excess > 0:
+                    mbox.evict(excess)
+
+            self._msgCond(cmd).notify_all()
 
         except Exception as e:
             self.log("_submitMessage: ERROR: %r" % e, -1)
 
         finally:
             self._queuelock.release()
+
+        if cmd == CMD_CAN_RECV and idx != None:
+            ts, msg = tsmsg
+            self._live_stats.update(ts, struct.unpack_from('>I', msg)[0], msg[4:])
+
+            # hand the frame to anyone waiting on an ISO-TP response
+            if self._isotp_waiters:
+                self._isotp_feed(idx, tsmsg)
+
+        if idx != None:
+            for cb in self._msg_listeners:
+                try:
+                    cb(cmd, idx, tsmsg)
+                except Exception as e:
+                    self.log("_submitMessage: listener %r: ERROR: %r" % (cb, e), -1)
+
         return len(mbox)-1
 
+    def addMsgListener(self, cb):
+        '''
+        call cb(cmd, idx, (ts, msg)) for every message filed into a mailbox
+        from now on.  it's called from the receive thread, after the message
+        is in its mailbox, so it should be quick about it
+        '''
+        self._msg_listeners = self._msg_listeners + [cb]
+
+    def removeMsgListener(self, cb):
+        self._msg_listeners = [x for x in self._msg_listeners if x is not cb]
+
+    def _isotp_feed(self, idx, tsmsg):
+        '''
+        feed a freshly received CAN frame to the ISO-TP listeners for its arbid
+        and wake up the waiters if it's news to them (a completed message, or
+        something to do flow control about).
+        runs in the receive thread
+        '''
+        ts, msg = tsmsg
+        arbid, = struct.unpack_from('>I', msg)
+        if not self._isotp_waiters.get(arbid):
+            return
+
+        with self._isotp_cond:
+            wake = False
+            for listener in self._isotp_waiters.get(arbid, ()):
+                if listener.feedFrame(idx, ts, arbid, msg[4:]):
+                    wake = True
+
+            if wake:
+                self._isotp_cond.notify_all()
+
+    def _newMailbox(self, cmd):
+        '''
+        returns an empty mailbox for cmd.  CAN frames get a compact
+        CanMsgStore, everything else a deque
+        '''
+        if cmd in CAN_MSG_MBOXES:
+            return CanMsgStore()
+        return deque()
+
+    def _msgCond(self, cmd):
+        '''
+        the Condition notified when something is filed in the cmd mailbox.
+        call with self._queuelock held
+        '''
+        cond = self._msg_conds.get(cmd)
+        if cond == None:
+            cond = self._msg_conds[cmd] = threading.Condition(self._queuelock)
+        return cond
+
+    def _notifyMsgs(self, cmd):
+        '''
+        wake up anyone waiting on the cmd mailbox, for mailboxes not filled
+        by _submitMessage()
+        '''
+        with self._queuelock:
+            self._msgCond(cmd).notify_all()
+
+    def _waitForMsgs(self, cmd, count, timeout):
+        '''
+        wait (up to timeout seconds) until the cmd mailbox holds more than
+        count messages.  returns True if it does
+        '''
+        deadline = time.time() + timeout
+        with self._queuelock:
+            cond = self._msgCond(cmd)
+            while True:
+                mbox = self._messages.get(cmd)
+                if mbox != None and len(mbox) > count:
+                    return True
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                cond.wait(min(remaining, threading.TIMEOUT_MAX))
+
     def log(self, message, verbose=2):
         '''
         print a log message.  Only prints if CanCat's verbose setting >=verbose
@@ -511,21 +756,60 @@ class CanInterface(object):
             removes a message from a mailbox and returns it.
             For CMD_CAN_RECV mailbox, this will alter analysis results!
         '''
-        start = time.time()
-        while (time.time() - start) < wait:
-            mbox = self._messages.get(cmd)
+        deadline = time.time() + wait
+        with self._queuelock:
+            cond = self._msgCond(cmd)
+            while True:
+                mbox = self._messages.get(cmd)
+                if mbox != None:
+                    first = self._getFirstMsgIndex(mbox)
+                    if len(mbox) > first:
+                        if first:
+                            # a ring buffer can't renumber, so the oldest just goes
+                            timestamp, message = mbox[first]
+                            mbox.evict(1)
+                        elif isinstance(mbox, deque):
+                            timestamp, message = mbox.popleft()
+                        else:
+                            timestamp, message = mbox.pop(0)
 
-            if mbox != None and len(mbox):
-                self._queuelock.acquire()
-                try:
-                    timestamp, message = mbox.pop(0)
-                finally:
-                    self._queuelock.release()
+                        return timestamp, message
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None, None
 
-                return timestamp, message
+                # woken by _submitMessage() filing into this mailbox
+                cond.wait(min(remaining, threading.TIMEOUT_MAX))
+
+    def _getFirstMsgIndex(self, mbox):
+        '''
+        index of the oldest message still in the mailbox: 0 unless it's a
+        CanMsgStore that has evicted messages (max_msgs or a capture)
+        '''
+        if isinstance(mbox, CanMsgStore):
+            return mbox.getFirstIndex()
+        return 0
+
+    def _reportEvicted(self, idx, first):
+        '''
+        tell the user the messages they asked for are gone
+        '''
+        if self._max_msgs:
+            why = 'max_msgs=%d' % self._max_msgs
+        else:
+            why = 'evicted'
+        print("Messages %d-%d are no longer available (%s), continuing from message %d" % (idx, first-1, why, first))
 
-            time.sleep(.01)
-        return None, None
+    def getOldestMsgIndex(self):
+        '''
+        index of the oldest CAN message that can still be read.  0 unless
+        max_msgs has made the mailbox a ring buffer and it has wrapped
+        '''
+        messages = self.getCanMsgQueue()
+        if isinstance(messages, CanMsgStore):
+            return messages.getOldestIndex()
+        return 0
 
     def recvall(self, cmd):
         '''
@@ -541,7 +825,7 @@ class CanInterface(object):
         self._queuelock.acquire()
         try:
             messages = list(mbox)
-            self._messages[cmd] = []
+            self._messages[cmd] = self._newMailbox(cmd)
         finally:
             self._queuelock.release()
 
@@ -598,9 +882,10 @@ class CanInterface(object):
 
         msg = struct.pack('>I', arbid) + struct.pack('B', extflag) + self._bytesHelper(message)
 
-        for i in range(count):
-            self._send(CMD_CAN_SEND, msg)
-            ts, result = self.recv(CMD_CAN_SEND_RESULT, timeout)
+        with self._xmitlock:
+            for i in range(count):
+                self._send(CMD_CAN_SEND, msg)
+                ts, result = self.recv(CMD_CAN_SEND_RESULT, timeout)
 
         if result == None:
             print("CANxmit:  Return is None!?")
@@ -612,11 +897,115 @@ class CanInterface(object):
 
         return resval
 
+    def CANxmitBatch(self, frames, extflag=0, timeout=3, window=None, batch=None):
+        '''
+        Transmit a list of (arbid, message) CAN messages, as fast as the
+        transceiver will take them.  Returns a list with the result of each
+        (0 == CAN_RESP_OK, None if no result came back within timeout, or if
+        it wasn't sent because an earlier result was late)
+
+        batch=True packs up to CAN_SEND_BATCH_MAX frames into each
+        CMD_CAN_SEND_BATCH, answered with one result per frame.  batch=False
+        sends the usual CMD_CAN_SEND per frame, but keeps window of them in
+        flight instead of waiting on each result.  batch=None (the default)
+        goes by batch_xmit, which is off until the firmware is known to take
+        batches.  window is how many commands are in flight at once
+        '''
+        frames = [(arbid, self._bytesHelper(message)) for arbid, message in frames]
+
+        if batch is None:
+            batch = self.batch_xmit
+
+        if batch:
+            if window is None:
+                window = CAN_BATCH_WINDOW
+            msgs = []
+            counts = []
+            for x in range(0, len(frames), CAN_SEND_BATCH_MAX):
+                chunk = frames[x:x+CAN_SEND_BATCH_MAX]
+                msg = [struct.pack('B', len(chunk))]
+                for arbid, message in chunk:
+                    msg.append(struct.pack('>IBB', arbid, extflag, len(message)))
+                    msg.append(message)
+                msgs.append(b''.join(msg))
+                counts.append(len(chunk))
+
+            results = self._xmitPipelined(CMD_CAN_SEND_BATCH, CMD_CAN_SEND_BATCH_RESULT, msgs, counts, timeout, window)
+
+        else:
+            if window is None:
+                window = CAN_XMIT_WINDOW
+            msgs = [struct.pack('>IB', arbid, extflag) + message for arbid, message in frames]
+            results = self._xmitPipelined(CMD_CAN_SEND, CMD_CAN_SEND_RESULT, msgs, [1] * len(msgs), timeout, window)
+
+        failed = len(results) - results.count(CAN_RESP_OK)
+        if failed:
+            print("CANxmitBatch() failed: %d of %d frames" % (failed, len(results)))
+
+        return results
+
+    def _xmitPipelined(self, cmd, resultcmd, msgs, counts, timeout, window):
+        '''
+        send msgs as cmd commands, keeping up to window of them in flight,
+        and collect the resultcmd answers (one result byte per frame, counts
+        frames per msg).  returns the flattened list of results
+
+        results come back in the order the commands went out and are matched
+        up that way.  once one is late nothing more gets sent, and it and the
+        rest in flight get one more timeout between them to come back, so
+        they aren't left for the next CANxmit() to pick up.  a result that
+        never comes at all puts the ones after it on the wrong frames.  the
+        burst holds _xmitlock, so other threads' CANxmit()s wait for it
+        '''
+        results = []
+        inflight = []
+        giveup = None
+        with self._xmitlock:
+            for msg, count in zip(msgs, counts):
+                if len(inflight) >= window:
+                    result = self._xmitResults(resultcmd, inflight[0], timeout)
+                    if result is None:
+                        giveup = time.time() + timeout
+                        break
+
+                    results.extend(result)
+                    inflight.pop(0)
+
+                self._send(cmd, msg)
+                inflight.append(count)
+
+            for count in inflight:
+                result = None
+                if giveup is None:
+                    result = self._xmitResults(resultcmd, count, timeout)
+                    if result is None:
+                        giveup = time.time() + timeout
+                if result is None:
+                    result = self._xmitResults(resultcmd, count, max(0, giveup - time.time()))
+
+                results.extend(result or [None] * count)
+
+        # and whatever didn't get sent
+        return results + [None] * (sum(counts) - len(results))
+
+    def _xmitResults(self, resultcmd, count, timeout):
+        ts, result = self.recv(resultcmd, timeout)
+        if result is None:
+            return None
+
+        results = list(bytearray(result[:count]))
+        return results + [None] * (count - len(results))
+
     def ISOTPxmit(self, tx_arbid, rx_arbid, message, extflag=0, timeout=3, count=1):
         '''
         Transmit an ISOTP can message. tx_arbid is the arbid we're transmitting,
         and rx_arbid is the arbid we're listening for
         '''
+        if self.host_isotp:
+            for i in range(count):
+                resval = self._isotp_xmit_host(tx_arbid, rx_arbid, message, extflag, timeout)
+            return resval
+
         msg = struct.pack('>IIB', tx_arbid, rx_arbid, extflag) + message
         for i in range(count):
             self._send(CMD_CAN_SEND_ISOTP, msg)
@@ -640,10 +1029,12 @@ class CanInterface(object):
         '''
         if start_msg_idx is None:
             start_msg_idx = self.getCanMsgCount()
-        # set the CANCat to respond to Flow Control messages
-        resval = self._isotp_enable_flowcontrol(tx_arbid, rx_arbid, extflag)
+        if not self.host_isotp:
+            # set the CANCat to respond to Flow Control messages
+            resval = self._isotp_enable_flowcontrol(tx_arbid, rx_arbid, extflag)
 
-        msg = self._getIsoTpMsg(rx_arbid, start_index=start_msg_idx, timeout=timeout)
+        msg, idx = self._isotp_get_msg(rx_arbid, start_index=start_msg_idx, timeout=timeout,
+                                       tx_arbid=tx_arbid, extflag=extflag)
 
         return msg
 
@@ -660,14 +1051,26 @@ class CanInterface(object):
 
         return resval
 
-    def ISOTPxmit_recv(self, tx_arbid, rx_arbid, message, extflag=0, timeout=3, count=1, service=None):
+    def ISOTPxmit_recv(self, tx_arbid, rx_arbid, message, extflag=0, timeout=3, count=1, service=None, first_timeout=None):
         '''
         Transmit an ISOTP can message, then wait for a response.
         tx_arbid is the arbid we're transmitting, and rx_arbid
         is the arbid we're listening for
+
+        first_timeout, if given, is how long to wait for the response to
+        start (its single or first frame).  once it has, the whole response
+        gets timeout
         '''
 
         currIdx = self.getCanMsgCount()
+        if self.host_isotp:
+            for i in range(count):
+                self._isotp_xmit_host(tx_arbid, rx_arbid, self._bytesHelper(message), extflag, timeout)
+
+            msg, idx = self._isotp_get_msg(rx_arbid, start_index=currIdx, service=service, timeout=timeout,
+                                           tx_arbid=tx_arbid, extflag=extflag, first_timeout=first_timeout)
+            return msg, idx
+
         msg = struct.pack('>II', tx_arbid, rx_arbid) + struct.pack('B', extflag) + self._bytesHelper(message)
         for i in range(count):
             self._send(CMD_CAN_SENDRECV_ISOTP, msg)
@@ -679,57 +1082,172 @@ class CanInterface(object):
         if resval != 0:
             print("ISOTPxmit() failed: %s" % CAN_RESPS.get(resval))
 
-        msg, idx = self._isotp_get_msg(rx_arbid, start_index = currIdx, service = service, timeout = timeout)
+        msg, idx = self._isotp_get_msg(rx_arbid, start_index = currIdx, service = service, timeout = timeout,
+                                       first_timeout = first_timeout)
         return msg, idx
 
-    def _isotp_get_msg(self, rx_arbid, start_index=0, service=None, timeout=None):
+    def _isotp_xmit_host(self, tx_arbid, rx_arbid, message, extflag=0, timeout=3):
         '''
-        Internal Method to piece together a valid ISO-TP message from received CAN packets.
+        Transmit an ISOTP message as plain CAN frames, waiting on the flow
+        control from rx_arbid ourselves (see host_isotp).
+        Returns the result of the last frame sent, None if the flow control
+        never came
         '''
+        frames = [frame.ljust(8, ISOTP_PAD) for frame in iso_tp.msg_encode(message)]
+        if len(frames) == 1:
+            return self.CANxmit(tx_arbid, frames[0], extflag, timeout)
 
-        found = False
-        complete = False
-        starttime = lasttime = time.time()
+        with self._isotp_cond:
+            listener = self._isotp_listen(rx_arbid, self.getCanMsgCount())
+            try:
+                resval = self._isotp_xmit_unlocked(tx_arbid, frames[0], extflag, timeout)
+                idx = 1
+                while resval == 0 and idx < len(frames):
+                    deadline = time.time() + timeout
+                    while not listener.flowcontrol:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            print("ISOTPxmit: no flow control from 0x%x" % rx_arbid)
+                            return None
+                        self._isotp_cond.wait(remaining)
+
+                    fc = listener.flowcontrol.pop(0)
+                    status, blocksize, stmin = iso_tp.flowcontrol_params(fc)
+                    if status == 1:
+                        # wait for the next one
+                        continue
+                    elif status != 0:
+                        print("ISOTPxmit: 0x%x aborted the transfer: %s" % (rx_arbid, fc.hex()))
+                        return CAN_RESP_FAIL
+
+                    blocksize = blocksize or len(frames)
+                    for frame in frames[idx:idx+blocksize]:
+                        resval = self._isotp_xmit_unlocked(tx_arbid, frame, extflag, timeout)
+                        if resval != 0:
+                            break
+                        if stmin:
+                            time.sleep(stmin)
+                    idx += blocksize
+
+            finally:
+                self._isotp_unlisten(rx_arbid, listener)
+
+        return resval
+
+    def _isotp_xmit_unlocked(self, arbid, message, extflag, timeout):
+        '''
+        CANxmit() while we hold _isotp_cond.  the receive thread needs that
+        lock to deliver ISO-TP frames, so it's dropped until the result is in
+        '''
+        self._isotp_cond.release()
+        try:
+            return self.CANxmit(arbid, message, extflag, timeout)
+        finally:
+            self._isotp_cond.acquire()
+
+    def _isotp_listen(self, rx_arbid, start_index):
+        '''
+        returns a new IsoTpListener for rx_arbid, fed every frame since
+        start_index.  must be called holding _isotp_cond
+        '''
+        listener = iso_tp.IsoTpListener(start_index, verbose=self.verbose > 2)
+        self._isotp_waiters.setdefault(rx_arbid, []).append(listener)
+
+        # catch up on frames that arrived before we started listening.  the receive
+        # thread can't feed us while we hold the lock, and skips anything we've seen
+        mbox = self._messages.get(CMD_CAN_RECV)
+        if isinstance(mbox, CanMsgStore):
+            start_index = max(start_index, mbox.getOldestIndex())
+            for idx, ts, arbid, data in mbox.iterArbidFrames([rx_arbid], start_index):
+                listener.feedFrame(idx, ts, arbid, data)
+
+        elif mbox != None:
+            for idx in range(start_index, len(mbox)):
+                ts, msg = mbox[idx]
+                arbid, data = self._splitCanMsg(msg)
+                if arbid == rx_arbid:
+                    listener.feedFrame(idx, ts, arbid, data)
+
+        return listener
+
+    def _isotp_unlisten(self, rx_arbid, listener):
+        self._isotp_waiters[rx_arbid].remove(listener)
+        if not self._isotp_waiters[rx_arbid]:
+            del self._isotp_waiters[rx_arbid]
+
+    def _isotp_get_msg(self, rx_arbid, start_index=0, service=None, timeout=None, tx_arbid=None, extflag=0, first_timeout=None):
+        '''
+        Internal Method to piece together a valid ISO-TP message from received CAN packets.
+
+        Frames for rx_arbid are reassembled by the receive thread as they arrive; we just
+        catch up on anything received since start_index and then sleep until a complete
+        message (or the timeout) shows up.  With host_isotp, the flow control for
+        multi-frame responses is sent from here, on tx_arbid.
+
+        With first_timeout, we give up after that long if no response has started
+        (no single or first frame), and allow timeout once one has.
+        '''
+        starttime = time.time()
 
         if isinstance(service, int):
             # Assume this is a 1 byte SID value
             service = struct.pack('>B', service & 0xff)
 
-        while not complete and (not timeout or (lasttime-starttime < timeout)):
-            time.sleep(0.01)
-            msgs = [msg for msg in self.genCanMsgs(start=start_index, arbids=[rx_arbid])]
+        if not self.host_isotp:
+            tx_arbid = None
 
-            if len(msgs):
-                try:
-                    # Check that the message is for the expected service, if specified
-                    arbid, msg, count = iso_tp.msg_decode(msgs)
-                    if msg[0] == 0x7e:  # response for TesterPresent... ignore
-                        start_index = msgs[count-1][0] + 1
-
-                    elif service is not None:
-                        # Check if this is the right service, or there was an error
-                        if msg[:len(service)] == service or msg[0] == 0x7f:
-                            msg_found = True
-                            return msg, msgs[count-1][0]
-
-                        print("Hey, we got here, wrong service code? (%s != %s)" % (msg.hex(), service.hex()))
-                        start_index = msgs[count-1][0] + 1
-                    else:
-                        msg_found = True
-                        return msg, msgs[count-1][0]
+        with self._isotp_cond:
+            listener = self._isotp_listen(rx_arbid, start_index)
+
+            try:
+                while True:
+                    if listener.fc_wanted and tx_arbid is not None:
+                        listener.fc_wanted = False
+                        self._isotp_xmit_unlocked(tx_arbid, ISOTP_FLOWCONTROL.ljust(8, ISOTP_PAD), extflag, 3)
 
-                except iso_tp.IncompleteIsoTpMsg as e:
-                    #print(e) # debugging only, this is expected
-                    pass
+                    while listener.pdus:
+                        arbid, msg, first_idx, last_idx = listener.pdus.pop(0)
+                        if not len(msg):
+                            start_index = last_idx + 1
 
-            lasttime = time.time()
-            #print("_isotp_get_msg: status: %r - %r (%r) > %r" % (lasttime, starttime, (lasttime-starttime),  timeout))
+                        elif msg[0] == 0x7e:  # response for TesterPresent... ignore
+                            start_index = last_idx + 1
+
+                        elif service is not None:
+                            # Check if this is the right service, or there was an error
+                            # (including 0x7f/0x78 "response pending", handled by the caller)
+                            if msg[:len(service)] == service or msg[0] == 0x7f:
+                                return msg, last_idx
+
+                            print("Hey, we got here, wrong service code? (%s != %s)" % (msg.hex(), service.hex()))
+                            start_index = last_idx + 1
+
+                        else:
+                            return msg, last_idx
+
+                    limit = timeout
+                    if first_timeout is not None and listener.first_ts is None:
+                        limit = min(first_timeout, timeout or first_timeout)
+
+                    if not limit:
+                        self._isotp_cond.wait()
+                        continue
+
+                    remaining = limit - (time.time() - starttime)
+                    if remaining <= 0:
+                        break
+
+                    self._isotp_cond.wait(remaining)
+
+            finally:
+                self._isotp_unlisten(rx_arbid, listener)
 
         if self.verbose:
+            lasttime = time.time()
             print("_isotp_get_msg: Timeout: %r - %r (%r) > %r" % (lasttime, starttime, (lasttime-starttime),  timeout))
         return None, start_index
 
-    def CANsniff(self, start_msg=None, arbids=None, advfilters=[], maxmsgs=None):
+    def CANsniff(self, start_msg=None, arbids=None, advfilters=[], maxmsgs=None, stats_interval=None):
         '''
         Print messages in real time.
 
@@ -752,11 +1270,18 @@ class CanInterface(object):
 
                     J1939 adds 'pgn', 'pf', 'ps', 'edp', 'dp', 'sa'
 
+                    Filters are compiled once, not eval'd per message.  A filter may
+                    also be a callable, called as func(idx, ts, arbid, data).
+
                     (this description is true for all advfilters, not specifically CANsniff)
 
+        stats_interval - print the live per-arbid stats (see getLiveStats()) every this
+                    many seconds while sniffing
+
         '''
         count = 0
         msg_gen = self.reprCanMsgsLines(start_msg=start_msg, arbids=arbids, advfilters=advfilters, tail=True)
+        next_stats = time.time()
 
         while True:
             if maxmsgs != None and maxmsgs < count:
@@ -768,6 +1293,10 @@ class CanInterface(object):
             else:
                 time.sleep(.1)
 
+            if stats_interval != None and time.time() >= next_stats:
+                print(self.reprLiveStats(arbids=arbids))
+                next_stats = time.time() + stats_interval
+
             if keystop():
                 break
 
@@ -855,6 +1384,16 @@ class CanInterface(object):
             print("CAN INIT FAILED WHILE SETTING BAUD RATE: Retrying")
             response = self.recv(CMD_CAN_BAUD_RESULT, wait=30)
 
+    def getCanBitrate(self):
+        '''
+        the CAN bus bitrate set by setCanBaud(), in bits per second.  None if
+        it hasn't been set (or was autodetected)
+        '''
+        baud_const = self._config.get('can_baud')
+        if baud_const == None or not 0 < baud_const < len(CAN_BITRATES):
+            return None
+        return CAN_BITRATES[baud_const]
+
     def setCanMode(self, mode):
         '''
         Sets the desired operation mode. Note that just setting the operational mode
@@ -904,13 +1443,21 @@ class CanInterface(object):
         messages = self.getCanMsgQueue()
 
         # get the ts of the first received message
-        if messages != None and len(messages):
+        if isinstance(messages, CanMsgStore) and len(messages):
+            startts = messages.getStartTimestamp()
+        elif messages != None and len(messages):
             startts = messages[0][0]
         else:
             startts = time.time()
 
         if start == None:
             start = self.getCanMsgCount()
+        elif isinstance(messages, CanMsgStore) and start < messages.getOldestIndex():
+            # a ring buffer or segment only holds the tail end of a capture.
+            # the default start=0 just means "from the beginning"
+            if start:
+                self._reportEvicted(start, messages.getOldestIndex())
+            start = messages.getOldestIndex()
 
         if messages == None:
             stop = 0
@@ -947,23 +1494,49 @@ class CanInterface(object):
                         if tail:
                             yield None
 
-                        # wait for trigger event so we're not constantly polling
-                        self._msg_events[self._msg_source_idx].wait(1)
-                        self._msg_events[self._msg_source_idx].clear()
+                        # wait for new messages so we're not constantly polling
+                        self._waitForMsgs(self._msg_source_idx, msglen, 1)
                         self.log("received 'new messages' event trigger", 3)
 
                     # we've gained some messages since last check...
                     stop = len(messages)
                     continue    # to the big message loop.
 
+                # with an arbid filter, let the store's per-arbid index hand us
+                # only the matching frames between idx and stop
+                if arbids != None and isinstance(messages, CanMsgStore):
+                    try:
+                        for fidx, ts, arbid, data in messages.iterArbidFrames(arbids, idx, stop):
+                            if maxsecs != None and time.time() > maxsecs+starttime:
+                                return
+
+                            yield((fidx, ts - startts, arbid, data))
+                            idx = fidx + 1
+
+                    except MsgEvictedError as e:
+                        # the ring buffer lapped us
+                        self._reportEvicted(idx, e.first)
+                        idx = e.first
+                        continue
+
+                    idx = stop
+                    continue
+
                 # now actually handle messages
-                ts, msg = messages[idx]
+                if isinstance(messages, CanMsgStore):
+                    try:
+                        ts, arbid, data = messages.getFrame(idx)
+                    except MsgEvictedError as e:
+                        self._reportEvicted(idx, e.first)
+                        idx = e.first
+                        continue
+                else:
+                    ts, msg = messages[idx]
+                    arbid, data = self._splitCanMsg(msg)
 
                 # make ts an offset instead of the real time.
                 ts -= startts
 
-                arbid, data = self._splitCanMsg(msg)
-
                 if arbids != None and arbid not in arbids:
                     # allow filtering of arbids
                     idx += 1
@@ -999,6 +1572,13 @@ class CanInterface(object):
         canmsgs = self._messages.get(self._msg_source_idx, [])
         return len(canmsgs)
 
+    def waitForCanMsgs(self, count, timeout):
+        '''
+        wait (up to timeout seconds) until more than count CAN messages have
+        been received.  returns True if they have
+        '''
+        return self._waitForMsgs(self._msg_source_idx, count, timeout)
+
     def printSessionStatsByBookmark(self, start=None, stop=None, reverse=True, sort=None):
         '''
         Prints session stats only for messages between two bookmarks
@@ -1057,45 +1637,103 @@ class CanInterface(object):
 
         return arbid_list
 
+    def getArbidStats(self, start=0, stop=None, percentiles=sessionstats.STATS_PERCENTILES):
+        '''
+        returns {arbid: stats} for messages start through stop (inclusive, like
+        genCanMsgs).  stats is a dict of count, first_ts/last_ts (from the start
+        of the session), mean/median/stddev/min/max/percentiles of the time
+        between messages, jitter and a {dlc: count} histogram.
+        see cancatlib.sessionstats, which uses NumPy if it's installed
+        '''
+        messages = self.getCanMsgQueue()
+        if messages == None:
+            return {}
+
+        if stop != None:
+            stop += 1
+
+        if isinstance(messages, CanMsgStore) and start < messages.getOldestIndex():
+            if start:
+                self._reportEvicted(start, messages.getOldestIndex())
+            start = messages.getOldestIndex()
+
+        if isinstance(messages, CanMsgStore) and start >= messages.getFirstIndex():
+            # straight from the columns, no per-message python
+            ts, arbids, dlcs = messages.getColumns(start, stop)
+            stats = sessionstats.getArbidStats(ts, arbids, dlcs, percentiles)
+            startts = messages.getStartTimestamp()
+
+        else:
+            ts = array('d')
+            arbids = []
+            dlcs = array('H')
+            if stop != None:
+                stop -= 1
+            for idx, mts, arbid, data in self.genCanMsgs(start, stop):
+                ts.append(mts)
+                arbids.append(arbid)
+                dlcs.append(len(data))
+
+            stats = sessionstats.getArbidStats(ts, arbids, dlcs, percentiles)
+            startts = 0
+
+        if startts:
+            for stat in stats.values():
+                stat['first_ts'] -= startts
+                stat['last_ts'] -= startts
+
+        return stats
+
+    def getLiveStats(self):
+        '''
+        returns {arbid: stats} kept up to date as messages are received, so it
+        costs nothing however long the capture is.  stats is a dict of count,
+        first_ts/last_ts (time.time() when received), mean/stddev/min/max of
+        the time between messages, last_data and changes (how many times the
+        data has changed).  Starts over with clearCanMsgs()
+        '''
+        return self._live_stats.getStats()
+
+    def reprLiveStats(self, arbids=None, reverse=True):
+        '''
+        the live stats (see getLiveStats()) as a table, by message count
+        '''
+        out = [sessionstats.LIVE_STATS_HEADER]
+        stats = self.getLiveStats()
+        arbid_list = sorted(((stat['count'], arbid, stat) for arbid, stat in stats.items()
+                             if arbids == None or arbid in arbids), key=itemgetter(0), reverse=reverse)
+
+        for count, arbid, stat in arbid_list:
+            out.append("  %8x\t %-12d mean: %8.3f    hi: %8.3f    lo: %7.3f    sd: %7.3f  %7d  %s" % \
+                    (arbid, count, stat['mean'], stat['max'], stat['min'], stat['stddev'],
+                     stat['changes'], binascii.hexlify(stat['last_data']).decode()))
+
+        out.append("Total Uniq IDs: %d\nTotal Messages: %d" % (len(stats), sum(stat['count'] for stat in stats.values())))
+        return '\n'.join(out)
+
+    def printLiveStats(self, arbids=None, reverse=True):
+        '''
+        print the live per-arbid stats.  see getLiveStats()
+        '''
+        print(self.reprLiveStats(arbids=arbids, reverse=reverse))
+
     def _reprSessionStatsHeader(self):
-        return 'Arbitration ID   Msg Count    Timing (mean/median/high/low)'
+        return 'Arbitration ID   Msg Count    Timing (mean/median/high/low/stddev/jitter)'
 
     def _reprArbid(self, arbid):
         return '  %8x' % arbid
 
     def getSessionStats(self, start=0, stop=None, reverse=True, sort=None):
         out = []
-        arbid_list = self.getArbitrationIds(start=start, stop=stop, reverse=reverse, sort=sort)
-
-        for datalen, arbid, msgs in arbid_list:
-            last = 0
-            high = 0
-            low = 0xffffffff
-            for ts, data in msgs:
-                if last == 0:
-                    last = ts
-                    continue
-
-                # calculate the high and low
-                delta = ts - last
-                if delta > high:
-                    high = delta
-                if delta < low:
-                    low = delta
-
-                # track repeated values (rounded to nearest .001 sec)
-                last = ts
+        stats = self.getArbidStats(start=start, stop=stop)
+        unsorted_list = [(stat['count'], arbid, stat) for arbid, stat in stats.items()]
+        arbid_list = self._sortArbitrationIds(unsorted_list, reverse=reverse, sort=sort)
 
-            if datalen > 1:
-                mean = (msgs[-1][0] - msgs[0][0]) / (datalen-1)
-                median = low + (high-low) / 2
-            else:
-                low = 0
-                mean = 0
-                median = mean
+        for datalen, arbid, stat in arbid_list:
             arbid_str = self._reprArbid(arbid)
-            out.append("%s\t %-12d mean: %8.3f     mdn: %8.3f    hi: %8.3f    lo: %7.3f" % \
-                    (arbid_str, datalen, mean, median, high, low))
+            out.append("%s\t %-12d mean: %8.3f     mdn: %8.3f    hi: %8.3f    lo: %7.3f    sd: %7.3f    jit: %7.3f" % \
+                    (arbid_str, datalen, stat['mean'], stat['median'], stat['max'], stat['min'],
+                     stat['stddev'], stat['jitter']))
 
         msg_count = self.getCanMsgCount()
         out.append("Total Uniq IDs: %d\nTotal Messages: %d" % (len(arbid_list), msg_count))
@@ -1111,6 +1749,9 @@ class CanInterface(object):
         self.restoreSession(me, force=force)
         self._filename = filename
 
+        if me.get('file_version', 0) >= sessionfile.SESSION_VERSION:
+            self._session_saved = self._sessionSnapshot(filename, me.get('messages'))
+
     def restoreSession(self, me, force=False):
         '''
         Load a previous analysis session from a python dictionary object
@@ -1120,7 +1761,7 @@ class CanInterface(object):
             print("Refusing to reload a session while active session!  use 'force=True' option")
             return
 
-        self._messages = me.get('messages')
+        self._messages = storeCanMailboxes(me.get('messages'))
         self.bookmarks = me.get('bookmarks')
         self.bookmark_info = me.get('bookmark_info')
         self.comments = me.get('comments')
@@ -1130,14 +1771,16 @@ class CanInterface(object):
         if ver is not None:
             self._config = me.get('config')
 
-        for cmd in self._messages:
-            self._msg_events[cmd] = threading.Event()
-
-    def saveSessionToFile(self, filename=None):
+    def saveSessionToFile(self, filename=None, pickled=False):
         '''
         Saves the current analysis session to the filename given
         If saved previously, the name will already be cached, so it is
         unnecessary to provide it again.
+
+        Sessions are written in the binary session format (see
+        cancatlib.sessionfile), which loads instantly.  Saving a live capture
+        to the same file again only appends the new messages.
+        pickled=True writes the old pickle format instead.
         '''
         if filename != None:
             self._filename = filename
@@ -1147,11 +1790,54 @@ class CanInterface(object):
             filename = self._filename
 
         savegame = self.saveSession()
-        me = pickle.dumps(savegame)
+        if pickled:
+            me = pickle.dumps(savegame)
 
-        outfile = open(filename, 'wb')
-        outfile.write(me)
-        outfile.close()
+            outfile = open(filename, 'wb')
+            outfile.write(me)
+            outfile.close()
+            self._session_saved = None
+            return
+
+        append_from = self._sessionAppendFrom(filename, savegame['messages'])
+        counts = sessionfile.writeSession(filename, savegame, append_from)
+        self._session_saved = self._sessionSnapshot(filename, savegame['messages'], counts)
+
+    def _sessionSnapshot(self, filename, messages, counts=None):
+        stores = dict((cmd, (mbox, mbox._mutations)) for cmd, mbox in messages.items()
+                      if isinstance(mbox, CanMsgStore))
+        if counts is None:
+            counts = dict((cmd, len(mbox)) for cmd, (mbox, mutations) in stores.items())
+        return filename, stores, counts
+
+    def _sessionAppendFrom(self, filename, messages):
+        '''
+        if filename holds our last binary save and the CAN mailboxes have only
+        grown since then, return {cmd: frames already saved}.  otherwise None
+        (the file gets rewritten)
+        '''
+        if self._session_saved is None:
+            return None
+
+        savedname, stores, counts = self._session_saved
+        if savedname != filename or not os.path.exists(filename):
+            return None
+
+        current = [cmd for cmd, mbox in messages.items() if isinstance(mbox, CanMsgStore)]
+        if set(current) != set(stores):
+            return None
+
+        for cmd in current:
+            mbox = messages[cmd]
+            store, mutations = stores[cmd]
+            if mbox is not store or mbox._mutations != mutations or len(mbox) < counts[cmd]:
+                return None
+
+            # frames we haven't saved yet may already be evicted
+            if counts[cmd] < mbox.getFirstIndex():
+                return None
+
+        return counts
 
     def saveSession(self):
         '''
@@ -1195,7 +1881,11 @@ class CanInterface(object):
         return bkmk_index
 
     def getMsgIndexFromBookmark(self, bkmk_index):
-        return self.bookmarks[bkmk_index]
+        msg_index = self.bookmarks[bkmk_index]
+        if msg_index < self.getOldestMsgIndex():
+            print("Bookmark %d (message %d) has been evicted, the oldest message still available is %d" %
+                    (bkmk_index, msg_index, self.getOldestMsgIndex()))
+        return msg_index
 
     def getBookmarkFromMsgIndex(self, msg_index):
         bkmk_index = self.bookmarks.index(msg_index)
@@ -1254,8 +1944,13 @@ class CanInterface(object):
 
         return self.filterCanMsgs(start_msg, stop_msg, start_baseline_msg, stop_baseline_msg, arbids, ignore, advfilters)
 
-    def _getLocals(self, idx, ts, arbid, data):
-        return {'idx':idx, 'ts':ts, 'arbid':arbid, 'data':data}
+    def _compileAdvFilters(self, advfilters):
+        '''
+        compile advfilters (source strings and/or callables) into a single
+        predicate(idx, ts, arbid, data) using this interface's filter names.
+        returns None if there are no filters.
+        '''
+        return compileAdvFilters(advfilters, self._advfilter_fields)
 
     def filterCanMsgs(self, start_msg=0, stop_msg=None, start_baseline_msg=None, stop_baseline_msg=None, arbids=None, ignore=[], advfilters=[], tail=False, maxsecs=None):
         '''
@@ -1278,6 +1973,8 @@ class CanInterface(object):
         if arbids != None and type(arbids) != list:
             arbids = [arbids]
 
+        advfilter = self._compileAdvFilters(advfilters)
+
         for genmsg in self.genCanMsgs(start_msg, stop_msg, arbids=arbids, tail=tail, maxsecs=maxsecs):
             # if we use "tail" we may yield Nones if we're waiting.
             if genmsg is None:
@@ -1290,18 +1987,7 @@ class CanInterface(object):
                 continue
 
             # advanced filters allow python code to be handed in.  if any of the python code snippits result in "False" or 0, skip this message
-            skip = False
-            if advfilters:
-                # do this once per message, but only if there are advanced filters
-                lcls = self._getLocals(idx, ts, arbid, msg)
-
-            for advf in advfilters:
-                # eval each advfilter string/python and determine if this
-                # message should be included.
-                if not eval(advf, lcls):
-                    skip = True
-
-            if skip:
+            if advfilter != None and not advfilter(idx, ts, arbid, msg):
                 self.log("skipping message(adv): (%r, %r, %r, %r)" % ((idx, ts, arbid, msg)))
                 continue
 
@@ -1823,9 +2509,11 @@ class CanInTheMiddleInterface(CanInterface):
             stop = stop + 1
 
         for idx in xrange(start, stop):
-            ts, msg = messages[idx]
-
-            arbid, data = self._splitCanMsg(msg)
+            if isinstance(messages, CanMsgStore):
+                ts, arbid, data = messages.getFrame(idx)
+            else:
+                ts, msg = messages[idx]
+                arbid, data = self._splitCanMsg(msg)
 
             if arbids != None and arbid not in arbids:
                 # allow filtering of arbids
@@ -2055,18 +2743,14 @@ class CanInTheMiddleInterface(CanInterface):
         if type(arbids) != list:
             arbids = [arbids]
 
+        advfilter = self._compileAdvFilters(advfilters)
+
         for idx,ts,arbid,msg in self.genCanMsgs(start_msg, stop_msg, arbids=arbids):
             if not ((arbids != None and arbid in arbids) or arbid not in ignore and (filter_ids==None or arbid not in filter_ids)):
                 continue
 
             # advanced filters allow python code to be handed in.  if any of the python code snippits result in "False" or 0, skip this message
-            skip = False
-            for advf in advfilters:
-                lcls = self._locals(idx, ts, arbid, msg)
-                if not eval(advf, lcls):
-                    skip = True
-
-            if skip:
+            if advfilter != None and not advfilter(idx, ts, arbid, msg):
                 continue
 
             yield (idx, ts,arbid,msg)
@@ -2269,7 +2953,7 @@ class CanInTheMiddleInterface(CanInterface):
             print("Refusing to reload a session while active session!  use 'force=True' option")
             return
 
-        self._messages = me.get('messages')
+        self._messages = storeCanMailboxes(me.get('messages'))
         self.bookmarks = me.get('bookmarks')
         self.bookmark_info = me.get('bookmark_info')
         self.comments = me.get('comments')
@@ -0,0 +1,116 @@
+'''
+Compiled "advanced filters".
+
+advfilters are snippets of python handed in by the user (eg. 'pf==0xeb' or
+'sa in (0x00, 0x0b)') that decide whether a message is shown/kept.  They used
+to be eval()'d from source for every message, with a freshly built locals
+dict each time.  Instead, compileAdvFilters() turns the whole list into one
+python function:
+
+    def _advfilter(idx, ts, arbid, data):
+        pf = arbid[4]               # only the fields the filters actually use
+        return (pf == 0xeb) and (sa in _const0)
+
+Each interface describes the names its filters may use as a dict of
+{name: python expression in terms of idx, ts, arbid, data}.  Constant
+membership tests ("x in (1, 2, 3)") are turned into frozenset lookups.
+
+A filter may also be a callable, which is called as func(idx, ts, arbid, data)
+and skips all of this.
+'''
+import ast
+import functools
+
+ADVFILTER_ARGS = ('idx', 'ts', 'arbid', 'data')
+
+# how many compiled predicates to keep around.  the cache keys hold on to any
+# callables among the filters, so it can't grow for the life of the process
+ADVFILTER_CACHE_SIZE = 64
+
+
+class _ConstSetRewriter(ast.NodeTransformer):
+    '''
+    rewrite "x in (const, const, ...)" into a lookup in a prebuilt frozenset
+    '''
+    def __init__(self, consts):
+        self.consts = consts
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        comparators = []
+        for op, comp in zip(node.ops, node.comparators):
+            if isinstance(op, (ast.In, ast.NotIn)) and \
+                    isinstance(comp, (ast.Tuple, ast.List, ast.Set)) and \
+                    all(isinstance(elt, ast.Constant) for elt in comp.elts):
+                name = '_const%d' % len(self.consts)
+                self.consts[name] = frozenset(elt.value for elt in comp.elts)
+                comp = ast.copy_location(ast.Name(id=name, ctx=ast.Load()), comp)
+
+            comparators.append(comp)
+
+        node.comparators = comparators
+        return node
+
+
+@functools.lru_cache(maxsize=ADVFILTER_CACHE_SIZE)
+def _buildAdvFilter(advfilters, fields):
+    namespace = {}
+    exprs = []
+    used = set()
+
+    for fidx, advf in enumerate(advfilters):
+        if callable(advf):
+            name = '_func%d' % fidx
+            namespace[name] = advf
+            args = [ast.Name(id=arg, ctx=ast.Load()) for arg in ADVFILTER_ARGS]
+            exprs.append(ast.Call(func=ast.Name(id=name, ctx=ast.Load()), args=args, keywords=[]))
+            continue
+
+        expr = ast.parse(advf.strip(), '<advfilter>', 'eval').body
+        expr = _ConstSetRewriter(namespace).visit(expr)
+        used.update(node.id for node in ast.walk(expr) if isinstance(node, ast.Name))
+        exprs.append(expr)
+
+    # only compute the fields the filters reference
+    body = []
+    for name, src in fields:
+        if name in used and name not in ADVFILTER_ARGS:
+            value = ast.parse(src, '<advfilter>', 'eval').body
+            body.append(ast.Assign(targets=[ast.Name(id=name, ctx=ast.Store())], value=value))
+
+    if len(exprs) == 1:
+        retval = exprs[0]
+    else:
+        retval = ast.BoolOp(op=ast.And(), values=exprs)
+    body.append(ast.Return(value=retval))
+
+    args = ast.arguments(posonlyargs=[], args=[ast.arg(arg=arg) for arg in ADVFILTER_ARGS],
+                         vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+    func = ast.FunctionDef(name='_advfilter', args=args, body=body, decorator_list=[], returns=None)
+    module = ast.fix_missing_locations(ast.Module(body=[func], type_ignores=[]))
+
+    exec(compile(module, '<advfilters>', 'exec'), namespace)
+    return namespace['_advfilter']
+
+
+def compileAdvFilters(advfilters, fields=None):
+    '''
+    compile a list of advfilters (python source strings and/or callables) into
+    a single predicate: pred(idx, ts, arbid, data) -> True if the message passes
+    every filter.  returns None if there are no filters.
+
+    fields is a dict of extra names available to the filters (see module doc).
+    SyntaxErrors in the filters are raised here rather than per message.
+    '''
+    if not advfilters:
+        return None
+
+    if isinstance(advfilters, (str, bytes)) or callable(advfilters):
+        advfilters = [advfilters]
+
+    advfilters = tuple(advfilters)
+    if len(advfilters) == 1 and callable(advfilters[0]):
+        return advfilters[0]
+
+    fields = tuple(sorted((fields or {}).items()))
+    return _buildAdvFilter(advfilters, fields)
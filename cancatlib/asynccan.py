@@ -0,0 +1,439 @@
+'''
+asyncio front end for a CanInterface.
+
+AsyncCanInterface sits on top of a CanInterface: the receive thread and the
+message store are the CanInterface's, nothing is received or kept twice.
+What the receive thread files away is handed over to the event loop in
+batches, so any number of transmits, ISO-TP exchanges and subscriptions can
+be waited on at once without a thread for each:
+
+    async def main():
+        ac = AsyncCanInterface(port='/dev/ttyACM0')
+
+        await ac.CANxmit(0x7df, b'\\x02\\x01\\x00')
+        msg, idx = await ac.ISOTPxmit_recv(0x7e0, 0x7e8, b'\\x22\\xf1\\x90')
+
+        with ac.subscribe([0x7e8, 0x7e9]) as sub:
+            async for idx, ts, arbid, data in sub:
+                ...
+
+        async for idx, ts, arbid, data in ac.genCanMsgs(start=None, maxsecs=10):
+            ...
+
+Anything else (setCanBaud(), saveSessionToFile(), ...) goes straight to the
+CanInterface.  An AsyncCanInterface belongs to the first event loop it's
+used from.  Don't transmit through the CanInterface itself while coroutines
+are transmitting: both take their results from the same mailbox.
+
+ISO-TP is done here rather than in the transceiver (like
+CanInterface.host_isotp), which only keeps track of one ISO-TP exchange at a
+time.
+'''
+import time
+import struct
+import asyncio
+from collections import deque
+
+from cancatlib import iso_tp
+from cancatlib import CanInterface, CanMsgStore, CMD_CAN_RECV, CMD_CAN_SEND, CMD_CAN_SEND_RESULT,\
+        CAN_RESPS, CAN_RESP_FAIL, CAN_XMIT_WINDOW, ISOTP_PAD, ISOTP_FLOWCONTROL
+
+# old messages genCanMsgs() yields between giving the event loop a turn
+HISTORY_BATCH = 256
+
+
+class Subscription(object):
+    '''
+    the CAN messages received from now on (from some arbids, or all of them)
+    as an async iterator of (idx, ts, arbid, data).  close() it when done (or
+    use it as a context manager).  if maxsize is set, messages that don't fit
+    in the queue are dropped and counted in .dropped
+    '''
+    def __init__(self, aiface, arbids=None, maxsize=0):
+        self._aiface = aiface
+        self.arbids = None if arbids is None else frozenset(arbids)
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+        self.closed = False
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def get(self, timeout=None):
+        '''
+        the next message, None after timeout seconds or once closed
+        '''
+        if self.closed and self.queue.empty():
+            return None
+        if timeout is None:
+            return await self.queue.get()
+
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._aiface._unsubscribe(self)
+            # wake up anyone waiting on us, even if it costs a message
+            while True:
+                try:
+                    self.queue.put_nowait(None)
+                    break
+                except asyncio.QueueFull:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+
+class AsyncCanInterface(object):
+    '''
+    awaitable CANxmit() and ISOTPxmit_recv(), plus subscriptions and an async
+    genCanMsgs(), over a CanInterface (iface, or one made from kwargs)
+    '''
+    def __init__(self, iface=None, **kwargs):
+        if iface is None:
+            iface = CanInterface(**kwargs)
+
+        self.iface = iface
+        self._loop = None
+        self._window = None
+        # (cmd, idx, tsmsg) from the receive thread, for _dispatch()
+        self._backlog = deque()
+        self._scheduled = False
+        # arbid -> [Subscription], and the ones for every arbid
+        self._subs = {}
+        self._subs_all = []
+        # rx_arbid -> [IsoTpListener]
+        self._isotp = {}
+        # result cmd -> deque of futures, oldest command first
+        self._results = {}
+
+    def __getattr__(self, name):
+        return getattr(self.iface, name)
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is None:
+            self._loop = loop
+            self._window = asyncio.Semaphore(CAN_XMIT_WINDOW)
+            self.iface.addMsgListener(self._onMessage)
+
+        elif loop is not self._loop:
+            raise RuntimeError("AsyncCanInterface is already in use from another event loop")
+
+        return loop
+
+    def detach(self):
+        '''
+        stop taking messages from the CanInterface and end all subscriptions
+        '''
+        self.iface.removeMsgListener(self._onMessage)
+        for sub in self._subs_all + [sub for subs in self._subs.values() for sub in subs]:
+            sub.close()
+        self._loop = None
+
+    def _onMessage(self, cmd, idx, tsmsg):
+        '''
+        receive thread: queue up anything the event loop is waiting for
+        '''
+        if cmd == CMD_CAN_RECV:
+            if not (self._subs or self._subs_all or self._isotp):
+                return
+        elif cmd not in self._results:
+            return
+
+        self._backlog.append((cmd, idx, tsmsg))
+        if not self._scheduled:
+            self._scheduled = True
+            try:
+                self._loop.call_soon_threadsafe(self._dispatch)
+            except (AttributeError, RuntimeError):
+                # detached, or the loop is closed
+                pass
+
+    def _dispatch(self):
+        '''
+        event loop: hand the backlog to whoever is waiting on it
+        '''
+        # cleared first, so anything queued from here on schedules another pass
+        self._scheduled = False
+        backlog = self._backlog
+        while backlog:
+            cmd, idx, tsmsg = backlog.popleft()
+            if cmd != CMD_CAN_RECV:
+                waiters = self._results.get(cmd)
+                if not waiters:
+                    continue
+
+                ts, result = self.iface.recv(cmd, 0)
+                if result is None:
+                    continue
+
+                # a waiter that gave up still owns its command's result
+                fut = waiters.popleft()
+                if not fut.done():
+                    fut.set_result(result)
+                continue
+
+            ts, msg = tsmsg
+            arbid, data = self.iface._splitCanMsg(msg)
+            for listener in self._isotp.get(arbid, ()):
+                if listener.feedFrame(idx, ts, arbid, data):
+                    listener.event.set()
+
+            frame = (idx, ts, arbid, data)
+            for sub in self._subs.get(arbid, ()):
+                sub._put(frame)
+            for sub in self._subs_all:
+                sub._put(frame)
+
+    def subscribe(self, arbids=None, maxsize=0):
+        '''
+        returns a Subscription to the CAN messages received from now on from
+        arbids (None: all of them)
+        '''
+        self._bind()
+        sub = Subscription(self, arbids, maxsize)
+        if sub.arbids is None:
+            self._subs_all.append(sub)
+        else:
+            for arbid in sub.arbids:
+                self._subs.setdefault(arbid, []).append(sub)
+        return sub
+
+    def _unsubscribe(self, sub):
+        if sub.arbids is None:
+            if sub in self._subs_all:
+                self._subs_all.remove(sub)
+            return
+
+        for arbid in sub.arbids:
+            subs = self._subs.get(arbid, [])
+            if sub in subs:
+                subs.remove(sub)
+            if not subs:
+                self._subs.pop(arbid, None)
+
+    async def _command(self, cmd, resultcmd, message, timeout):
+        '''
+        send a command to the transceiver and wait (up to timeout) for its
+        result.  no more than CAN_XMIT_WINDOW are outstanding at once
+        '''
+        loop = self._bind()
+        async with self._window:
+            fut = loop.create_future()
+            self._results.setdefault(resultcmd, deque()).append(fut)
+            self.iface._send(cmd, message)
+            try:
+                return await asyncio.wait_for(fut, timeout)
+            except asyncio.TimeoutError:
+                return None
+
+    async def CANxmit(self, arbid, message, extflag=0, timeout=3):
+        '''
+        Transmit a CAN message on the attached CAN bus.  Returns the
+        transceiver's result, None if there wasn't one within timeout
+        '''
+        msg = struct.pack('>IB', arbid, extflag) + self.iface._bytesHelper(message)
+        result = await self._command(CMD_CAN_SEND, CMD_CAN_SEND_RESULT, msg, timeout)
+
+        if result == None:
+            print("CANxmit:  Return is None!?")
+            return None
+
+        resval = result[0]
+        if resval != 0:
+            print("CANxmit() failed: %s" % CAN_RESPS.get(resval))
+
+        return resval
+
+    def _isotpListen(self, rx_arbid):
+        listener = iso_tp.IsoTpListener(verbose=self.iface.verbose > 2)
+        listener.event = asyncio.Event()
+        self._isotp.setdefault(rx_arbid, []).append(listener)
+        # frames counted here were filed before we were listening
+        listener.next_idx = self.iface.getCanMsgCount()
+        return listener
+
+    def _isotpUnlisten(self, rx_arbid, listener):
+        self._isotp[rx_arbid].remove(listener)
+        if not self._isotp[rx_arbid]:
+            del self._isotp[rx_arbid]
+
+    async def _isotpWait(self, listener, ready, deadline):
+        '''
+        wait until ready() or the deadline.  returns ready()
+        '''
+        while not ready():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            listener.event.clear()
+            try:
+                await asyncio.wait_for(listener.event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        return True
+
+    async def _isotpXmit(self, listener, tx_arbid, rx_arbid, message, extflag, timeout):
+        frames = [frame.ljust(8, ISOTP_PAD) for frame in iso_tp.msg_encode(message)]
+        resval = await self.CANxmit(tx_arbid, frames[0], extflag, timeout)
+
+        idx = 1
+        while resval == 0 and idx < len(frames):
+            if not await self._isotpWait(listener, lambda: listener.flowcontrol, time.time() + timeout):
+                print("ISOTPxmit: no flow control from 0x%x" % rx_arbid)
+                return None
+
+            fc = listener.flowcontrol.pop(0)
+            status, blocksize, stmin = iso_tp.flowcontrol_params(fc)
+            if status == 1:
+                # wait for the next one
+                continue
+            elif status != 0:
+                print("ISOTPxmit: 0x%x aborted the transfer: %s" % (rx_arbid, fc.hex()))
+                return CAN_RESP_FAIL
+
+            blocksize = blocksize or len(frames)
+            for frame in frames[idx:idx+blocksize]:
+                resval = await self.CANxmit(tx_arbid, frame, extflag, timeout)
+                if resval != 0:
+                    break
+                if stmin:
+                    await asyncio.sleep(stmin)
+            idx += blocksize
+
+        return resval
+
+    async def ISOTPxmit(self, tx_arbid, rx_arbid, message, extflag=0, timeout=3):
+        '''
+        Transmit an ISOTP message, taking the flow control from rx_arbid.
+        Returns the result of the last frame sent, None if the flow control
+        never came
+        '''
+        self._bind()
+        listener = self._isotpListen(rx_arbid)
+        try:
+            return await self._isotpXmit(listener, tx_arbid, rx_arbid, message, extflag, timeout)
+        finally:
+            self._isotpUnlisten(rx_arbid, listener)
+
+    async def ISOTPxmit_recv(self, tx_arbid, rx_arbid, message, extflag=0, timeout=3, service=None):
+        '''
+        Transmit an ISOTP message and wait for the response from rx_arbid
+        (sending its flow control).  Returns (message, index of its last
+        frame), or (None, index) if nothing came in timeout seconds.
+
+        With service, responses to other services are skipped (negative
+        responses, 0x7f, are returned).  TesterPresent responses always are
+        '''
+        self._bind()
+        if isinstance(service, int):
+            # Assume this is a 1 byte SID value
+            service = struct.pack('>B', service & 0xff)
+
+        listener = self._isotpListen(rx_arbid)
+        start_index = listener.next_idx
+        try:
+            await self._isotpXmit(listener, tx_arbid, rx_arbid, message, extflag, timeout)
+
+            deadline = time.time() + timeout
+            while True:
+                if listener.fc_wanted:
+                    listener.fc_wanted = False
+                    await self.CANxmit(tx_arbid, ISOTP_FLOWCONTROL.ljust(8, ISOTP_PAD), extflag)
+
+                while listener.pdus:
+                    arbid, msg, first_idx, last_idx = listener.pdus.pop(0)
+                    start_index = last_idx + 1
+                    if not len(msg) or msg[0] == 0x7e:
+                        continue
+                    if service is None or msg[:len(service)] == service or msg[0] == 0x7f:
+                        return msg, last_idx
+
+                if not await self._isotpWait(listener, lambda: listener.pdus or listener.fc_wanted, deadline):
+                    return None, start_index
+
+        finally:
+            self._isotpUnlisten(rx_arbid, listener)
+
+    async def genCanMsgs(self, start=0, stop=None, arbids=None, maxsecs=None):
+        '''
+        async CanInterface.genCanMsgs(tail=True): yields (idx, ts, arbid, data)
+        for the CAN messages from index start (None: only new ones), waiting
+        for more as they come in, until index stop (inclusive) or maxsecs
+        seconds.  ts is relative to the first message, like genCanMsgs()
+        '''
+        deadline = None if maxsecs is None else time.time() + maxsecs
+        sub = self.subscribe(arbids)
+        try:
+            count = self.iface.getCanMsgCount()
+            messages = self.iface.getCanMsgQueue()
+            if isinstance(messages, CanMsgStore) and len(messages):
+                startts = messages.getStartTimestamp()
+            elif messages != None and len(messages):
+                startts = messages[0][0]
+            else:
+                startts = time.time()
+
+            if start == None:
+                start = count
+
+            # what's already here, then whatever the subscription has queued since
+            if start < count:
+                last = count - 1 if stop is None else min(stop, count - 1)
+                for x, frame in enumerate(self.iface.genCanMsgs(start, last, arbids=arbids)):
+                    if deadline is not None and time.time() > deadline:
+                        return
+                    yield frame
+                    if x % HISTORY_BATCH == HISTORY_BATCH - 1:
+                        await asyncio.sleep(0)
+
+            if stop is not None and stop < count:
+                return
+
+            while True:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        return
+
+                frame = await sub.get(timeout)
+                if frame is None:
+                    return
+
+                idx, ts, arbid, data = frame
+                if idx < count or idx < start:
+                    continue
+                if stop is not None and idx > stop:
+                    return
+
+                yield idx, ts - startts, arbid, data
+                if stop is not None and idx >= stop:
+                    return
+
+        finally:
+            sub.close()
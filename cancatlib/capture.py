@@ -0,0 +1,235 @@
+'''
+Continuous capture to rolling segment files.
+
+For long captures, CaptureWriter streams an interface's CAN mailbox to disk
+from a background thread: every flush it appends the new frames to the
+current segment file, starts a new segment when the current one gets too
+big (or too old), and evicts frames that are safely on disk from memory so
+only the newest `window` frames are kept.
+
+Segments are ordinary binary session files (see cancatlib.sessionfile)
+named <basename>.0000.cancat, <basename>.0001.cancat, ...  Each one records
+the message index of its first frame, so they can also be loaded on their
+own with CanInterface(load_filename=...).
+
+SegmentArchive is the read side: the CanMsgStore hands it any request for
+an evicted index, so genCanMsgs()/printCanMsgs() keep working across the
+whole capture with the same message indexes.
+'''
+import sys
+import time
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+from cancatlib import sessionfile
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+WINDOW = 1000000
+FLUSH_INTERVAL = 1.0
+# segments kept open for reading evicted frames back
+SEGMENT_CACHE = 4
+
+
+class SegmentArchive(object):
+    '''
+    Evicted frames, by message index, read back from the segment files
+    '''
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self._firsts = []
+        self._filenames = []
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def addSegment(self, first_idx, filename):
+        with self._lock:
+            self._firsts.append(first_idx)
+            self._filenames.append(filename)
+
+    def getFirstIndex(self):
+        with self._lock:
+            if not self._firsts:
+                return 0
+            return self._firsts[0]
+
+    def getSegments(self):
+        '''
+        returns [(first message index, filename), ...]
+        '''
+        with self._lock:
+            return list(zip(self._firsts, self._filenames))
+
+    def _getStore(self, idx):
+        '''
+        returns (store, first index of the next segment or None) for the
+        segment holding idx
+        '''
+        with self._lock:
+            pos = bisect_right(self._firsts, idx) - 1
+            if pos < 0:
+                raise IndexError('message %d is not in any capture segment' % idx)
+
+            filename = self._filenames[pos]
+            nextfirst = None
+            if pos + 1 < len(self._firsts):
+                nextfirst = self._firsts[pos + 1]
+
+            store = self._cache.get(filename)
+            if store is None or idx >= len(store):
+                # the newest segment is still being written, so reload if it's grown
+                store = sessionfile.loadSession(filename)['messages'].get(self.cmd)
+                if store is None or idx >= len(store):
+                    raise IndexError('message %d has not been written to %r yet' % (idx, filename))
+                self._cache[filename] = store
+
+            self._cache.move_to_end(filename)
+            while len(self._cache) > SEGMENT_CACHE:
+                self._cache.popitem(last=False)
+
+            return store, nextfirst
+
+    def _iterSegments(self, start, stop):
+        while start < stop:
+            store, nextfirst = self._getStore(start)
+            end = stop
+            if nextfirst is not None and nextfirst < stop:
+                end = nextfirst
+            yield store, start, end
+            start = end
+
+    def getFrame(self, idx):
+        store, nextfirst = self._getStore(idx)
+        return store.getFrame(idx)
+
+    def iterFrames(self, start, stop):
+        for store, lo, hi in self._iterSegments(start, stop):
+            for frame in store.iterFrames(lo, hi):
+                yield frame
+
+    def iterArbidFrames(self, arbids, start, stop):
+        for store, lo, hi in self._iterSegments(start, stop):
+            for frame in store.iterArbidFrames(arbids, lo, hi):
+                yield frame
+
+
+class CaptureWriter(object):
+    '''
+    Writes an interface's cmd mailbox (a CanMsgStore) to rolling segment
+    files from a background thread.  see CanInterface.startCapture()
+    '''
+    def __init__(self, iface, basename, cmd, segment_bytes=SEGMENT_BYTES, segment_secs=None, window=WINDOW, flush_interval=FLUSH_INTERVAL):
+        self.iface = iface
+        self.basename = basename
+        self.cmd = cmd
+        self.segment_bytes = segment_bytes
+        self.segment_secs = segment_secs
+        self.window = window
+        self.flush_interval = flush_interval
+
+        self.archive = None
+        self.filenames = []
+        self._store = None
+        self._writer = None
+        self._written = 0
+        self._segnum = 0
+        self._seg_first = 0
+        self._seg_started = None
+
+        self._go = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._runner)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''
+        write out everything that's left and close the current segment
+        '''
+        self._go.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _runner(self):
+        while not self._go.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                self.iface.log("capture: ERROR: %r" % e, -1)
+                if self.iface.verbose:
+                    sys.excepthook(*sys.exc_info())
+
+        try:
+            self.flush()
+        finally:
+            self._closeSegment()
+
+    def _meta(self):
+        meta = dict(self.iface.saveSession())
+        meta['messages'] = {}
+        meta['file_version'] = float(sessionfile.SESSION_VERSION)
+        meta['first_idx'] = {self.cmd: self._seg_first}
+        meta['start_ts'] = {self.cmd: self._store.getStartTimestamp()}
+        return meta
+
+    def _openSegment(self, first_idx):
+        filename = '%s.%04d.cancat' % (self.basename, self._segnum)
+        self._segnum += 1
+        self._seg_first = first_idx
+        self._seg_started = time.time()
+
+        self._writer = sessionfile.SessionFileWriter(filename)
+        self._writer.writeMeta(self._meta())
+        self._writer.flush()
+
+        self.archive.addSegment(first_idx, filename)
+        self.filenames.append(filename)
+        self.iface.log("capture: new segment %r (from message %d)" % (filename, first_idx), 1)
+
+    def _closeSegment(self):
+        if self._writer is None:
+            return
+
+        # bookmarks/comments may have changed since the segment was started
+        self._writer.writeMeta(self._meta())
+        self._writer.flush(sync=True)
+        self._writer.close()
+        self._writer = None
+
+    def flush(self):
+        '''
+        write out new frames, rotate segments and evict from memory.
+        called every flush_interval seconds from the writer thread
+        '''
+        store = self.iface._messages.get(self.cmd)
+        if store is None:
+            return
+
+        if store is not self._store:
+            # first messages, or the mailbox was cleared: numbering starts over
+            self._closeSegment()
+            self._store = store
+            self.archive = SegmentArchive(self.cmd)
+            store._archive = self.archive
+            self._written = store.getFirstIndex()
+            self._openSegment(self._written)
+
+        count = len(store)
+        if count > self._written:
+            self._written += self._writer.writeFrames(self.cmd, store, self._written, count)
+            self._writer.flush()
+
+        if self._written > self._seg_first:
+            if self._writer.tell() >= self.segment_bytes or \
+                    (self.segment_secs and time.time() - self._seg_started >= self.segment_secs):
+                self._closeSegment()
+                self._openSegment(self._written)
+
+        # anything on disk and older than the window can go
+        excess = min(self._written, len(store) - self.window) - store.getFirstIndex()
+        if excess > 0:
+            with self.iface._queuelock:
+                store.evict(excess)
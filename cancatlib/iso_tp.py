@@ -4,6 +4,9 @@ import sys
 import struct
 
 def msg_encode(data, verbose=False):
+    '''
+    split data into the (unpadded) CAN frame payloads of one ISO-TP message
+    '''
     olist = []
     dlen = len(data)
 
@@ -15,14 +18,14 @@ def msg_encode(data, verbose=False):
         ftype = 0
         size = dlen
         b0 = (ftype << 4) | size
-        olist.append( "%c%s" % (b0, data))
+        olist.append(struct.pack(">B", b0) + data)
 
     else:
         # first frame
         ftype = 1
         size = dlen
         b0 = (ftype << 12) | size
-        olist.append( "%s%s" % (struct.pack(">H", b0), data[:6]) )
+        olist.append(struct.pack(">H", b0) + data[:6])
 
         # consecutive frames
         frameidx = 1
@@ -30,7 +33,7 @@ def msg_encode(data, verbose=False):
             ftype = 2
             b0 = (ftype << 4) | frameidx
             if verbose: print(hex(b0))
-            olist.append( "%c%s" % (b0, data[dataidx:dataidx+7]) )
+            olist.append(struct.pack(">B", b0) + data[dataidx:dataidx+7])
 
             frameidx += 1
             frameidx %= 16
@@ -38,6 +41,26 @@ def msg_encode(data, verbose=False):
     return olist
 
 
+def flowcontrol_params(fc):
+    '''
+    returns (status, blocksize, separation time in seconds) from a flow
+    control frame's payload.  status is 0 (go), 1 (wait) or 2 (overflow),
+    None if the frame is too short to make sense of
+    '''
+    if len(fc) < 3:
+        return None, 0, 0
+
+    stmin = fc[2]
+    if stmin <= 0x7f:
+        stmin /= 1000.0
+    elif 0xf1 <= stmin <= 0xf9:
+        stmin = (stmin - 0xf0) / 10000.0
+    else:
+        # reserved values mean the longest separation time
+        stmin = .127
+
+    return fc[0] & 0xf, fc[1], stmin
+
 class IncompleteIsoTpMsg(Exception):
     def __init__(self, output, length):
         self.output = output
@@ -127,6 +150,127 @@ def msg_decode(msglist, offset=0, verbose=False, cancat=True):
     return arbid, b''.join(output), count
 
 
+class IsoTpReassembler(object):
+    '''
+    Incremental ISO-TP decoder for a single arbid.  Frames are fed in one at
+    a time (eg. from the receive thread) instead of re-decoding the whole
+    message list each time a new frame shows up.
+
+    feed() returns (arbid, data, first_idx, last_idx) when a PDU completes,
+    otherwise None.
+    '''
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        self.output = []
+        self.length = None
+        self.nextidx = 0
+        self.first_idx = None
+
+    def feed(self, idx, ts, arbid, msg):
+        if not len(msg):
+            return None
+
+        ctrl = msg[0]
+        ftype = (ctrl >> 4)
+        if ftype == 0:
+            if self.length != None:
+                if self.verbose:
+                    print("Failed to reach length: %d bytes short (new single frame)" % self.length)
+                self.reset()
+
+            # Single packet message, return only the relevant data
+            return arbid, msg[1:ctrl+1], idx, idx
+
+        elif ftype == 1:
+            if self.length != None and self.verbose:
+                print("Dropping incomplete ISO-TP message: %d bytes short (new first frame)" % self.length)
+
+            self.reset()
+            self.length = struct.unpack(">H", msg[0:2])[0] & 0xfff
+            self.first_idx = idx
+
+            msg = msg[2:self.length+2]
+            self.output.append(msg)
+            self.length -= len(msg)
+            self.nextidx = 1
+
+        elif ftype == 2:
+            if self.length == None:
+                # consecutive frame without a first frame (we started listening late)
+                return None
+
+            seq = ctrl & 0xf
+            if seq != self.nextidx:
+                print("Indexing Bug: idx: %x != nextidx: %x" % (seq, self.nextidx))
+
+            msg = msg[1:self.length+1]
+            self.output.append(msg)
+            self.length -= len(msg)
+            self.nextidx = (self.nextidx + 1) & 0xf
+
+        else:
+            # flow control, or something that doesn't fit
+            return None
+
+        if self.length > 0:
+            return None
+
+        data = b''.join(self.output)
+        first_idx = self.first_idx
+        self.reset()
+        return arbid, data, first_idx, idx
+
+
+class IsoTpListener(IsoTpReassembler):
+    '''
+    IsoTpReassembler for someone waiting on a response: ignores frames it has
+    already seen (by message index) and collects completed PDUs in .pdus.
+
+    .first_ts is the timestamp of the first single or first frame it's
+    seen, when a response started coming in.
+
+    for host side ISO-TP (see CanInterface.host_isotp) it also keeps the
+    flow control frames it sees in .flowcontrol, and sets .fc_wanted when a
+    first frame is waiting for us to send flow control
+    '''
+    def __init__(self, start_idx=0, verbose=False):
+        IsoTpReassembler.__init__(self, verbose)
+        self.next_idx = start_idx
+        self.pdus = []
+        self.flowcontrol = []
+        self.fc_wanted = False
+        self.first_ts = None
+
+    def feedFrame(self, idx, ts, arbid, msg):
+        '''
+        returns True if this frame is news for the waiter: it completed a
+        PDU, started one or is flow control
+        '''
+        if idx < self.next_idx:
+            return False
+
+        self.next_idx = idx + 1
+        ftype = msg[0] >> 4 if len(msg) else None
+        if ftype == 3:
+            self.flowcontrol.append(msg)
+            return True
+
+        if ftype in (0, 1) and self.first_ts is None:
+            self.first_ts = ts
+
+        res = self.feed(idx, ts, arbid, msg)
+        # once consecutive frames show up, somebody has sent flow control
+        self.fc_wanted = (ftype == 1 and res is None)
+        if res is None:
+            return self.fc_wanted
+
+        self.pdus.append(res)
+        return True
+
+
 def msgs_decode(msglist, verbose=False):
     output = None
     messages = []
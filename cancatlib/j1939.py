@@ -3,7 +3,9 @@ from __future__ import print_function
 import queue
 import cancatlib
 import struct
-from cancatlib.J1939db import *
+from binascii import hexlify
+from functools import lru_cache
+from cancatlib.j1939tables import *
 from cancatlib import *
 
 from cancatlib.vstruct.bitfield import *
@@ -286,11 +288,16 @@ pgn_pfs = {
         0xff:   ("Proprietary B",   pf_ff),
         }
 
+# real buses only have a few hundred arbids, so the per-frame work of
+# splitting them apart is cached
+ARBID_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=ARBID_CACHE_SIZE)
 def parseArbid(arbid):
-    (prioPlus,
-        pf,
-        ps,
-        sa) = struct.unpack('BBBB', struct.pack(">I", arbid))
+    prioPlus = (arbid >> 24) & 0xff
+    pf = (arbid >> 16) & 0xff
+    ps = (arbid >> 8) & 0xff
+    sa = arbid & 0xff
 
     prio = prioPlus >> 2
     edp = (prioPlus >> 1) & 1
@@ -466,6 +473,19 @@ class TimeoutException(Exception):
     pass
 
 class J1939(cancatlib.CanInterface):
+    # advfilter names, computed from the raw 29-bit arbid (see parseArbid)
+    _advfilter_fields = {'id':       'arbid',
+                         'priority': 'arbid >> 26',
+                         'edp':      '(arbid >> 25) & 1',
+                         'dp':       '(arbid >> 24) & 1',
+                         'pf':       '(arbid >> 16) & 0xff',
+                         'ps':       '(arbid >> 8) & 0xff',
+                         'sa':       'arbid & 0xff',
+                         'pgn':      '(arbid >> 8) & 0xffff',
+                         'da':       '(arbid >> 8) & 0xff',
+                         'ge':       '(arbid >> 8) & 0xff',
+                         }
+
     def __init__(self, port=None, baud=baud, verbose=False, cmdhandlers=None, comment='', load_filename=None, orig_iface=None):
         self.myIDs = []
         self.extMsgs = {}
@@ -559,7 +579,7 @@ class J1939(cancatlib.CanInterface):
             spnlines = None
             spns = res.get("SPNs")
             if spns is not None:
-                spnlines = reprSPNdata(spns, msg)
+                spnlines = reprSPNdata(spns, msg, pgn)
 
             if spnlines is not None:
                 nextline = "\n\t" + '\n\t'.join(spnlines)
@@ -567,26 +587,6 @@ class J1939(cancatlib.CanInterface):
         return "%.8d %8.3f pri/edp/dp: %d/%d/%d, PG: %.2x %.2x  Source: %.2x  Data: %-18s  %s\t\t%s%s" % \
                 (idx, ts, prio, edp, dp, pf, ps, sa, data.encode('hex'), pfmeaning, comment, nextline)
 
-    def _getLocals(self, idx, ts, arbid, data):
-        prio, edp, dp, pf, ps, sa = parseArbid(arbid)
-        pgn = (pf<<8) | ps
-        lcls = {'idx':idx,
-                'ts':ts,
-                'arbid':arbid,
-                'data':data,
-                'priority':prio,
-                'edp':edp,
-                'dp':dp,
-                'pf':pf,
-                'ps':ps,
-                'sa':sa,
-                'pgn':pgn,
-                'da':ps,
-                'ge':ps,
-                }
-
-        return lcls
-
     def _j1939_can_handler(self, message, none):
         '''
         this function is run for *Every* received CAN message... and is executed from the
@@ -985,90 +985,153 @@ class J1939(cancatlib.CanInterface):
 MAX_WORD = 64
 bu_masks = [(2 ** (i)) - 1 for i in range(8*MAX_WORD+1)]
 
-def reprSPNdata(spnlist, msg):
-    spnlines = []
-    # loop through the SPNs listed for this PGN
-    for spnum in spnlist:
-        spn = J1939SPNdb.get(spnum)
-        if spn is None:
-            continue
-
-        # graciously refactored code from TruckDevil (hey LBD!)
-        spnlen = spn.get('SPNLength')
-        pgnlen = spn.get('PGNLength')
-        spnName = spn.get('Name')
-        spnData = ''
-
-        # skip variable-length PGNs for now
-        if (type(pgnlen) == str and 'ariable' in pgnlen):
-            pass
-
+# how an SPN is turned into a value
+SPN_NUMBER =    0   # raw * resolution + offset
+SPN_BIT =       1   # bit field, with J1939BitDecodings meanings
+SPN_BINARY =    2
+SPN_ASCII =     3
+SPN_VARIABLE =  4   # in a variable length PGN: no fixed place, the whole message
+SPN_UNKNOWN =   5   # no usable layout in the db
+
+# compiled SPN decoders:
+#   (spnum, spn, name, units, kind, startbyte, endbyte, shift, mask, scale, offset, bitdecode)
+_spn_decoders = {}
+# pgn -> tuple of the compiled decoders of its SPNs
+_pgn_decoders = {}
+
+def compileSPN(spnum):
+    '''
+    work out once where an SPN lives in its PGN's data and how to scale it.
+    returns the decoder tuple (see decodeSPN()), or None if it isn't in the db
+    '''
+    dec = _spn_decoders.get(spnum)
+    if dec is not None or spnum in _spn_decoders:
+        return dec
+
+    spn = J1939SPNdb.get(spnum)
+    if spn is None:
+        _spn_decoders[spnum] = None
+        return None
+
+    units = spn.get('Units')
+    pgnlen = spn.get('PGNLength')
+    startBit = spn.get('StartBit')
+    endBit = spn.get('EndBit')
+
+    startByte = endByte = shift = mask = 0
+    scale = 1
+    offset = 0
+
+    if type(pgnlen) == str and 'ariable' in pgnlen:
+        kind = SPN_VARIABLE
+
+    elif startBit is None or endBit is None or startBit < 0 or endBit < startBit:
+        kind = SPN_UNKNOWN
+
+    else:
+        # bit 0 is the LSB of the first byte, multi-byte values are little endian
+        startByte = startBit // 8
+        endByte = endBit // 8 + 1
+        shift = startBit % 8
+        mask = bu_masks[min(endBit - startBit + 1, 8*MAX_WORD)]
+
+        if units == 'ASCII':
+            kind = SPN_ASCII
+        elif units == 'bit':
+            kind = SPN_BIT
+        elif units == 'binary':
+            kind = SPN_BINARY
         else:
-            startBit = spn.get('StartBit')
-            endBit = spn.get('EndBit')
-
-            startByte = startBit // 8
-            startBitO = startBit % 8
-            endByte = (endBit + 7) // 8
-            endBitO = endBit % 8
-
-            datablob = msg[startByte:endByte]
-            #print("sb: %d\t eb: %d\t sB:%d\t SBO:%d\t eB:%d\t eBO:%d\t %r" % (startBit, endBit, startByte, startBitO, endByte, endBitO, datablob))
-
-            units = spn.get("Units")
-            if units == 'ASCII':
-                spnData = repr(datablob)
-
-            else:
-                try:
-                    # carve out the number
-                    datanum = 0
-                    numbytes = struct.unpack('%dB' % len(datablob), datablob)
-                    for n in numbytes:
-                        datanum <<= 8
-                        datanum |= n
-
-                    datanum >>= (7 - endBitO)
-                    #print("datanum: %x" % datanum)
-                    mask = bu_masks[endBit - startBit + 1]
-                    datanum &= mask
-                    #print("datanum: %x (mask: %x)" % (datanum, mask))
-
-                    if units == 'bit':
-                        meaning = ''
-                        bitdecode = J1939BitDecodings.get(spnum)
-                        if bitdecode is not None:
-                            meaning = bitdecode.get(datanum)
-
-                        spnData = '0x%x (%s)' % (datanum, meaning)
-
-                    elif units == 'binary':
-                        spnData = bin(datanum)
-
-                    else:
-                        # some other unit with a resolution
-                        datanum = 0
-                        numbytes = struct.unpack('%dB' % len(datablob), datablob)
-                        for n in numbytes:
-                            datanum <<= 8
-                            datanum |= n
-
-                        datanum >> (7 - endBitO)
-
-                        resolution = spn.get('Resolution')
-                        if resolution is not None:
-                            datanum *= resolution
-
-                        offset = spn.get('Offset')
-                        if offset is not None:
-                            datanum + offset
-
-                        spnData = '%.3f %s' % (datanum, units)
-                except Exception as e:
-                    spnData = "ERROR"
-                    print("SPN: %r %r (%r)" % (e, msg, spn))
-
-        spnlines.append('      SPN(%d): %-20s\t %s' % (spnum, spnData, spnName))
+            kind = SPN_NUMBER
+            scale = spn.get('Resolution') or 1
+            offset = spn.get('Offset') or 0
+
+    dec = (spnum, spn, spn.get('Name'), units, kind, startByte, endByte, shift, mask, scale, offset,
+           J1939BitDecodings.get(spnum))
+    _spn_decoders[spnum] = dec
+    return dec
+
+def getPGNDecoder(pgn, spnlist=None):
+    '''
+    the compiled decoders for a PGN's SPNs, built the first time it's seen.
+    spnlist overrides the PGN's SPN list from J1939PGNdb (but is still
+    cached by pgn)
+    '''
+    decs = _pgn_decoders.get(pgn)
+    if decs is None:
+        if spnlist is None:
+            spnlist = J1939PGNdb.get(pgn, {}).get('SPNs') or ()
+        decs = tuple(dec for dec in (compileSPN(spnum) for spnum in spnlist) if dec is not None)
+        _pgn_decoders[pgn] = decs
+    return decs
+
+def decodeSPN(dec, msg):
+    '''
+    returns (value, repr) of one SPN out of a PGN's data, given its decoder.
+    value is the engineering value (scaled number, bit field, or bytes)
+    '''
+    spnum, spn, name, units, kind, startByte, endByte, shift, mask, scale, offset, bitdecode = dec
+
+    if kind == SPN_NUMBER or kind == SPN_BIT or kind == SPN_BINARY:
+        blob = msg[startByte:endByte]
+        if len(blob) < endByte - startByte:
+            return None, 'N/A (short)'
+
+        raw = (int.from_bytes(blob, 'little') >> shift) & mask
+        if kind == SPN_NUMBER:
+            value = raw * scale + offset
+            return value, '%.3f %s' % (value, units)
+
+        if kind == SPN_BIT:
+            meaning = ''
+            if bitdecode is not None:
+                meaning = bitdecode.get(raw)
+            return raw, '0x%x (%s)' % (raw, meaning)
+
+        return raw, '%s (%x)' % (bin(raw), raw)
+
+    if kind == SPN_ASCII:
+        blob = msg[startByte:endByte]
+        return blob, repr(blob)
+
+    if kind == SPN_VARIABLE:
+        if units == 'ASCII':
+            return msg, repr(msg)
+        return msg, hexlify(msg).decode()
+
+    return None, ''
+
+def decodePGN(pgn, msg, spnlist=None):
+    '''
+    decode every SPN of a PGN's data.
+    returns [(spnum, spn dict, units, value, repr), ...]
+    '''
+    out = []
+    for dec in getPGNDecoder(pgn, spnlist):
+        value, vrepr = decodeSPN(dec, msg)
+        out.append((dec[0], dec[1], dec[3], value, vrepr))
+    return out
+
+def getSPNValues(pgn, msg):
+    '''
+    returns {spnum: engineering value} for a PGN's data
+    '''
+    return dict((dec[0], decodeSPN(dec, msg)[0]) for dec in getPGNDecoder(pgn))
+
+def reprSPNdata(spnlist, msg, pgn=None):
+    '''
+    one line per SPN of msg.  with pgn, the PGN's cached decoders are used
+    instead of looking up every SPN in spnlist
+    '''
+    if pgn is not None:
+        decs = getPGNDecoder(pgn, spnlist)
+    else:
+        decs = [dec for dec in (compileSPN(spnum) for spnum in spnlist) if dec is not None]
+
+    spnlines = []
+    for dec in decs:
+        value, spnData = decodeSPN(dec, msg)
+        spnlines.append('      SPN(%d): %-20s\t %s' % (dec[0], spnData, dec[2]))
 
     return spnlines
 
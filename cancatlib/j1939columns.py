@@ -0,0 +1,223 @@
+'''
+Bulk J1939 SPN decoding, a whole capture at a time.
+
+decodeSPNColumns() takes a run of J1939 messages ((ts, arbtup, data), like
+the J1939MSGS mailbox), groups them by PGN and pulls each requested SPN out
+of every payload of the PGNs that carry it.  Each SPN comes back as a time
+series in columns:
+
+    {spnum: {'ts': timestamps, 'sa': source addresses, 'value': values}}
+
+The SPN layouts are the compiled ones parsePGNData() uses (see
+j1939.compileSPN()).  With NumPy installed, the payloads of a PGN are
+stacked into one uint8 matrix and each numeric or bit field SPN is a few
+shift/mask operations over its byte columns, so millions of messages decode
+in seconds.  Without it (or use_numpy=False) the same columns are built a
+message at a time with j1939.decodeSPN(), as arrays instead of ndarrays.
+
+Numeric and bit field values are floats (scaled and offset, raw bit field
+values as is), NaN where a message is too short to hold the SPN.  ASCII and
+variable length SPNs come back as a list of bytes.
+'''
+from array import array
+
+from cancatlib.j1939 import compileSPN, decodeSPN, SPN_NUMBER, SPN_BIT, SPN_BINARY
+from cancatlib.j1939tables import J1939PGNdb
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NAN = float('nan')
+NUMERIC_KINDS = (SPN_NUMBER, SPN_BIT, SPN_BINARY)
+
+# spnum -> [pgn, ...], built the first time it's needed
+_spn_pgns = None
+
+
+def getSPNPGNs(spnum):
+    '''
+    the PGNs an SPN is carried in
+    '''
+    global _spn_pgns
+    if _spn_pgns is None:
+        index = {}
+        for pgn, pgndata in J1939PGNdb.items():
+            for spn in pgndata.get('SPNs') or ():
+                index.setdefault(spn, []).append(pgn)
+        _spn_pgns = index
+
+    return _spn_pgns.get(spnum, [])
+
+
+def arbtupPGN(arbtup):
+    '''
+    the PGN of a message, including the data page bit (like J1939PGNdb)
+    '''
+    arbid, prio, edp, dp, pf, ps, sa = arbtup
+    if pf < 0xf0:
+        return (dp << 16) | (pf << 8)
+    return (dp << 16) | (pf << 8) | ps
+
+
+def _groupByPGN(messages, pgns, startts):
+    '''
+    one pass over the messages: {pgn: (ts, sa, [data, ...])} for the wanted PGNs
+    '''
+    groups = dict((pgn, (array('d'), array('B'), [])) for pgn in pgns)
+
+    # arbtups repeat, so remember which group each one goes to
+    targets = {}
+    for ts, arbtup, data in messages:
+        group = targets.get(arbtup, False)
+        if group is False:
+            group = targets[arbtup] = groups.get(arbtupPGN(arbtup))
+        if group is None:
+            continue
+
+        group[0].append(ts - startts)
+        group[1].append(arbtup[6])
+        group[2].append(data)
+
+    return groups
+
+
+def _decodeGroupPython(decs, datas):
+    values = []
+    for dec in decs:
+        if dec[4] in NUMERIC_KINDS:
+            column = array('d')
+            for data in datas:
+                value, srepr = decodeSPN(dec, data)
+                column.append(NAN if value is None else value)
+        else:
+            column = [decodeSPN(dec, data)[0] for data in datas]
+        values.append(column)
+    return values
+
+
+def _payloadMatrix(datas, width):
+    '''
+    the first width bytes of every payload as an (n, width) uint8 matrix,
+    and the length of each payload
+    '''
+    lens = numpy.fromiter(map(len, datas), dtype=numpy.intp, count=len(datas))
+    if len(datas) and (lens == lens[0]).all() and lens[0] >= width:
+        # the usual case: every message of a PGN is the same size
+        mat = numpy.frombuffer(b''.join(datas), dtype=numpy.uint8).reshape(len(datas), int(lens[0]))
+        return mat[:, :width], lens
+
+    buf = b''.join(data[:width].ljust(width, b'\0') for data in datas)
+    return numpy.frombuffer(buf, dtype=numpy.uint8).reshape(len(datas), width), lens
+
+
+def _decodeGroupNumpy(decs, datas):
+    # SPNs wider than a uint64 (or not numbers) go the slow way
+    fast = [dec[4] in NUMERIC_KINDS and dec[6] - dec[5] <= 8 for dec in decs]
+    width = max([dec[6] for dec, isfast in zip(decs, fast) if isfast] or [0])
+    mat, lens = _payloadMatrix(datas, width)
+
+    values = []
+    for dec, isfast in zip(decs, fast):
+        if not isfast:
+            values.append(_decodeGroupPython([dec], datas)[0])
+            continue
+
+        spnum, spn, name, units, kind, startByte, endByte, shift, mask, scale, offset, bitdecode = dec
+        raw = numpy.zeros(len(datas), dtype=numpy.uint64)
+        for x in range(endByte - startByte):
+            raw |= mat[:, startByte + x].astype(numpy.uint64) << numpy.uint64(8 * x)
+        raw = (raw >> numpy.uint64(shift)) & numpy.uint64(mask)
+
+        value = raw.astype(numpy.float64)
+        if kind == SPN_NUMBER:
+            value = value * scale + offset
+        value[lens < endByte] = NAN
+        values.append(value)
+
+    return values
+
+
+def _concat(columns, use_numpy):
+    if len(columns) == 1:
+        return columns[0]
+    if use_numpy and not isinstance(columns[0], list):
+        return numpy.concatenate([numpy.asarray(col) for col in columns])
+
+    out = columns[0][:0]
+    for col in columns:
+        out += col
+    return out
+
+
+def decodeSPNColumns(messages, spns, startts=0, use_numpy=True):
+    '''
+    decode SPNs out of an iterable of J1939 messages (ts, arbtup, data).
+    returns {spnum: {'ts': ..., 'sa': ..., 'value': ...}} (see module doc),
+    timestamps relative to startts.  SPNs that aren't in the db are left out
+    '''
+    use_numpy = use_numpy and numpy is not None
+
+    # which SPNs to pull out of which PGNs
+    wanted = {}
+    for spnum in spns:
+        dec = compileSPN(spnum)
+        if dec is None:
+            continue
+        for pgn in getSPNPGNs(spnum):
+            wanted.setdefault(pgn, []).append(dec)
+
+    groups = _groupByPGN(messages, wanted, startts)
+
+    parts = dict((spnum, []) for spnum in spns if compileSPN(spnum) is not None)
+    for pgn, decs in wanted.items():
+        ts, sas, datas = groups[pgn]
+        if not len(datas):
+            continue
+
+        if use_numpy:
+            values = _decodeGroupNumpy(decs, datas)
+            ts = numpy.frombuffer(ts, dtype=numpy.float64)
+            sas = numpy.frombuffer(sas, dtype=numpy.uint8)
+        else:
+            values = _decodeGroupPython(decs, datas)
+
+        for dec, value in zip(decs, values):
+            parts[dec[0]].append((ts, sas, value))
+
+    out = {}
+    for spnum, runs in parts.items():
+        if not runs:
+            if use_numpy:
+                out[spnum] = {'ts': numpy.empty(0), 'sa': numpy.empty(0, dtype=numpy.uint8), 'value': numpy.empty(0)}
+            else:
+                out[spnum] = {'ts': array('d'), 'sa': array('B'), 'value': array('d')}
+            continue
+
+        ts = _concat([run[0] for run in runs], use_numpy)
+        sas = _concat([run[1] for run in runs], use_numpy)
+        values = _concat([run[2] for run in runs], use_numpy)
+
+        if len(runs) > 1:
+            # carried in more than one PGN: back into time order
+            if use_numpy:
+                order = numpy.argsort(ts, kind='stable')
+                ts = ts[order]
+                sas = sas[order]
+                if isinstance(values, list):
+                    values = [values[x] for x in order]
+                else:
+                    values = values[order]
+            else:
+                order = sorted(range(len(ts)), key=ts.__getitem__)
+                ts = array('d', (ts[x] for x in order))
+                sas = array('B', (sas[x] for x in order))
+                if isinstance(values, list):
+                    values = [values[x] for x in order]
+                else:
+                    values = array('d', (values[x] for x in order))
+
+        out[spnum] = {'ts': ts, 'sa': sas, 'value': values}
+
+    return out
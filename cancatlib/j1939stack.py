@@ -1,11 +1,16 @@
+import heapq
 import traceback
+from array import array
+from bisect import bisect_left
 from binascii import hexlify
 from operator import itemgetter
+from functools import lru_cache
 
 import cancatlib
 import struct
-from cancatlib.j1939 import emitArbid
-from cancatlib.J1939db import *
+from cancatlib.j1939 import emitArbid, getPGNDecoder, decodeSPN
+from cancatlib.j1939tables import *
+from cancatlib import j1939columns
 from cancatlib import *
 from cancatlib.vstruct.bitfield import *
 
@@ -41,6 +46,20 @@ TP_BAM = 20
 TP_DIRECT = 10
 TP_DIRECT_BROKEN=9
 
+# TP.CM connection abort reasons
+TP_ABORT_BUSY =         1
+TP_ABORT_RESOURCES =    2
+TP_ABORT_TIMEOUT =      3
+TP_ABORT_CTS_IN_DT =    4
+TP_ABORT_RETRANSMITS =  5
+TP_ABORT_UNEXPECTED =   6
+TP_ABORT_BAD_SEQUENCE = 7
+
+# transport protocol timing (J1939-21), in seconds
+TP_T3 = 1.25            # sender: waiting for CTS/EOM after RTS or the last packet sent
+TP_T4 = 1.05            # sender: waiting for the next CTS after a hold (CTS for 0 packets)
+TP_BAM_INTERVAL = .05   # between BAM packets, the spec allows 50-200ms
+
 class NAME(VBitField):
     def __init__(self):
         VBitField.__init__(self)
@@ -66,11 +85,16 @@ def parseName(name):
     namebits.vsParse(rname)
     return namebits
 
+# real buses only have a few hundred arbids, so the per-frame work of
+# splitting them apart is cached
+ARBID_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=ARBID_CACHE_SIZE)
 def parseArbid(arbid):
-    (prioPlus,
-        pf,
-        ps,
-        sa) = struct.unpack(b'BBBB', struct.pack(b">I", arbid))
+    prioPlus = (arbid >> 24) & 0xff
+    pf = (arbid >> 16) & 0xff
+    ps = (arbid >> 8) & 0xff
+    sa = arbid & 0xff
 
     prio = prioPlus >> 2
     edp = (prioPlus >> 1) & 1
@@ -79,16 +103,18 @@ def parseArbid(arbid):
     return arbid, prio, edp, dp, pf, ps, sa
 
 
-def getArbtupInfo(arbtup):
+# getArbtupInfo() keys
+ARBTUP_INFO_KEYS = ('arbid', 'pri', 'priority', 'edp', 'dp', 'pf', 'ps', 'sa', 'pg', 'pgn', 'da', 'ge')
+
+@lru_cache(maxsize=ARBID_CACHE_SIZE)
+def _arbtupInfo(arbtup):
     '''
-    Return a dictionary of values that can be sorted on based on the arbtup
+    getArbtupInfo() values as a tuple, in ARBTUP_INFO_KEYS order
     '''
     arbid, prio, edp, dp, pf, ps, sa = arbtup
     if (arbid is not None and arbid <= 0x7FF) or (dp and edp):
         # First check if this message is a J1939 message or not
-        return {'arbid': arbid, 'pri': None, 'priority': None, 'edp': None,
-                'dp': None, 'pf': None, 'ps': None, 'sa': None, 'pg': None,
-                'pgn': None, 'da': None, 'ge': None}
+        return (arbid, None, None, None, None, None, None, None, None, None, None, None)
 
     if pf < 240:
         # If the PDU Format is 0-239 then the PGN is only the PF field
@@ -97,7 +123,6 @@ def getArbtupInfo(arbtup):
         # In this format there is no group extension value, and the PS field is
         # the destination address
         ge = None
-        da = ps
     else:
         # If the PDU Format is 240+ then the PGN is the PF and PS fields
         pgn = (pf << 8) | ps
@@ -107,11 +132,15 @@ def getArbtupInfo(arbtup):
         # messages may choose to use the GE as the DA. So for that purpose the
         # DA is still set to PS here.
         ge = ps
-        da = ps
 
-    return {'arbid': arbid, 'pri': prio, 'priority': prio, 'edp': edp, 'dp': dp,
-            'pf': pf, 'ps': ps, 'sa': sa, 'pg': pgn, 'pgn': pgn, 'da': ps,
-            'ge': ge}
+    return (arbid, prio, prio, edp, dp, pf, ps, sa, pgn, pgn, ps, ge)
+
+
+def getArbtupInfo(arbtup):
+    '''
+    Return a dictionary of values that can be sorted on based on the arbtup
+    '''
+    return dict(zip(ARBTUP_INFO_KEYS, _arbtupInfo(arbtup)))
 
 
 def arbinfo_list_getter(*items):
@@ -119,10 +148,18 @@ def arbinfo_list_getter(*items):
     Provide operator.attrgetter-type function that can return the elected keys
     from an arbtup value
     '''
+    fields = tuple(ARBTUP_INFO_KEYS.index(i) for i in items)
+    # the same arbtups come up over and over, work out each one's key once
+    keys = {}
+
     def g(obj):
         # The arbtup is the second item
-        data = getArbtupInfo(obj[1])
-        return tuple(data[i] for i in items if data[i] is not None)
+        arbtup = obj[1]
+        key = keys.get(arbtup)
+        if key is None:
+            info = _arbtupInfo(arbtup)
+            key = keys[arbtup] = tuple(info[i] for i in fields if info[i] is not None)
+        return key
     return g
 
 
@@ -189,6 +226,24 @@ pgn_pfs = {
 
 class J1939Interface(cancatlib.CanInterface):
     _msg_source_idx = J1939MSGS
+    # advfilter names: here "arbid" is the arbtup (arbid, prio, edp, dp, pf, ps, sa).
+    # _j1939_filters also get the names _submitJ1939Message has always offered.
+    _advfilter_fields = {'priority':  'arbid[1]',
+                         'prio':      'arbid[1]',
+                         'edp':       'arbid[2]',
+                         'dp':        'arbid[3]',
+                         'pf':        'arbid[4]',
+                         'ps':        'arbid[5]',
+                         'sa':        'arbid[6]',
+                         'pgn':       '(arbid[4] << 8) | arbid[5]',
+                         'da':        'arbid[5]',
+                         'ge':        'arbid[5]',
+                         'datarange': '(arbid[2] << 1) | arbid[3]',
+                         'arbtup':    'arbid',
+                         'message':   'data',
+                         'timestamp': 'ts',
+                         }
+
     def __init__(self, port=None, baud=cancatlib.baud, verbose=False, cmdhandlers=None, comment='', load_filename=None, orig_iface=None, process_can_msgs=True, promisc=True):
 
         cancatlib.CanInterface.__init__(self, port=port, baud=baud, verbose=verbose, cmdhandlers=cmdhandlers, comment=comment, load_filename=load_filename, orig_iface=orig_iface)
@@ -197,9 +252,16 @@ class J1939Interface(cancatlib.CanInterface):
         self._last_recv_idx = -1
         self._threads = []
         self._j1939_filters = []
-        self._j1939_msg_events = {}
+        self._j1939_filters_compiled = ((), None)
         self._j1939queuelock = threading.Lock()
+        # J1939recv*: pf -> indexes of J1939MSGS messages, and waiting
+        # Conditions (on _j1939queuelock) by pf, or None for any pf
+        self._j1939_pf_index = (None, 0, {})
+        self._j1939_waiters = {}
         self._TPmsgParts = {}
+        # our RTS/CTS transfers in progress: (sa, da) -> queue of TP.CM replies
+        self._tp_tx_sessions = {}
+        self.tp_bam_interval = TP_BAM_INTERVAL
         self.maxMsgsPerPGN = 0x200
         self._j1939_msg_listeners = []
         self.promisc = promisc
@@ -238,40 +300,123 @@ class J1939Interface(cancatlib.CanInterface):
             self._config['myIDs'].remove(curid)
 
     def J1939xmit(self, pf, ps, sa, data, prio=6, edp=0, dp=0):
+        '''
+        send a J1939 message.  more than 8 bytes goes out with the transport
+        protocol (see _j1939xmit_tp).  returns whether it made it: for a
+        single frame, that the transceiver sent it
+        '''
         if len(data) <= 8:
             arbid = emitArbid(prio, edp, dp, pf, ps, sa)
             # print("TX: %x : %s" % (arbid, hexlify(data).decode()))
-            self.CANxmit(arbid, data, extflag=1)
-            return
+            return self.CANxmit(arbid, data, extflag=1) == cancatlib.CAN_RESP_OK
 
-        self._j1939xmit_tp(pf, ps, sa, data, prio, edp, dp)
+        return self._j1939xmit_tp(pf, ps, sa, data, prio, edp, dp)
 
     def _j1939xmit_tp(self, pf, ps, sa, message, prio=6, edp=0, dp=0):
-        pgn2 = (edp << 1) | dp
-        pgn1 = pf
-        if pgn1 < 240:
-            pgn0 = 0
+        '''
+        send a message of up to 1785 bytes with the J1939 transport protocol:
+        BAM for global destinations (PDU2 or DA 0xff), RTS/CTS otherwise.
+        returns True once it's all been sent (and, for RTS/CTS, acknowledged
+        with EOM), False if the transfer was aborted or timed out, or a BAM
+        packet couldn't be sent
+        '''
+        # PGN as it goes in TP.CM: LSB first
+        if pf < 240:
+            pgnbytes = (0, pf, (edp << 1) | dp)
+            da = ps
         else:
-            pgn0 = ps
+            pgnbytes = (ps, pf, (edp << 1) | dp)
+            da = 0xff
 
-        msgs = [b'%c'%(x+1) + message[x*7:(x*7)+7] for x in range((len(message)+6)//7)]
-        if len(msgs) > 255:
+        pkts = [struct.pack('B', x+1) + message[x*7:(x*7)+7].ljust(7, b'\xff') for x in range((len(message)+6)//7)]
+        if len(pkts) > 255:
             raise Exception("J1939xmit_tp: attempt to send message that's too large")
 
-        cm_msg = struct.pack('<BHBBBBB', CM_RTS, len(message), len(msgs), 0xff,
-                pgn2, pgn1, pgn0)
+        if da == 0xff:
+            return self._tpSendBAM(pkts, len(message), pgnbytes, sa, prio, edp, dp)
+
+        return self._tpSendRTS(pkts, len(message), pgnbytes, da, sa, prio, edp, dp)
+
+    def _tpSendBAM(self, pkts, totsize, pgnbytes, sa, prio, edp, dp):
+        cm_msg = struct.pack('<BHBBBBB', CM_BAM, totsize, len(pkts), 0xff, *pgnbytes)
+        if self.CANxmit(emitArbid(prio, edp, dp, PF_TP_CM, 0xff, sa), cm_msg, extflag=1) != cancatlib.CAN_RESP_OK:
+            return False
+
+        # paced from when each packet was due, not when the last one went out
+        dtarbid = emitArbid(prio, edp, dp, PF_TP_DT, 0xff, sa)
+        due = time.time()
+        for pkt in pkts:
+            due += self.tp_bam_interval
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            # nobody can ask for a missed one again, so there's no point going on
+            if self._j1939xmitBurst(dtarbid, [pkt]):
+                return False
+
+        return True
+
+    def _tpSendRTS(self, pkts, totsize, pgnbytes, da, sa, prio, edp, dp):
+        key = (sa, da)
+        if key in self._tp_tx_sessions:
+            raise Exception("J1939xmit_tp: already sending from 0x%x to 0x%x" % (sa, da))
+
+        replies = queue.Queue()
+        self._tp_tx_sessions[key] = replies
+        try:
+            cmarbid = emitArbid(prio, edp, dp, PF_TP_CM, da, sa)
+            dtarbid = emitArbid(prio, edp, dp, PF_TP_DT, da, sa)
+            cm_msg = struct.pack('<BHBBBBB', CM_RTS, totsize, len(pkts), 0xff, *pgnbytes)
+            self.CANxmit(cmarbid, cm_msg, extflag=1)
 
-        arbid = emitArbid(prio, edp, dp, PF_TP_CM, ps, sa)
-        # print("TXe: %x : %s" % (arbid, hexlify(cm_msg).decode()))
-        self.CANxmit(arbid, cm_msg, extflag=1)
-        time.sleep(.01)  # hack: should watch for CM_CTS
-        for msg in msgs:
-            #self.J1939xmit(PF_TP_DT, ps, sa, msg, prio=prio)
-            arbid = emitArbid(prio, edp, dp, PF_TP_DT, ps, sa)
-            print("TXe: %x : %s" % (arbid, hexlify(msg).decode()))
-            self.CANxmit(arbid, msg, extflag=1)
+            timeout = TP_T3
+            while True:
+                try:
+                    data = replies.get(timeout=timeout)
+                except queue.Empty:
+                    self.log("J1939xmit_tp: timed out waiting for 0x%x, aborting" % da, 1)
+                    self._tpAbort(cmarbid, TP_ABORT_TIMEOUT, pgnbytes)
+                    return False
+
+                cb = data[0]
+                if cb == CM_ABORT:
+                    self.log("J1939xmit_tp: 0x%x aborted the transfer (reason %d)" % (da, data[1]), 1)
+                    return False
+
+                if cb == CM_EOM:
+                    return True
+
+                # CTS: how many packets, starting where
+                maxpkts, nextpkt = data[1], data[2]
+                if maxpkts == 0:
+                    # hold the connection open
+                    timeout = TP_T4
+                    continue
+
+                if nextpkt < 1 or nextpkt > len(pkts):
+                    self.log("J1939xmit_tp: 0x%x asked for packet %d of %d, aborting" % (da, nextpkt, len(pkts)), 1)
+                    self._tpAbort(cmarbid, TP_ABORT_BAD_SEQUENCE, pgnbytes)
+                    return False
+
+                self._j1939xmitBurst(dtarbid, pkts[nextpkt-1:nextpkt-1+maxpkts])
+                timeout = TP_T3
 
-        # hack: should watch for CM_EOM
+        finally:
+            del self._tp_tx_sessions[key]
+
+    def _tpAbort(self, cmarbid, reason, pgnbytes):
+        self.CANxmit(cmarbid, struct.pack('<BBBBBBBB', CM_ABORT, reason, 0xff, 0xff, 0xff, *pgnbytes), extflag=1)
+
+    def _j1939xmitBurst(self, arbid, msgs, timeout=3):
+        '''
+        send several frames with one arbid in one go (batched or pipelined at
+        the transceiver, see CANxmitBatch()).  returns how many failed
+        '''
+        results = self.CANxmitBatch([(arbid, msg) for msg in msgs], extflag=1, timeout=timeout)
+        failed = len(results) - results.count(cancatlib.CAN_RESP_OK)
+        if failed:
+            self.log("J1939xmit: %d of %d frames failed" % (failed, len(msgs)), 1)
+        return failed
 
     def _sortArbitrationIds(self, arbid_list, reverse=True, sort=None):
         if sort is None:
@@ -289,7 +434,7 @@ class J1939Interface(cancatlib.CanInterface):
             return sorted(arbid_list, key=itemgetter(0), reverse=reverse)
 
     def _reprSessionStatsHeader(self):
-        return '  Arb ID  (pri/edp/dp PG  SA)    Msg Count    Timing (mean/median/high/low)'
+        return '  Arb ID  (pri/edp/dp PG  SA)    Msg Count    Timing (mean/median/high/low/stddev/jitter)'
 
     def _reprArbid(self, arbtup):
         arbid, prio, edp, dp, pf, ps, sa = arbtup
@@ -366,7 +511,8 @@ class J1939Interface(cancatlib.CanInterface):
         _, prio, edp, dp, pf, ps, sa = arbtup
 
         # if i don't care about this message... bail. (0xef+ is multicast)
-        if pf < 0xef and ps not in self._config['myIDs'] and not self.promisc:
+        if pf < 0xef and ps not in self._config['myIDs'] and not self.promisc \
+                and (ps, sa) not in self._tp_tx_sessions:
             return
 
         if pf == 0xeb:
@@ -418,19 +564,21 @@ class J1939Interface(cancatlib.CanInterface):
         if timestamp is None:
             timestamp = time.time()
 
-        _, prio, edp, dp, pf, ps, sa = arbtup
-        pgn = (pf<<8) | ps
-        datarange = (edp<<1) | dp
-
         if len(self._j1939_filters):
-            lcls = locals()
-            for advf in self._j1939_filters:
-                try:
-                    if not eval(advf, lcls):
-                        return
-                except Exception as e:
-                    print("_submitJ1939Message advfilter ERROR: %r" % e)
+            try:
+                # _j1939_filters is a plain list people poke at, so only
+                # recompile when it has changed
+                filters = tuple(self._j1939_filters)
+                compiled, advfilter = self._j1939_filters_compiled
+                if filters != compiled:
+                    advfilter = self._compileAdvFilters(filters)
+                    self._j1939_filters_compiled = (filters, advfilter)
+
+                if not advfilter(None, timestamp, arbtup, message):
                     return
+            except Exception as e:
+                print("_submitJ1939Message advfilter ERROR: %r" % e)
+                return
 
         self._j1939queuelock.acquire()
         try:
@@ -474,14 +622,16 @@ class J1939Interface(cancatlib.CanInterface):
                 mbox = []
                 self._messages[J1939MSGS] = mbox
 
-            msgevt = self._j1939_msg_events.get(J1939MSGS)
-            if msgevt is None:
-                msgevt = threading.Event()
-                self._j1939_msg_events[J1939MSGS] = msgevt
-
             #mbox.append((pf, ps, sa, edp, dp, prio, timestamp, message))
             mbox.append((timestamp, arbtup, message))
-            msgevt.set()
+            self._notifyMsgs(J1939MSGS)
+
+            self._indexJ1939Msgs(mbox)
+            if self._j1939_waiters:
+                for cond in self._j1939_waiters.get(arbtup[4], ()):
+                    cond.notify()
+                for cond in self._j1939_waiters.get(None, ()):
+                    cond.notify()
             ##self._j1939_msg_events[pf].set()
             # note: this event will trigger for any of the data ranges, as long as the PF is correct... this may be a problem.
             # FIXME: come back to this...
@@ -624,6 +774,13 @@ class J1939Interface(cancatlib.CanInterface):
         cb = data[0]
         #print("ec: %.2x%.2x %.2x" % (arbtup[3], arbtup[4], cb))
 
+        if cb in (CM_CTS, CM_EOM, CM_ABORT):
+            # replies to one of our own transfers go to its sender
+            replies = j1939._tp_tx_sessions.get((arbtup[5], arbtup[6]))
+            if replies is not None:
+                replies.put(data)
+                return
+
         htup = tp_cm_handlers.get(cb)
         if htup is not None:
             subname, cb_handler = htup
@@ -764,26 +921,6 @@ class J1939Interface(cancatlib.CanInterface):
         arbtup = None, prio, edp, dp, pf, ps, sa
         self._submitJ1939Message(arbtup, msg)
 
-    def _getLocals(self, idx, ts, arbtup, data):
-        #print("getLocals:",idx, ts, arbtup, data)
-        _, prio, edp, dp, pf, ps, sa = arbtup
-        pgn = (pf << 8) | ps
-        lcls = {'idx': idx,
-                'ts': ts,
-                'data': data,
-                'priority': prio,
-                'edp': edp,
-                'dp': dp,
-                'pf': pf,
-                'ps': ps,
-                'sa': sa,
-                'pgn': pgn,
-                'da': ps,
-                'ge': ps,
-                }
-
-        return lcls
-
     def genCanMsgs(self, start=0, stop=None, arbids=None, tail=False, maxsecs=None):
         '''
         CAN message generator.  takes in start/stop indexes as well as a list
@@ -834,9 +971,8 @@ class J1939Interface(cancatlib.CanInterface):
 
                 if stop == msgqlen:
                     self.log("waiting for messages", 3)
-                    # wait for trigger event so we're not constantly polling
-                    self._msg_events[self._msg_source_idx].wait(1)
-                    self._msg_events[self._msg_source_idx].clear()
+                    # wait for new messages so we're not constantly polling
+                    self._waitForMsgs(self._msg_source_idx, msgqlen, 1)
                     self.log("received 'new messages' event trigger", 3)
 
                 # we've gained some messages since last check...
@@ -860,106 +996,162 @@ class J1939Interface(cancatlib.CanInterface):
             yield((idx, ts, arbtup, data))
             idx += 1
 
+    def getSPNColumns(self, spns, start=0, stop=None, use_numpy=True):
+        '''
+        decode a list of SPNs out of messages start through stop (inclusive,
+        like genCanMsgs) as time series:
+            {spnum: {'ts': timestamps, 'sa': source addresses, 'value': values}}
+        timestamps are from the start of the session.  see
+        cancatlib.j1939columns, which uses NumPy if it's installed
+        '''
+        messages = self.getCanMsgQueue()
+        if messages is None or not len(messages):
+            return j1939columns.decodeSPNColumns((), spns, use_numpy=use_numpy)
 
-    def J1939recv(self, pf, ps, sa, msgcount=1, timeout=1, start_msg=None, update_last_recv=True):
-        out = []
+        if stop is None:
+            stop = len(messages)
+        else:
+            stop += 1
 
-        if start_msg is None:
-            start_msg = self._last_recv_idx
+        return j1939columns.decodeSPNColumns(messages[start:stop], spns, messages[0][0], use_numpy)
 
-        #for msg in self.filterCanMsgs(start_msg=start_msg, advfilters=advfilters, tail=True, maxsecs=timeout):
-            #(idx, ts, arbid, data) = msg
-            #out.append(msg)
-            #self._last_recv_idx = msg[0]
-        # FIXME: add in the wait/set interaction for lower perf impact.
-        startts = time.time()
-        cur = start_msg
-        mque = self._messages[J1939MSGS]
-        while time.time() < (startts + timeout):
-            if cur >= len(mque):
-                time.sleep(.001)
-                continue
 
-            ts, arbtup, msg = mque[cur]
-            cur += 1
+    def _indexJ1939Msgs(self, mque):
+        '''
+        bring the pf -> message index map up to date with the J1939MSGS
+        mailbox and return it.  must hold _j1939queuelock
+        '''
+        indexed, count, index = self._j1939_pf_index
+        if indexed is not mque or len(mque) < count:
+            # new or cleared mailbox
+            count = 0
+            index = {}
+
+        for idx in range(count, len(mque)):
+            pf = mque[idx][1][4]
+            idxs = index.get(pf)
+            if idxs is None:
+                idxs = index[pf] = array('Q')
+            idxs.append(idx)
+
+        self._j1939_pf_index = (mque, len(mque), index)
+        return index
+
+    def _j1939Candidates(self, index, pfs, start, stop):
+        '''
+        indexes from start up to stop of the messages with a pf in pfs (None: all)
+        '''
+        if pfs is None:
+            return range(start, stop)
 
-            # we have a message now, does the PGN match?
-            _, mprio, medp, mdp, mpf, mps, msa = arbtup
-            if mpf != pf or mps != ps or msa != sa:
-                continue
+        runs = []
+        for pf in pfs:
+            idxs = index.get(pf)
+            if idxs is not None:
+                runs.append(idxs[bisect_left(idxs, start):bisect_left(idxs, stop)])
 
-            # it's passed the checks... add it to the queue
-            out.append((ts, arbtup, msg))
+        if len(runs) == 1:
+            return runs[0]
+        return heapq.merge(*runs)
 
-            if len(out) >= msgcount:
-                break
+    def _j1939WaitRecv(self, pfs, match, msgcount, timeout, start_msg, update_last_recv):
+        '''
+        collect up to msgcount messages (from start_msg on) that match(arbtup),
+        waiting up to timeout seconds for them to arrive.  only messages with
+        a pf in pfs (None: any) are looked at, straight from the pf index, and
+        only their arrival wakes us up
+        '''
+        out = []
+
+        if start_msg is None:
+            start_msg = self._last_recv_idx
 
+        deadline = time.time() + timeout
+        cur = max(start_msg, 0)
+        cond = threading.Condition(self._j1939queuelock)
+
+        with self._j1939queuelock:
+            for pf in (pfs if pfs is not None else (None,)):
+                self._j1939_waiters.setdefault(pf, set()).add(cond)
+
+            try:
+                while True:
+                    mque = self._messages.get(J1939MSGS)
+                    if mque is not None:
+                        index = self._indexJ1939Msgs(mque)
+                        stop = len(mque)
+                        for idx in self._j1939Candidates(index, pfs, cur, stop):
+                            ts, arbtup, msg = mque[idx]
+                            if not match(arbtup):
+                                continue
+
+                            # it's passed the checks... add it to the queue
+                            out.append((ts, arbtup, msg))
+                            if len(out) >= msgcount:
+                                stop = idx + 1
+                                break
+
+                        cur = max(cur, stop)
+
+                    remaining = deadline - time.time()
+                    if len(out) >= msgcount or remaining <= 0:
+                        break
+
+                    cond.wait(remaining)
+
+            finally:
+                for pf in (pfs if pfs is not None else (None,)):
+                    waiters = self._j1939_waiters.get(pf)
+                    waiters.discard(cond)
+                    if not waiters:
+                        del self._j1939_waiters[pf]
 
         # if we actually found something, and we wanted to update last recvd...
         if len(out) and update_last_recv:
             self._last_recv_idx = cur
 
         return out
-    def J1939recv_loose(self, pf=(), ps=None, sa=None, msgcount=1, timeout=1, start_msg=None, update_last_recv=True):
-        out = []
 
-        if start_msg is None:
-            start_msg = self._last_recv_idx
+    def J1939recv(self, pf, ps, sa, msgcount=1, timeout=1, start_msg=None, update_last_recv=True):
+        '''
+        wait up to timeout seconds for msgcount messages with this pf/ps/sa,
+        starting at message start_msg (default: after the last one received)
+        '''
+        def match(arbtup):
+            return arbtup[5] == ps and arbtup[6] == sa
 
-        #for msg in self.filterCanMsgs(start_msg=start_msg, advfilters=advfilters, tail=True, maxsecs=timeout):
-            #(idx, ts, arbid, data) = msg
-            #out.append(msg)
-            #self._last_recv_idx = msg[0]
-        # FIXME: add in the wait/set interaction for lower perf impact.
-        startts = time.time()
-        cur = start_msg
-        mque = self._messages[J1939MSGS]
-        while time.time() < (startts + timeout):
-            if cur >= len(mque):
-                time.sleep(.001)
-                continue
+        return self._j1939WaitRecv((pf,), match, msgcount, timeout, start_msg, update_last_recv)
 
-            ts, arbtup, msg = mque[cur]
-            cur += 1
+    def J1939recv_loose(self, pf=(), ps=None, sa=None, msgcount=1, timeout=1, start_msg=None, update_last_recv=True):
+        '''
+        like J1939recv, but pf, ps and sa may each be a value, a list/tuple of
+        values, or None for anything
+        '''
+        if pf is not None and type(pf) not in (tuple, list):
+            pf = (pf,)
 
-            # we have a message now, does the PGN match? (loose matching)
+        def match(arbtup):
+            # does the PGN match? (loose matching)
             _, mprio, medp, mdp, mpf, mps, msa = arbtup
-            if pf is not None:
-                if type(pf) in (tuple, list):
-                    if mpf not in pf:
-                        continue
-                else:
-                    if mpf != pf:
-                        continue
-
             if ps is not None:
                 if type(ps) in (tuple, list):
                     if mps not in ps:
-                        continue
+                        return False
                 else:
                     if mps != ps:
-                        continue
+                        return False
 
             if sa is not None:
                 if type(sa) in (tuple, list):
                     if msa not in sa:
-                        continue
+                        return False
                 else:
                     if msa != sa:
-                        continue
-
-            # it's passed the checks... add it to the queue
-            out.append((ts, arbtup, msg))
+                        return False
 
-            if len(out) >= msgcount:
-                break
-
-
-        # if we actually found something, and we wanted to update last recvd...
-        if len(out) and update_last_recv:
-            self._last_recv_idx = cur
+            return True
 
-        return out
+        return self._j1939WaitRecv(pf, match, msgcount, timeout, start_msg, update_last_recv)
 
     def J1939xmit_recv(self, pf, ps, sa, data, recv_count=1, prio=6, edp=0, dp=0, timeout=1, expected_pf=None):
         msgidx = self.getCanMsgCount()
@@ -1024,15 +1216,15 @@ class J1939Interface(cancatlib.CanInterface):
 
         '''
 
-MAX_WORD = 64
-bu_masks = [(2 ** (i)) - 1 for i in range(8*MAX_WORD+1)]
-
 # Minimum keys required by the parsePGNData() function to display unknown/vendor
 # specific PGNs
 unknown_pgn_data = {"Name": "", "SPNs": []}
 
 def parsePGNData(pf, ps, msg):
-
+    '''
+    decode the SPNs of a message's data.  each PGN's SPN layouts are compiled
+    once (see j1939.getPGNDecoder()) and reused for every message after that
+    '''
     # piece the correct PGN together from PF/PS
     if pf < 0xec:
         pgn = pf << 8
@@ -1043,99 +1235,18 @@ def parsePGNData(pf, ps, msg):
     res = J1939PGNdb.get(pgn, unknown_pgn_data)
     out = {'pgn': pgn, 'pgndata': res}
 
-    spnlist = res.get('SPNs')
     spndata = []
+    for dec in getPGNDecoder(pgn):
+        try:
+            datanum, spnRepr = decodeSPN(dec, msg)
 
-    var_len_idx = 0
-    for spnum in spnlist:
-        # get SPN data
-        spn = J1939SPNdb.get(spnum)
-        if spn is None:
-            continue
-
-        # graciously refactored code from TruckDevil (hey LBD!)
-        spnlen = spn.get('SPNLength')
-        pgnlen = spn.get('PGNLength')
-        spnName = spn.get('Name')
-        spnRepr = ''
-        datanum = -1
-        units = spn.get("Units")
-
-        # skip variable-length PGNs for now
-        if (type(pgnlen) == str and 'ariable' in pgnlen):
-            datablob = msg
-            endBit = endBitO = startByte = startBitO = startBit = 0
-
-        else:       # FIXME: Rework this section
-            startBit = spn.get('StartBit')
-            endBit = spn.get('EndBit')
-
-            startByte = startBit // 8
-            startBitO = startBit % 8
-            endByte = (endBit + 7) // 8
-            endBitO = endBit % 8
-
-            datablob = msg[startByte:endByte]
-
-        #print("sb: %d\t eb: %d\t sB:%d\t SBO:%d\t eB:%d\t eBO:%d\t %r" % (startBit, endBit, startByte, startBitO, endByte, endBitO, datablob))
-
-        if units == 'ASCII':
-            spnRepr = repr(datablob)
-            datanum = datablob
-
-        else:
-            try:
-                # carve out the number
-                datanum = 0
-                datafloat = 0.0
-                numbytes = struct.unpack('%dB' % len(datablob), datablob)
-                for i, n in enumerate(numbytes):
-                    datanum |= (n << (8*i))
-                    #print("datanum (working): 0x%x   ::  0x%x" % (n, datanum))
-                    #datanum <<= 8
-
-                datanum >>= (7 - endBitO)
-                #print("datanum: %x" % datanum)
-
-                mask = bu_masks[endBit - startBit + 1]
-                datanum &= mask
-                #print("datanum(2): %x" % datanum)
-
-                offset = spn.get('Offset')
-                if offset is not None:
-                    datanum += int(offset)
-                    datafloat += offset
-                #print("datanum: %x (mask: %x)" % (datanum, mask))
-
-                # make sense of the number based on units
-                if units == 'bit':
-                    meaning = ''
-                    bitdecode = J1939BitDecodings.get(spnum)
-                    if bitdecode is not None:
-                        meaning = bitdecode.get(datanum)
-
-                    spnRepr = '0x%x (%s)' % (datanum, meaning)
-
-                elif units == 'binary':
-                    spnRepr = "%s (%x)" % (bin(int(datanum)), datanum)
-
-                elif units == '%':
-                    spnRepr = "%d%%" % datanum
-
-                else:
-                    # some other unit with a resolution
-                    resolution = spn.get('Resolution')
-                    if resolution is not None:
-                        datanum *= resolution
-
-                    spnRepr = '%.3f %s' % (datafloat, units)
-
-            except Exception as e:
-                spnRepr = "ERROR"
-                print("SPN: %r %r (%r)" % (e, msg, spn))
-                traceback.print_exc()
+        except Exception as e:
+            datanum = -1
+            spnRepr = "ERROR"
+            print("SPN: %r %r (%r)" % (e, msg, dec[1]))
+            traceback.print_exc()
 
-        spndata.append((spnum, spn, units, datanum, spnRepr))
+        spndata.append((dec[0], dec[1], dec[3], datanum, spnRepr))
 
     out['spns'] = spndata
     return out
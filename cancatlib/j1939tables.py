@@ -0,0 +1,217 @@
+'''
+On-demand J1939 lookup tables.
+
+cancatlib/J1939db.py holds the PGN, SPN, bit decoding, source address and
+manufacturer tables as one huge Python literal.  Importing it means compiling
+(or unmarshalling) every entry up front: ~0.8s and ~170MB peak the first
+time, tens of ms and several MB every time after that, for a session that
+may only ever look at a few dozen PGNs.
+
+Here the same tables are kept in an indexed sqlite file (J1939db.sqlite, one
+marshalled value per entry) and each one is wrapped in a read-only mapping
+that fetches entries the first time they're asked for and keeps them in an
+LRU cache.  Importing this module opens nothing; the database is opened on
+the first lookup.
+
+J1939db.py stays the source of the tables.  The sqlite file records a hash
+of the J1939db.py it was built from, and is rebuilt if that changes (or it's
+missing).  If it can't be written, the tables fall back to J1939db.py.
+
+Rebuild by hand with:  python -m cancatlib.j1939tables
+'''
+import os
+import sys
+import marshal
+import threading
+import collections.abc
+from functools import lru_cache
+
+__all__ = ['J1939BitDecodings', 'J1939FMITabledbr', 'J1939LampFlashTabledb', 'J1939OBDTabledb',
+           'J1939PGNdb', 'J1939SAHWTabledb', 'J1939SATabledb', 'J1939SPNdb', 'mfg_lookup']
+
+DB_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_SOURCE = os.path.join(DB_DIR, 'J1939db.py')
+DB_FILE = os.path.join(DB_DIR, 'J1939db.sqlite')
+
+# entries kept per table
+CACHE_SIZE = 1024
+MARSHAL_VERSION = 4
+
+_db = None
+_dblock = threading.Lock()
+_MISSING = object()
+
+
+def _sourceHash(source):
+    # sqlite3 and hashlib (openssl) are only imported once a table is used
+    import hashlib
+    with open(source, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _loadSource(source):
+    '''
+    the tables as dicts, straight out of J1939db.py
+    '''
+    tables = {}
+    with open(source, 'rb') as f:
+        exec(compile(f.read(), source, 'exec'), tables)
+    return dict((name, tables[name]) for name in __all__)
+
+
+def buildDb(dbfile=None, source=None):
+    '''
+    (re)build the sqlite tables (default DB_FILE) from J1939db.py
+    '''
+    import sqlite3
+    if dbfile is None:
+        dbfile = DB_FILE
+    if source is None:
+        source = DB_SOURCE
+
+    tables = _loadSource(source)
+
+    tmpfile = '%s.%d.tmp' % (dbfile, os.getpid())
+    conn = sqlite3.connect(tmpfile)
+    try:
+        conn.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE entries (tbl TEXT, key INTEGER, value BLOB, '
+                     'PRIMARY KEY (tbl, key)) WITHOUT ROWID')
+        conn.execute('INSERT INTO meta VALUES (?, ?)', ('source_sha1', _sourceHash(source)))
+        for name, table in tables.items():
+            conn.executemany('INSERT INTO entries VALUES (?, ?, ?)',
+                             ((name, key, marshal.dumps(value, MARSHAL_VERSION))
+                              for key, value in table.items()))
+        conn.commit()
+        conn.execute('VACUUM')
+        conn.close()
+        os.replace(tmpfile, dbfile)
+
+    except:
+        conn.close()
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+
+def _isCurrent(conn):
+    if not os.path.exists(DB_SOURCE):
+        # shipped without the source, nothing to compare with
+        return True
+
+    row = conn.execute("SELECT value FROM meta WHERE name='source_sha1'").fetchone()
+    return row is not None and row[0] == _sourceHash(DB_SOURCE)
+
+
+def _connect():
+    import sqlite3
+    return sqlite3.connect('file:%s?mode=ro' % DB_FILE, uri=True, check_same_thread=False)
+
+
+def _openDb():
+    '''
+    returns a connection to the current tables, or None if there isn't one
+    and it can't be built
+    '''
+    import sqlite3
+    try:
+        if os.path.exists(DB_FILE):
+            conn = _connect()
+            if _isCurrent(conn):
+                return conn
+            conn.close()
+
+        buildDb()
+        return _connect()
+
+    except (OSError, sqlite3.Error) as e:
+        print("J1939 tables: can't use %s (%r), loading %s" % (DB_FILE, e, DB_SOURCE))
+        return None
+
+
+def _getDb():
+    global _db
+    with _dblock:
+        if _db is None:
+            _db = _openDb()
+            if _db is None:
+                from cancatlib import J1939db
+                _db = dict((name, getattr(J1939db, name)) for name in __all__)
+        return _db
+
+
+class J1939Table(collections.abc.Mapping):
+    '''
+    read-only {int: entry} mapping over one table, loaded as it's used
+    '''
+    def __init__(self, name):
+        self.name = name
+        self._lookup = lru_cache(CACHE_SIZE)(self._load)
+
+    def __repr__(self):
+        return '<J1939Table %s>' % self.name
+
+    def _query(self, sql, *args):
+        db = _getDb()
+        with _dblock:
+            return db.execute(sql, (self.name,) + args).fetchall()
+
+    def _load(self, key):
+        db = _getDb()
+        if isinstance(db, dict):
+            return db[self.name].get(key, _MISSING)
+
+        with _dblock:
+            row = db.execute('SELECT value FROM entries WHERE tbl=? AND key=?', (self.name, key)).fetchone()
+
+        if row is None:
+            return _MISSING
+        return marshal.loads(row[0])
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        if value is _MISSING:
+            return default
+        return value
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def __iter__(self):
+        db = _getDb()
+        if isinstance(db, dict):
+            return iter(list(db[self.name]))
+        return iter([key for key, in self._query('SELECT key FROM entries WHERE tbl=? ORDER BY key')])
+
+    def __len__(self):
+        db = _getDb()
+        if isinstance(db, dict):
+            return len(db[self.name])
+        return self._query('SELECT count(*) FROM entries WHERE tbl=?')[0][0]
+
+    def cacheInfo(self):
+        return self._lookup.cache_info()
+
+
+J1939BitDecodings = J1939Table('J1939BitDecodings')
+J1939FMITabledbr = J1939Table('J1939FMITabledbr')
+J1939LampFlashTabledb = J1939Table('J1939LampFlashTabledb')
+J1939OBDTabledb = J1939Table('J1939OBDTabledb')
+J1939PGNdb = J1939Table('J1939PGNdb')
+J1939SAHWTabledb = J1939Table('J1939SAHWTabledb')
+J1939SATabledb = J1939Table('J1939SATabledb')
+J1939SPNdb = J1939Table('J1939SPNdb')
+mfg_lookup = J1939Table('mfg_lookup')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        DB_FILE = sys.argv[1]
+    buildDb()
+    print('wrote %s' % DB_FILE)
@@ -0,0 +1,661 @@
+'''
+Compact, columnar storage for received CAN messages.
+
+The CMD_CAN_RECV mailbox used to be a list of (timestamp, message) tuples,
+which costs a float, a bytes object and a tuple per frame.  A multi-hour
+capture turns into tens of millions of Python objects.  CanMsgStore keeps the
+same data in parallel arrays instead:
+
+    timestamps  array('d')
+    arbids      array('I')
+    dlcs        array('H')
+    offsets     array('Q')      (where each payload starts)
+    payload     bytearray       (every payload, back to back)
+
+It still behaves like the old list: len(), indexing, slicing and iteration
+hand back (timestamp, message) tuples where message is the 4-byte big-endian
+arbid followed by the data, exactly as the transceiver sent it.  Code that
+cares about speed should use getFrame()/iterFrames(), which skip building
+the message bytes entirely.
+
+An arbid -> message-index posting list is kept alongside the columns so that
+arbid-filtered iteration (iterArbidFrames) only costs as much as the number
+of matching frames.
+
+A store can also be built around read-only columns (see fromColumns(), used
+to mmap session files).  Those are only copied into real arrays the first
+time the store is modified.
+
+Old frames can be evicted from memory without renumbering the rest: message
+indexes stay the same for the life of the store, len() keeps counting every
+frame ever added, and the evicted ones are either served by an archive
+(segment files written by a capture, see cancatlib.capture) or reported with
+MsgEvictedError.
+
+Only one thread modifies a store at a time (CanInterface does it holding
+_queuelock), but readers don't lock.  The columns and the window into them
+are published together as one tuple, _state, which readers take once; a
+compaction builds new columns rather than touching the ones readers may
+still be holding.
+'''
+import heapq
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+
+# once this many entries have been popped off the front, pack the arrays down
+COMPACT_MIN = 0x10000
+
+
+class MsgEvictedError(IndexError):
+    '''
+    the requested message index has been evicted from memory (and there's no
+    archive to read it back from)
+    '''
+    def __init__(self, idx, first):
+        IndexError.__init__(self, 'message %d has been evicted, the oldest message still available is %d' % (idx, first))
+        self.idx = idx
+        self.first = first
+
+
+class _Columns(object):
+    '''
+    one set of column arrays, plus the per-arbid posting lists over them (None
+    until built).  frames are appended in place; compaction and unmapping
+    build a new set and leave the old one to any reader still holding it
+    '''
+    __slots__ = ('ts', 'arbids', 'dlcs', 'offsets', 'payload', 'arbidx')
+
+    def __init__(self, ts, arbids, dlcs, offsets, payload, arbidx=None):
+        self.ts = ts
+        self.arbids = arbids
+        self.dlcs = dlcs
+        self.offsets = offsets
+        self.payload = payload
+        self.arbidx = arbidx
+
+
+class CanMsgStore(object):
+    def __init__(self, msgs=None):
+        self._idxlock = threading.Lock()
+        self._mutations = 0
+        # where to read evicted frames from (anything with getFrame/iterFrames/iterArbidFrames)
+        self._archive = None
+        # timestamp of the first frame ever added, even if it's been evicted
+        self._start_ts = None
+        self._init_arrays()
+        if msgs is not None:
+            self.extend(msgs)
+
+    @classmethod
+    def fromColumns(cls, ts, arbids, dlcs, offsets, payload, arbidx_loader=None, first_idx=0):
+        '''
+        build a store around existing columns, which may be read-only buffers
+        (eg. memoryviews into an mmap'd session file).  first_idx is the message
+        index of the first frame (the ones before it count as evicted).
+
+        arbidx_loader, if given, is called the first time the per-arbid index
+        is needed and returns (arbidx, count): posting lists already covering
+        the first count frames.
+        '''
+        self = cls()
+        self._mapped = not isinstance(payload, bytearray)
+        self._arbidx_loader = arbidx_loader
+        self._state = (_Columns(ts, arbids, dlcs, offsets, payload), first_idx, 0)
+        return self
+
+    def _init_arrays(self, evicted=0):
+        # (columns, evicted, head): frames dropped from the front that keep
+        # their indexes, and physical entries at the front of the columns that
+        # are gone (evicted or popped) but haven't been compacted away.
+        #
+        # writers (one at a time, see CanInterface._queuelock) replace the
+        # whole tuple, and readers don't lock: they take _state once and only
+        # use what's in it.  the posting lists start out empty, they're None
+        # until built when the store was loaded rather than filled a frame at a time
+        self._state = (_Columns(array('d'), array('I'), array('H'), array('Q'), bytearray(), {}), evicted, 0)
+        self._arbidx_loader = None
+        # columns are read-only buffers until _unmap() copies them
+        self._mapped = False
+
+    # the current columns, for the writer and for poking around.  readers
+    # that might race with a compaction use one _state snapshot instead
+    @property
+    def _ts(self):
+        return self._state[0].ts
+
+    @property
+    def _arbids(self):
+        return self._state[0].arbids
+
+    @property
+    def _dlcs(self):
+        return self._state[0].dlcs
+
+    @property
+    def _offsets(self):
+        return self._state[0].offsets
+
+    @property
+    def _payload(self):
+        return self._state[0].payload
+
+    @property
+    def _arbidx(self):
+        return self._state[0].arbidx
+
+    @property
+    def _window(self):
+        return self._state[1:]
+
+    @property
+    def _head(self):
+        return self._state[2]
+
+    @property
+    def _evicted(self):
+        return self._state[1]
+
+    def __len__(self):
+        # dlcs is appended last, so every other column is at least this long
+        cols, evicted, head = self._state
+        return evicted + len(cols.dlcs) - head
+
+    def __repr__(self):
+        return '<%s: %d msgs>' % (self.__class__.__name__, len(self))
+
+    def getFirstIndex(self):
+        '''
+        index of the oldest message still held in memory
+        '''
+        return self._state[1]
+
+    def getOldestIndex(self):
+        '''
+        index of the oldest message that can still be read, from memory or
+        from the archive evicted messages went to
+        '''
+        if self._archive is not None:
+            return min(self._archive.getFirstIndex(), self._state[1])
+        return self._state[1]
+
+    def getStartTimestamp(self):
+        '''
+        timestamp of the first message ever stored (evicted or not)
+        '''
+        if self._start_ts is not None:
+            return self._start_ts
+
+        cols, evicted, head = self._state
+        if len(cols.dlcs) > head:
+            return cols.ts[head]
+
+        return None
+
+    def _locate(self, idx):
+        '''
+        returns (columns, physical index) of message idx, from one snapshot
+        '''
+        cols, evicted, head = self._state
+        count = evicted + len(cols.dlcs) - head
+        if idx < 0:
+            idx += count
+        if idx < 0 or idx >= count:
+            raise IndexError('CanMsgStore index out of range')
+        if idx < evicted:
+            raise MsgEvictedError(idx, evicted)
+        return cols, idx - evicted + head
+
+    def _physidx(self, idx):
+        return self._locate(idx)[1]
+
+    def _isArchived(self, idx):
+        return 0 <= idx < self._state[1] and self._archive is not None
+
+    def _unmap(self):
+        '''
+        copy read-only (mmap'd) columns into arrays so they can be modified
+        '''
+        if not self._mapped:
+            return
+
+        with self._idxlock:
+            cols, evicted, head = self._state
+            copies = []
+            for col, typecode in ((cols.ts, 'd'), (cols.arbids, 'I'), (cols.dlcs, 'H'), (cols.offsets, 'Q')):
+                copy = array(typecode)
+                copy.frombytes(memoryview(col).cast('B'))
+                copies.append(copy)
+
+            # same layout, so the posting lists still fit
+            self._state = (_Columns(*copies, payload=bytearray(cols.payload), arbidx=cols.arbidx), evicted, head)
+            self._mapped = False
+
+    def appendFrame(self, ts, arbid, data):
+        '''
+        Add one frame.  Columns (and the posting list) are appended in an
+        order that keeps len() safe for readers in other threads.
+        '''
+        if self._mapped:
+            self._unmap()
+        if self._start_ts is None:
+            self._start_ts = ts
+
+        cols = self._state[0]
+        pidx = len(cols.dlcs)
+        cols.payload += data
+        cols.ts.append(ts)
+        cols.arbids.append(arbid)
+        cols.offsets.append(len(cols.payload) - len(data))
+
+        arbidx = cols.arbidx
+        if arbidx is None:
+            # the index hasn't been built yet (or is being built right now).
+            # either the builder sees this frame, or we add it once it's done
+            with self._idxlock:
+                if cols.arbidx is not None:
+                    self._addPosting(cols.arbidx, arbid, pidx)
+                cols.dlcs.append(len(data))
+            return
+
+        self._addPosting(arbidx, arbid, pidx)
+        cols.dlcs.append(len(data))
+
+    @staticmethod
+    def _addPosting(arbidx, arbid, pidx):
+        posting = arbidx.get(arbid)
+        if posting is None:
+            posting = arbidx[arbid] = array('I')
+        posting.append(pidx)
+
+    def append(self, tsmsg):
+        '''
+        list-compatible append of a (timestamp, message) tuple
+        '''
+        ts, msg = tsmsg
+        if isinstance(msg, str):
+            msg = msg.encode('latin-1')
+
+        arbid, = struct.unpack_from('>I', msg)
+        self.appendFrame(ts, arbid, msg[4:])
+
+    def extend(self, msgs):
+        if isinstance(msgs, CanMsgStore):
+            for idx, ts, arbid, data in msgs.iterFrames(msgs.getFirstIndex()):
+                self.appendFrame(ts, arbid, data)
+            return
+
+        for tsmsg in msgs:
+            self.append(tsmsg)
+
+    def getTimestamp(self, idx):
+        if self._isArchived(idx):
+            return self._archive.getFrame(idx)[0]
+        cols, pidx = self._locate(idx)
+        return cols.ts[pidx]
+
+    def getArbid(self, idx):
+        if self._isArchived(idx):
+            return self._archive.getFrame(idx)[1]
+        cols, pidx = self._locate(idx)
+        return cols.arbids[pidx]
+
+    def getData(self, idx):
+        if self._isArchived(idx):
+            return self._archive.getFrame(idx)[2]
+        cols, pidx = self._locate(idx)
+        off = cols.offsets[pidx]
+        return bytes(cols.payload[off:off+cols.dlcs[pidx]])
+
+    def getFrame(self, idx):
+        '''
+        returns (timestamp, arbid, data) without packing/unpacking the arbid
+        '''
+        if self._isArchived(idx):
+            return self._archive.getFrame(idx)
+        cols, pidx = self._locate(idx)
+        off = cols.offsets[pidx]
+        return cols.ts[pidx], cols.arbids[pidx], bytes(cols.payload[off:off+cols.dlcs[pidx]])
+
+    def getColumns(self, start=None, stop=None):
+        '''
+        returns (timestamps, arbids, dlcs) columns for start <= idx < stop, for
+        bulk number crunching (see cancatlib.sessionstats).  they're copies,
+        or read-only views of an mmap'd session.  start defaults to the oldest
+        frame in memory, and archived frames aren't available this way
+        '''
+        cols, evicted, head = self._state
+        count = evicted + len(cols.dlcs) - head
+        if start is None:
+            start = evicted
+        if stop is None or stop > count:
+            stop = count
+        if start < evicted:
+            raise MsgEvictedError(start, evicted)
+
+        lo = start - evicted + head
+        hi = max(lo, stop - evicted + head)
+        return cols.ts[lo:hi], cols.arbids[lo:hi], cols.dlcs[lo:hi]
+
+    def _checkStart(self, start):
+        '''
+        evicted frames come from the archive (returns where the archive
+        should stop), or are an error
+        '''
+        evicted = self._state[1]
+        if start >= evicted:
+            return None
+        if self._archive is None:
+            raise MsgEvictedError(start, evicted)
+        return evicted
+
+    def _snapshot(self, start):
+        '''
+        returns (columns, evicted, head, count) to read frames from start on.
+        start may have been evicted since the caller last looked: then it
+        has to come from the archive (or it's an error)
+        '''
+        cols, evicted, head = self._state
+        if start < evicted and self._archive is None:
+            raise MsgEvictedError(start, evicted)
+        return cols, evicted, head, evicted + len(cols.dlcs) - head
+
+    def iterFrames(self, start=0, stop=None):
+        '''
+        yields (idx, timestamp, arbid, data) for start <= idx < stop
+        '''
+        if stop is None or stop > len(self):
+            stop = len(self)
+
+        archived = self._checkStart(start)
+        if archived is not None:
+            for frame in self._archive.iterFrames(start, min(stop, archived)):
+                yield frame
+            start = archived
+
+        # a snapshot only covers the frames added before the columns were last
+        # compacted, so take another one if it runs out before stop
+        while start < stop:
+            cols, evicted, head, count = self._snapshot(start)
+            if start < evicted:
+                # evicted while we were reading, the archive has these too
+                for frame in self._archive.iterFrames(start, min(stop, evicted)):
+                    yield frame
+                start = evicted
+                continue
+
+            end = min(stop, count)
+            if end <= start:
+                return
+
+            base = head - evicted
+            tss = cols.ts
+            arbids = cols.arbids
+            dlcs = cols.dlcs
+            offsets = cols.offsets
+            payload = cols.payload
+
+            for idx in range(start, end):
+                pidx = idx + base
+                off = offsets[pidx]
+                yield idx, tss[pidx], arbids[pidx], bytes(payload[off:off+dlcs[pidx]])
+            start = end
+
+    def _getArbidIndex(self, cols=None):
+        '''
+        the posting lists over cols (default: the current columns)
+        '''
+        if cols is None:
+            cols = self._state[0]
+
+        arbidx = cols.arbidx
+        if arbidx is None:
+            with self._idxlock:
+                arbidx = cols.arbidx
+                if arbidx is None:
+                    arbidx = self._buildArbidIndex(cols)
+
+        return arbidx
+
+    def _buildArbidIndex(self, cols):
+        # caller holds _idxlock, so appendFrame can't slip a frame past us
+        covered = 0
+        arbidx = {}
+        if self._arbidx_loader is not None:
+            arbidx, covered = self._arbidx_loader()
+            self._arbidx_loader = None
+
+        arbids = cols.arbids
+        addPosting = self._addPosting
+        for pidx in range(covered, len(cols.dlcs)):
+            addPosting(arbidx, arbids[pidx], pidx)
+
+        cols.arbidx = arbidx
+        return arbidx
+
+    def getArbids(self):
+        '''
+        returns the arbids present in memory (popped entries may linger
+        until the next compaction)
+        '''
+        return list(self._getArbidIndex().keys())
+
+    def _iterArbidIndexes(self, posting, start, stop, base):
+        # posting lists hold physical indexes, hand back message indexes
+        pos = bisect_left(posting, start + base)
+        end = len(posting)
+        while pos < end:
+            pidx = posting[pos]
+            if pidx >= stop + base:
+                return
+            yield pidx - base
+            pos += 1
+
+    def iterArbidFrames(self, arbids, start=0, stop=None):
+        '''
+        yields (idx, timestamp, arbid, data) for start <= idx < stop, but only
+        for frames whose arbid is in arbids.  Uses the posting lists, so the
+        frames in between are never touched.
+        '''
+        if stop is None or stop > len(self):
+            stop = len(self)
+        if start < 0:
+            start = 0
+
+        archived = self._checkStart(start)
+        if archived is not None:
+            for frame in self._archive.iterArbidFrames(arbids, start, min(stop, archived)):
+                yield frame
+            start = archived
+
+        try:
+            wanted = set(arbids)
+        except TypeError:
+            wanted = arbids
+
+        # see iterFrames()
+        while start < stop:
+            cols, evicted, head, count = self._snapshot(start)
+            if start < evicted:
+                for frame in self._archive.iterArbidFrames(arbids, start, min(stop, evicted)):
+                    yield frame
+                start = evicted
+                continue
+
+            end = min(stop, count)
+            if end <= start:
+                return
+
+            arbidx = self._getArbidIndex(cols)
+
+            # walk whichever side is smaller: the requested arbids or the ones we have
+            if len(wanted) <= len(arbidx):
+                postings = [arbidx[a] for a in wanted if a in arbidx]
+            else:
+                postings = [posting for a, posting in list(arbidx.items()) if a in wanted]
+
+            if not postings:
+                start = end
+                continue
+
+            base = head - evicted
+            if len(postings) == 1:
+                idxs = self._iterArbidIndexes(postings[0], start, end, base)
+            else:
+                idxs = heapq.merge(*[self._iterArbidIndexes(p, start, end, base) for p in postings])
+
+            tss = cols.ts
+            colarbids = cols.arbids
+            dlcs = cols.dlcs
+            offsets = cols.offsets
+            payload = cols.payload
+
+            for idx in idxs:
+                pidx = idx + base
+                off = offsets[pidx]
+                yield idx, tss[pidx], colarbids[pidx], bytes(payload[off:off+dlcs[pidx]])
+            start = end
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[x] for x in range(*idx.indices(len(self)))]
+
+        ts, arbid, data = self.getFrame(idx)
+        return ts, struct.pack('>I', arbid) + data
+
+    def __iter__(self):
+        for idx, ts, arbid, data in self.iterFrames(self.getFirstIndex()):
+            yield ts, struct.pack('>I', arbid) + data
+
+    def pop(self, idx=-1):
+        '''
+        list-compatible pop.  popping the oldest entry (the way recv() does)
+        is O(1); anything else has to shuffle the columns.  a store that has
+        evicted frames can't renumber, so it refuses.
+        '''
+        count = len(self)
+        if idx < 0:
+            idx += count
+
+        evicted = self._state[1]
+        if evicted:
+            raise MsgEvictedError(0, evicted)
+
+        item = self[idx]
+        self._unmap()
+        self._mutations += 1
+
+        if idx == 0:
+            cols, evicted, head = self._state
+            head += 1
+            self._state = (cols, 0, head)
+            if head >= COMPACT_MIN and head * 2 >= len(cols.dlcs):
+                self._compact()
+
+        elif idx == count - 1:
+            cols, pidx = self._locate(idx)
+            if cols.arbidx is not None:
+                cols.arbidx[cols.arbids[pidx]].pop()
+            del cols.payload[cols.offsets[pidx]:]
+            del cols.dlcs[pidx]
+            del cols.offsets[pidx]
+            del cols.arbids[pidx]
+            del cols.ts[pidx]
+
+        else:
+            msgs = list(self)
+            del msgs[idx]
+            self.clear()
+            self.extend(msgs)
+
+        return item
+
+    def evict(self, count):
+        '''
+        drop the oldest count frames from memory.  unlike pop(), the remaining
+        frames keep their indexes.  returns how many were evicted
+        '''
+        cols, evicted, head = self._state
+        count = max(0, min(count, len(cols.dlcs) - head))
+        if not count:
+            return 0
+
+        head += count
+        self._state = (cols, evicted + count, head)
+        if head >= COMPACT_MIN and head * 2 >= len(cols.dlcs):
+            self._compact()
+        return count
+
+    def _compact(self):
+        '''
+        drop the entries that have been popped/evicted off the front.  the
+        compacted columns are new arrays, published with the new window in
+        one go; readers holding the old ones can carry on with them
+        '''
+        cols, evicted, head = self._state
+        if not head:
+            return
+
+        if head >= len(cols.dlcs):
+            self._init_arrays(evicted)
+            return
+
+        self._unmap()
+        # hold off anyone building the posting lists over the old columns
+        with self._idxlock:
+            cols, evicted, head = self._state
+            arbidx = cols.arbidx
+            if arbidx is not None:
+                arbidx = {}
+                for arbid, posting in cols.arbidx.items():
+                    posting = array('I', (pidx - head for pidx in posting[bisect_left(posting, head):]))
+                    if len(posting):
+                        arbidx[arbid] = posting
+
+            # a loader's posting lists are for the old layout
+            self._arbidx_loader = None
+
+            base = cols.offsets[head]
+            compacted = _Columns(cols.ts[head:], cols.arbids[head:], cols.dlcs[head:],
+                                 array('Q', (off - base for off in cols.offsets[head:])),
+                                 cols.payload[base:], arbidx)
+            self._state = (compacted, evicted, 0)
+
+    def clear(self):
+        self._mutations += 1
+        self._archive = None
+        self._start_ts = None
+        self._init_arrays()
+
+    def nbytes(self):
+        '''
+        approximate memory used by the stored frames
+        '''
+        cols = self._state[0]
+        return sum(len(col) * col.itemsize
+                   for col in (cols.ts, cols.arbids, cols.dlcs, cols.offsets)) + len(cols.payload)
+
+    def __getstate__(self):
+        self._unmap()
+        self._compact()
+        cols, evicted, head = self._state
+        return {'ts': cols.ts,
+                'arbids': cols.arbids,
+                'dlcs': cols.dlcs,
+                'offsets': cols.offsets,
+                'payload': bytes(cols.payload),
+                'first_idx': evicted,
+                'start_ts': self._start_ts,
+                }
+
+    def __setstate__(self, state):
+        self._state = (_Columns(state['ts'], state['arbids'], state['dlcs'], state['offsets'],
+                                bytearray(state['payload'])),
+                       state.get('first_idx', 0), 0)
+        self._start_ts = state.get('start_ts')
+        self._archive = None
+        self._mapped = False
+        self._mutations = 0
+        self._idxlock = threading.Lock()
+        self._arbidx_loader = None
@@ -1,9 +1,9 @@
 # Command line entry point for cancat2pcap
-# This requires scapy to be installed
 
 import sys
 import argparse
 from cancatlib.utils import convert
+from cancatlib.utils import pcap
 
 
 def main():
@@ -12,8 +12,15 @@ def main():
     parser = argparse.ArgumentParser(
             prog='cancat2pcap',
             description='Utility to convert a CanCat session into a pcap')
-    parser.add_argument('session', type=argparse.FileType('rb'), help='input CanCat session')
+    parser.add_argument('session', type=str, help='input CanCat session')
     parser.add_argument('output', type=str, help='output pcap file')
+    parser.add_argument('--socketcan', action='store_true',
+                        help='write LINKTYPE_CAN_SOCKETCAN frames instead of Linux cooked (SLL) ones')
     args = parser.parse_args(argv)
 
-    convert.cancat2pcap(args.session, args.output)
+    if args.socketcan:
+        linktype = pcap.LINKTYPE_CAN_SOCKETCAN
+    else:
+        linktype = pcap.LINKTYPE_LINUX_SLL
+
+    convert.cancat2pcap(args.session, args.output, linktype)
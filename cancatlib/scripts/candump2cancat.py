@@ -13,6 +13,8 @@ def main():
             description='Utility to convert a candump log into a CanCat session')
     parser.add_argument('log', help='input candump log')
     parser.add_argument('output', help='output cancat session')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes parsing the log (default: one per cpu)')
     args = parser.parse_args(argv)
 
-    convert.candump2cancat(args.log, args.output)
+    convert.candump2cancat(args.log, args.output, jobs=args.jobs)
@@ -1,13 +1,16 @@
 # CAN bus device mapping tool
 from __future__ import print_function
 
+import os
 import sys
 import argparse
 import re
 import time
 import signal
 import importlib
+import threading
 import traceback
+from collections import deque
 
 import cancatlib
 from cancatlib.utils.types import SparseHexRange, ECUAddress
@@ -19,6 +22,10 @@ c = None
 _config = None
 _output_filename = None
 _can_session_filename = None
+# scans of several ECUs may be running at once (--parallel)
+_results_lock = threading.RLock()
+# set to stop the periodic checkpoint saves
+_checkpoint_stop = threading.Event()
 
 
 def now():
@@ -168,12 +175,18 @@ def udsmap_parse_args():
 
     parser.add_argument('-T', '--timeout', type=float, default=0.2,
                         help='UDS Timeout, 3 seconds is the ISO14229 standard, standard for this tool is 200 msec (0.2)')
+    parser.add_argument('--fixed-timeout', action='store_true',
+                        help='Always wait the full UDS timeout for a response, instead of learning how quickly each ECU answers and waiting only a little longer than that')  # noqa: E501
     parser.add_argument('-w', '--startup-wait', type=float, nargs='?', const=2.0,
                         help='Wait to receive CAN messages before starting the scan')
     parser.add_argument('-d', '--scan-delay', type=float, default=0.0,
                         help='Wait a small time between requests, helps prevent flooding the bus')
     parser.add_argument('-r', '--rescan', action='store_true',
                         help='Run a full rescan and merge new results with any existing data')
+    parser.add_argument('-P', '--parallel', type=int, default=1, metavar='N',
+                        help='Scan up to N ECUs at once, and probe N addresses at once during ECU discovery. ISO-TP is done by this tool instead of the CanCat hardware so the ECUs can be talked to at the same time')  # noqa: E501
+    parser.add_argument('--batch-xmit', action='store_true',
+                        help='Send the --parallel discovery probes in batches. Needs the M2_CAN_haz_bus firmware that takes CMD_CAN_SEND_BATCH')  # noqa: E501
     # parser.add_argument('-f', '--force', action='store_true',
     #                   help='Force udsmap to scan with potentially harmful
     #                   options')
@@ -190,6 +203,10 @@ def udsmap_parse_args():
                         help='Filename for saving raw cancat session, can contain "time.strftime" formatting like "canmap_%%Y%%m%%d-%%H%%M%%S.sess"')  # noqa: E501
     parser.add_argument('-i', '--input-file',
                         help='Input file containing previous scan results')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the scans in the input file (or the output file, if there is no input file) exactly where they stopped, re-using the results already found')  # noqa: E501
+    parser.add_argument('-k', '--checkpoint-interval', type=float, default=30.0,
+                        help='How often (in seconds) to save the scan results and progress to the output file while scanning, 0 to only save at the end')  # noqa: E501
     parser.add_argument('-u', '--uds-class',
                         help='Custom UDS class, allows for implementing key/seed unlock functions or testing, example: cancatlib.uds.test.FakeUDS')  # noqa: E501
     return parser.parse_args()
@@ -197,7 +214,8 @@ def udsmap_parse_args():
 
 def log_and_save(results, note):
     log.msg(note)
-    results['notes'][results['start_time']] += '\n' + note
+    with _results_lock:
+        results['notes'][results['start_time']] += '\n' + note
 
 
 def import_results(args, c, scancls):
@@ -233,10 +251,14 @@ def import_results(args, c, scancls):
         if 'timeout' not in config['config']:
             config['config']['timeout'] = args.timeout
 
+        if 'adaptive_timeout' not in config['config']:
+            config['config']['adaptive_timeout'] = not args.fixed_timeout
+
         for e in imported_data['ECUs']:
             addr = ECUAddress(**e)
-            config['ECUs'][addr] = ECU(c, addr, uds_class=scancls,
-                                       timeout=config['config']['timeout'], delay=args.scan_delay, **e)
+            config['ECUs'][addr] = ECU(c, addr, scancls=scancls,
+                                       timeout=config['config']['timeout'], delay=args.scan_delay,
+                                       adaptive_timeout=config['config']['adaptive_timeout'], **e)
         return config
 
 
@@ -287,16 +309,32 @@ def save_results(results, filename=None):
         #       .add_ecu(), .add_note(), .export(), .import()
         output_data = {}
         global _config
-        output_data['config'] = results['config']
-        output_data['notes'] = dict([(k, literal_unicode(v)) for k, v in results['notes'].items()])
-        output_data['ECUs'] = sorted([e for e in results['ECUs'].values()], key=lambda x: x._addr.tx_arbid)
-
-        with open(filename, 'w') as f:
-            f.write(yaml.dump(output_data))
+        with _results_lock:
+            output_data['config'] = results['config']
+            output_data['notes'] = dict([(k, literal_unicode(v)) for k, v in results['notes'].items()])
+            output_data['ECUs'] = sorted([e for e in results['ECUs'].values()], key=lambda x: x._addr.tx_arbid)
+
+            # write it out whole before replacing the old one, so an
+            # interrupted save doesn't lose the last checkpoint
+            tmpfile = '{}.tmp'.format(filename)
+            with open(tmpfile, 'w') as f:
+                f.write(yaml.dump(output_data))
+            os.replace(tmpfile, filename)
+
+
+def checkpoint(interval):
+    # save the results (and so the progress of the scans) every interval
+    # seconds, until _checkpoint_stop is set
+    while not _checkpoint_stop.wait(interval):
+        try:
+            save_results(_config, _output_filename)
+        except Exception as e:
+            log.error('Failed to save checkpoint to {}: {}'.format(_output_filename, e))
 
 
 def save():
     global _config, _output_filename, _can_session_filename
+    _checkpoint_stop.set()
     if _output_filename:
         save_results(_config, _output_filename)
 
@@ -316,7 +354,54 @@ def sigint_handler(signum, frame):
     save_and_exit(1)
 
 
+def scan_ecus(ecus, func, parallel=1):
+    '''
+    run func(ecu) for each ECU, on up to parallel ECUs at once.  An exception
+    from one ECU stops any more from being started, and is raised once the
+    ones already running are done
+    '''
+    pending = deque(ecus)
+    if parallel <= 1 or len(pending) <= 1:
+        for ecu in pending:
+            func(ecu)
+        return
+
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                ecu = pending.popleft()
+            except IndexError:
+                return
+
+            try:
+                func(ecu)
+            except Exception as e:
+                log.error('{} scan failed: {}'.format(ecu._addr, e))
+                errors.append(e)
+
+    # daemon threads so a CTRL-C can save and exit without waiting on them
+    workers = [threading.Thread(target=worker) for i in range(min(parallel, len(pending)))]
+    for t in workers:
+        t.daemon = True
+        t.start()
+
+    for t in workers:
+        # join with a timeout so the main thread still sees CTRL-C
+        while t.is_alive():
+            t.join(.5)
+
+    if errors:
+        raise errors[0]
+
+
 def scan(config, args, c, scancls):  # noqa: C901
+    if args.parallel > 1:
+        parallel = args.parallel
+    else:
+        parallel = None
+
     if 'E' in args.scan:
         log_and_save(_config, 'ECU scan started @ {}'.format(config['start_time']))
 
@@ -325,27 +410,33 @@ def scan(config, args, c, scancls):  # noqa: C901
             if args.discovery_type == 'did':
                 if args.bus_mode in ['std', 'both']:
                     ecus.extend(ecu_did_scan(c, args.E, ext=0, udscls=scancls,
-                                             timeout=config['config']['timeout'], delay=args.scan_delay))
+                                             timeout=config['config']['timeout'], delay=args.scan_delay,
+                                             parallel=parallel))
                 if args.bus_mode in ['ext', 'both']:
                     ecus.extend(ecu_did_scan(c, args.E, ext=1, udscls=scancls,
-                                             timeout=config['config']['timeout'], delay=args.scan_delay))
+                                             timeout=config['config']['timeout'], delay=args.scan_delay,
+                                             parallel=parallel))
             else:
                 if args.bus_mode in ['std', 'both']:
                     ecus.extend(ecu_session_scan(c, args.E, ext=0, udscls=scancls,
-                                                 timeout=config['config']['timeout'], delay=args.scan_delay))
+                                                 timeout=config['config']['timeout'], delay=args.scan_delay,
+                                                 parallel=parallel))
                 if args.bus_mode in ['ext', 'both']:
                     ecus.extend(ecu_session_scan(c, args.E, ext=1, udscls=scancls,
-                                                 timeout=config['config']['timeout'], delay=args.scan_delay))
+                                                 timeout=config['config']['timeout'], delay=args.scan_delay,
+                                                 parallel=parallel))
 
-            for addr in ecus:
-                _config['ECUs'][addr] = ECU(c, addr, uds_class=scancls,
-                                            timeout=config['config']['timeout'], delay=args.scan_delay)
+            with _results_lock:
+                for addr in ecus:
+                    _config['ECUs'][addr] = ECU(c, addr, scancls=scancls,
+                                                timeout=config['config']['timeout'], delay=args.scan_delay,
+                                                adaptive_timeout=config['config']['adaptive_timeout'])
 
     if 'D' in args.scan:
         log_and_save(_config, 'DID read scan started @ {}'.format(now()))
 
-        for ecu in _config['ECUs'].values():
-            ecu.did_read_scan(args.D, args.rescan)
+        scan_ecus(_config['ECUs'].values(), lambda ecu: ecu.did_read_scan(args.D, args.rescan, args.resume),
+                  args.parallel)
 
     # if 'W' in args.scan:
     #    log_and_save(_config, 'DID write scan started @ {}'.format(now()))
@@ -361,20 +452,20 @@ def scan(config, args, c, scancls):  # noqa: C901
         else:
             recursive = True
 
-        for ecu in _config['ECUs'].values():
-            ecu.session_scan(args.S, args.rescan, rescan_did_range=args.D, recursive_scan=recursive)
+        scan_ecus(_config['ECUs'].values(),
+                  lambda ecu: ecu.session_scan(args.S, args.rescan, rescan_did_range=args.D, recursive_scan=recursive,
+                                               resume=args.resume),
+                  args.parallel)
 
     if 'A' in args.scan:
         log_and_save(_config, 'Auth scan started @ {}'.format(now()))
 
-        for ecu in _config['ECUs'].values():
-            ecu.auth_scan(args.A, args.rescan)
+        scan_ecus(_config['ECUs'].values(), lambda ecu: ecu.auth_scan(args.A, args.rescan, args.resume), args.parallel)
 
     if 'L' in args.scan:
         log_and_save(_config, 'Key Length scan started @ {}'.format(now()))
 
-        for ecu in _config['ECUs'].values():
-            ecu.key_length_scan(args.L, args.rescan)
+        scan_ecus(_config['ECUs'].values(), lambda ecu: ecu.key_length_scan(args.L, args.rescan), args.parallel)
 
 
 def main():  # noqa: C901
@@ -425,6 +516,15 @@ def main():  # noqa: C901
         if hasattr(scanlib, 'CanInterface'):
             ifaceclass = getattr(scanlib, 'CanInterface')
     c = ifaceclass(port=args.port)
+    if args.parallel > 1:
+        # the CanCat hardware only handles one ISO-TP exchange at a time
+        c.host_isotp = True
+    c.batch_xmit = args.batch_xmit
+
+    if args.resume and args.input_file is None and args.output_file:
+        # pick up from the last checkpoint in the output file
+        if os.path.exists(time.strftime(args.output_file)):
+            args.input_file = time.strftime(args.output_file)
 
     global _config
     if args.input_file is not None:
@@ -434,6 +534,7 @@ def main():  # noqa: C901
             'config': {
                 'baud': args.baud,
                 'timeout': args.timeout,
+                'adaptive_timeout': not args.fixed_timeout,
                 'no_recursive_session_scanning': args.no_recursive_session_scanning,
             },
             'notes': {},
@@ -467,6 +568,11 @@ def main():  # noqa: C901
     # signal will catch CTRL-C in script contexts
     signal.signal(signal.SIGINT, sigint_handler)
 
+    if _output_filename and args.checkpoint_interval > 0:
+        t = threading.Thread(target=checkpoint, args=(args.checkpoint_interval,))
+        t.daemon = True
+        t.start()
+
     # catching KeyboardInterrupt will catch CTRL-C in interactive contexts
     try:
         scan(_config, args, c, scancls)
@@ -1,5 +1,4 @@
-# Command line entry point for candump2cancat
-# This requires scapy to be installed
+# Command line entry point for pcap2cancat
 
 import sys
 import argparse
@@ -12,7 +11,7 @@ def main():
     parser = argparse.ArgumentParser(
             prog='pcap2cancat',
             description='Utility to convert a pcap with CAN messages into a CanCat session')
-    parser.add_argument('pcap', help='input pcap')
+    parser.add_argument('pcap', help='input pcap or pcapng')
     parser.add_argument('output', help='output cancat session')
     args = parser.parse_args(argv)
 
@@ -0,0 +1,382 @@
+'''
+Chunked, append-only binary session files.
+
+Pickled sessions have to be read (and every message rebuilt) in one go, which
+takes minutes and gigabytes for a long capture.  This format stores CAN frame
+mailboxes as raw columns that can be mmap'd and handed straight to a
+CanMsgStore, so opening a session is instant and frames are only paged in
+when they're looked at.
+
+Layout (little endian):
+
+    header      b'CanCatSF'  version(H)  flags(H)  reserved(I)
+
+    chunks      tag(4s)  param(I)  length(Q)  payload[length]  (padded to 8)
+
+        b'META' pickled dict: bookmarks, bookmark_info, comments, config,
+                class and any mailboxes that aren't CAN frames, plus
+                first_idx/start_ts for each CAN mailbox (a store holding a
+                window of a longer capture starts at first_idx).  Appended
+                again whenever it changes, the last one wins.
+
+        b'MSGS' param=mailbox: count(Q) payload_len(Q), then one column per
+                field, each a fixed-size record per frame (padded to 8):
+                    timestamps  double[count]
+                    arbids      uint32[count]
+                    dlcs        uint16[count]
+                    offsets     uint64[count]   (into this chunk's payload)
+                    payload     bytes[payload_len]
+                Frame chunks for a mailbox follow each other in capture
+                order; live captures just keep appending more of them.
+
+        b'AIDX' param=mailbox: covered(Q), then per arbid: arbid(I) count(I)
+                uint32[count] message indexes.  Posting lists for the first
+                covered frames of the mailbox, so arbid lookups don't have to
+                scan the whole capture.
+
+A session with one MSGS chunk per mailbox (what saveSession() writes) is used
+in place; several chunks (appended captures) are joined with one copy per
+column.
+'''
+import os
+import sys
+import mmap
+import pickle
+import struct
+from array import array
+from bisect import bisect_left
+
+from cancatlib.msgstore import CanMsgStore, MsgEvictedError
+
+SESSION_MAGIC = b'CanCatSF'
+SESSION_VERSION = 2
+
+SESSION_HDR = struct.Struct('<8sHHI')
+CHUNK_HDR = struct.Struct('<4sIQ')
+MSGS_HDR = struct.Struct('<QQ')
+AIDX_HDR = struct.Struct('<Q')
+POSTING_HDR = struct.Struct('<II')
+
+COLUMNS = (('ts', 'd'), ('arbids', 'I'), ('dlcs', 'H'), ('offsets', 'Q'))
+
+
+# column data is little endian on disk, and used in place on little endian hosts
+SWAP_COLUMNS = sys.byteorder == 'big'
+
+
+def _pad(length):
+    return -length % 8
+
+
+def _littleEndian(col, typecode):
+    if not SWAP_COLUMNS:
+        return col
+    col = array(typecode, col)
+    col.byteswap()
+    return col
+
+
+def isSessionFile(filename):
+    '''
+    is filename one of our binary session files (as opposed to a pickle)?
+    '''
+    with open(filename, 'rb') as f:
+        return f.read(len(SESSION_MAGIC)) == SESSION_MAGIC
+
+
+class SessionFileWriter(object):
+    '''
+    Writes (or appends to) a binary session file.
+    '''
+    def __init__(self, filename, append=False):
+        self.filename = filename
+        exists = append and os.path.exists(filename) and os.path.getsize(filename)
+
+        if exists:
+            if not isSessionFile(filename):
+                raise Exception('%r is not a CanCat binary session file, cannot append' % filename)
+            self._file = open(filename, 'ab')
+
+        else:
+            self._file = open(filename, 'wb')
+            self._file.write(SESSION_HDR.pack(SESSION_MAGIC, SESSION_VERSION, 0, 0))
+
+    def _writeChunk(self, tag, param, parts):
+        length = sum(len(memoryview(part).cast('B')) for part in parts)
+        f = self._file
+        f.write(CHUNK_HDR.pack(tag, param, length))
+        for part in parts:
+            f.write(part)
+        f.write(b'\0' * _pad(length))
+
+    def writeMeta(self, meta):
+        self._writeChunk(b'META', 0, [pickle.dumps(meta)])
+
+    def writeFrames(self, cmd, store, start=None, stop=None):
+        '''
+        write frames start <= idx < stop of a CanMsgStore as one MSGS chunk.
+        start defaults to the oldest frame still in memory
+        '''
+        # one snapshot, the receive thread may compact the store under us
+        cols, evicted, head = store._state
+        if start is None:
+            start = evicted
+        if stop is None or stop > evicted + len(cols.dlcs) - head:
+            stop = evicted + len(cols.dlcs) - head
+        count = stop - start
+        if count <= 0:
+            return 0
+        if start < evicted:
+            raise MsgEvictedError(start, evicted)
+
+        lo = start - evicted + head
+        hi = stop - evicted + head
+
+        base = cols.offsets[lo]
+        end = cols.offsets[hi-1] + cols.dlcs[hi-1]
+        offsets = cols.offsets[lo:hi]
+        if base:
+            offsets = array('Q', (off - base for off in offsets))
+
+        parts = [MSGS_HDR.pack(count, end - base)]
+        columns = (cols.ts[lo:hi], cols.arbids[lo:hi], cols.dlcs[lo:hi], offsets)
+        for (name, typecode), col in zip(COLUMNS, columns):
+            col = memoryview(_littleEndian(col, typecode)).cast('B')
+            parts.append(col)
+            parts.append(b'\0' * _pad(len(col)))
+        parts.append(cols.payload[base:end])
+
+        self._writeChunk(b'MSGS', cmd, parts)
+        return count
+
+    def writeIndex(self, cmd, store, count):
+        '''
+        write the store's per-arbid posting lists for its first count frames.
+        the store may still be growing, so it's left alone (no compaction)
+        '''
+        cols, evicted, head = store._state
+        parts = [AIDX_HDR.pack(count)]
+        for arbid, posting in list(store._getArbidIndex(cols).items()):
+            if head or (len(posting) and posting[-1] >= count):
+                lo = bisect_left(posting, head)
+                hi = bisect_left(posting, head + count)
+                posting = array('I', (pidx - head for pidx in posting[lo:hi]))
+            if not len(posting):
+                continue
+
+            parts.append(POSTING_HDR.pack(arbid, len(posting)))
+            parts.append(memoryview(_littleEndian(posting, 'I')).cast('B'))
+
+        self._writeChunk(b'AIDX', cmd, parts)
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self, sync=False):
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def writeSession(filename, savegame, append_from=None):
+    '''
+    write a saveSession() dict to filename.
+
+    append_from={cmd: count} appends to an existing session file instead: only
+    frames past count are written for each CAN mailbox, plus a fresh META.
+    returns {cmd: count} of frames now in the file, for the next append.
+    '''
+    messages = savegame.get('messages') or {}
+    stores = dict((cmd, mbox) for cmd, mbox in messages.items() if isinstance(mbox, CanMsgStore))
+
+    meta = dict(savegame)
+    meta['messages'] = dict((cmd, mbox) for cmd, mbox in messages.items() if cmd not in stores)
+    meta['file_version'] = float(SESSION_VERSION)
+    meta['start_ts'] = dict((cmd, store.getStartTimestamp()) for cmd, store in stores.items())
+
+    counts = {}
+    if append_from is None:
+        # write next to the old file and swap it in, so stores that are still
+        # mmap'd from it don't lose their pages.  windows won't replace a
+        # mapped file, so copy them into memory there.
+        if os.name == 'nt':
+            for store in stores.values():
+                store._unmap()
+
+        tmpname = filename + '.tmp'
+        writer = SessionFileWriter(tmpname)
+        try:
+            meta['first_idx'] = dict((cmd, store.getFirstIndex()) for cmd, store in stores.items())
+            writer.writeMeta(meta)
+            for cmd, store in stores.items():
+                start = meta['first_idx'][cmd]
+                counts[cmd] = start + writer.writeFrames(cmd, store, start)
+                writer.writeIndex(cmd, store, counts[cmd] - start)
+        finally:
+            writer.close()
+        os.replace(tmpname, filename)
+
+    else:
+        # first_idx is whatever the earlier META said, leave it out
+        writer = SessionFileWriter(filename, append=True)
+        try:
+            for cmd, store in stores.items():
+                start = append_from.get(cmd, 0)
+                counts[cmd] = start + writer.writeFrames(cmd, store, start)
+            writer.writeMeta(meta)
+        finally:
+            writer.close()
+
+    return counts
+
+
+def _readChunks(buf):
+    hdr_magic, version, flags, _ = SESSION_HDR.unpack_from(buf, 0)
+    if hdr_magic != SESSION_MAGIC:
+        raise Exception('not a CanCat session file')
+    if version > SESSION_VERSION:
+        raise Exception('session file version %d is newer than this CanCat (%d)' % (version, SESSION_VERSION))
+
+    off = SESSION_HDR.size
+    while off + CHUNK_HDR.size <= len(buf):
+        tag, param, length = CHUNK_HDR.unpack_from(buf, off)
+        off += CHUNK_HDR.size
+        if off + length > len(buf):
+            # a capture that was cut off mid-chunk.  keep what we have
+            break
+
+        yield tag, param, off, length
+        off += length + _pad(length)
+
+
+def _readColumns(buf, off):
+    count, payload_len = MSGS_HDR.unpack_from(buf, off)
+    off += MSGS_HDR.size
+
+    cols = []
+    for name, typecode in COLUMNS:
+        size = count * array(typecode).itemsize
+        cols.append(buf[off:off+size].cast(typecode))
+        off += size + _pad(size)
+
+    cols.append(buf[off:off+payload_len])
+    return count, cols
+
+
+def _joinColumns(chunks):
+    ts, arbids, dlcs, offsets = [array(typecode) for name, typecode in COLUMNS]
+    payload = bytearray()
+    for count, (cts, carbids, cdlcs, coffsets, cpayload) in chunks:
+        for col, ccol in ((ts, cts), (arbids, carbids), (dlcs, cdlcs)):
+            col.frombytes(ccol.cast('B'))
+
+        chunkoffs = array('Q')
+        chunkoffs.frombytes(coffsets.cast('B'))
+        if SWAP_COLUMNS:
+            chunkoffs.byteswap()
+
+        # offsets are relative to each chunk's payload
+        base = len(payload)
+        if base:
+            chunkoffs = array('Q', (off + base for off in chunkoffs))
+        offsets.extend(chunkoffs)
+        payload += cpayload
+
+    if SWAP_COLUMNS:
+        for col in (ts, arbids, dlcs):
+            col.byteswap()
+
+    return ts, arbids, dlcs, offsets, payload
+
+
+def _indexLoader(buf):
+    def loader():
+        covered, = AIDX_HDR.unpack_from(buf, 0)
+        pos = AIDX_HDR.size
+        arbidx = {}
+        while pos < len(buf):
+            arbid, count = POSTING_HDR.unpack_from(buf, pos)
+            pos += POSTING_HDR.size
+            posting = array('I')
+            posting.frombytes(buf[pos:pos+count*4])
+            if SWAP_COLUMNS:
+                posting.byteswap()
+            arbidx[arbid] = posting
+            pos += count * 4
+
+        return arbidx, covered
+
+    return loader
+
+
+def iterSessionFrames(filename, cmd):
+    '''
+    generator of (timestamp, arbid, data) for a mailbox of a binary session
+    file, a chunk at a time without joining them (for streaming conversions)
+    '''
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    buf = memoryview(mm)
+    for tag, param, off, length in _readChunks(buf):
+        if tag != b'MSGS' or param != cmd:
+            continue
+
+        count, cols = _readColumns(buf, off)
+        if SWAP_COLUMNS:
+            cols = _joinColumns([(count, cols)])
+
+        for idx, ts, arbid, data in CanMsgStore.fromColumns(*cols).iterFrames():
+            yield ts, arbid, data
+
+
+def loadSession(filename):
+    '''
+    open a binary session file, returning a dict like saveSession() made.
+    CAN mailboxes come back as CanMsgStores reading straight from the file.
+    '''
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    buf = memoryview(mm)
+
+    meta = {}
+    first_idx = {}
+    frames = {}
+    indexes = {}
+    for tag, param, off, length in _readChunks(buf):
+        if tag == b'META':
+            meta = pickle.loads(buf[off:off+length])
+            # only full saves record first_idx, appended METAs leave it alone
+            first_idx = meta.get('first_idx', first_idx)
+
+        elif tag == b'MSGS':
+            frames.setdefault(param, []).append(_readColumns(buf, off))
+
+        elif tag == b'AIDX':
+            indexes[param] = buf[off:off+length]
+
+    start_ts = meta.get('start_ts') or {}
+    messages = meta.get('messages') or {}
+    for cmd, chunks in frames.items():
+        if len(chunks) == 1 and not SWAP_COLUMNS:
+            count, cols = chunks[0]
+        else:
+            cols = _joinColumns(chunks)
+
+        loader = None
+        if cmd in indexes:
+            loader = _indexLoader(indexes[cmd])
+
+        store = CanMsgStore.fromColumns(*cols, arbidx_loader=loader, first_idx=first_idx.get(cmd, 0))
+        store._start_ts = start_ts.get(cmd)
+        messages[cmd] = store
+
+    meta['messages'] = messages
+    meta['first_idx'] = first_idx
+    return meta
@@ -0,0 +1,280 @@
+'''
+Per arbitration ID session statistics.
+
+getArbidStats() takes a capture as three columns (timestamps, arbids, dlcs),
+groups it by arbid and works out, for each one:
+
+    count, first_ts, last_ts
+    mean/median/stddev/min/max of the time between messages (the period)
+    percentiles of the period
+    jitter: mean difference between consecutive periods
+    dlcs: histogram of message lengths {dlc: count}
+
+With NumPy installed this is done in a handful of vectorized passes over the
+whole capture (millions of frames in well under a second).  Without it, the
+same numbers are worked out one arbid at a time in plain python.  NumPy is
+optional: pip install numpy (or cancat[stats]).
+
+Periods of an arbid seen once are 0, like the old session stats.
+
+LiveStats is the running version: per arbid aggregates updated as each
+frame arrives (O(1), Welford's algorithm for the period mean/variance), so
+the stats of a live capture never have to rescan it.
+'''
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STATS_PERCENTILES = (5, 25, 75, 95, 99)
+LIVE_STATS_HEADER = 'Arbitration ID   Msg Count    Timing (mean/high/low/stddev)                 Changes  Last Data'
+
+# CAN-FD frames go up to 64 bytes
+MAX_DLC = 64
+
+
+def _emptyStats(count, first_ts, last_ts, percentiles):
+    return {'count': count,
+            'first_ts': first_ts,
+            'last_ts': last_ts,
+            'mean': 0.0,
+            'median': 0.0,
+            'stddev': 0.0,
+            'min': 0.0,
+            'max': 0.0,
+            'jitter': 0.0,
+            'percentiles': dict((p, 0.0) for p in percentiles),
+            'dlcs': {},
+            }
+
+
+def _percentile(ordered, pct):
+    '''
+    linear interpolation between closest ranks (numpy's default)
+    '''
+    pos = pct / 100.0 * (len(ordered) - 1)
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(ordered) - 1)
+    frac = pos - lo
+    return ordered[lo] * (1 - frac) + ordered[hi] * frac
+
+
+def _arbidStatsPython(ts, arbids, dlcs, percentiles):
+    groups = {}
+    for tstamp, arbid, dlc in zip(ts, arbids, dlcs):
+        group = groups.get(arbid)
+        if group is None:
+            group = groups[arbid] = (array('d'), {})
+        group[0].append(tstamp)
+        hist = group[1]
+        dlc = min(dlc, MAX_DLC)
+        hist[dlc] = hist.get(dlc, 0) + 1
+
+    stats = {}
+    for arbid, (times, hist) in groups.items():
+        stat = _emptyStats(len(times), times[0], times[-1], percentiles)
+        stat['dlcs'] = hist
+        stats[arbid] = stat
+        if len(times) < 2:
+            continue
+
+        deltas = [times[x] - times[x-1] for x in range(1, len(times))]
+        mean = sum(deltas) / len(deltas)
+        ordered = sorted(deltas)
+        stat['mean'] = mean
+        stat['median'] = _percentile(ordered, 50)
+        stat['stddev'] = math.sqrt(sum((d - mean) ** 2 for d in deltas) / len(deltas))
+        stat['min'] = ordered[0]
+        stat['max'] = ordered[-1]
+        stat['percentiles'] = dict((p, _percentile(ordered, p)) for p in percentiles)
+        if len(deltas) > 1:
+            stat['jitter'] = sum(abs(deltas[x] - deltas[x-1]) for x in range(1, len(deltas))) / (len(deltas) - 1)
+
+    return stats
+
+
+def _column(col, dtype):
+    # arrays and memoryviews carry their own item format
+    return numpy.asarray(col).astype(dtype, copy=False)
+
+
+def _factorize(arbids):
+    '''
+    returns (keys, codes): codes[x] is the index into keys of arbids[x]
+    '''
+    if isinstance(arbids, (array, memoryview)):
+        return numpy.unique(_column(arbids, numpy.uint32), return_inverse=True)
+
+    # anything hashable, eg. J1939 arbtups
+    keys = []
+    lookup = {}
+    codes = numpy.empty(len(arbids), dtype=numpy.intp)
+    for x, arbid in enumerate(arbids):
+        code = lookup.get(arbid)
+        if code is None:
+            code = lookup[arbid] = len(keys)
+            keys.append(arbid)
+        codes[x] = code
+    return keys, codes
+
+
+def _arbidStatsNumpy(ts, arbids, dlcs, percentiles):
+    keys, codes = _factorize(arbids)
+    ngroups = len(keys)
+    ts = _column(ts, numpy.float64)
+    dlcs = _column(dlcs, numpy.intp)
+
+    # group the frames, in time order within each arbid
+    order = numpy.argsort(codes, kind='stable')
+    groups = codes[order]
+    times = ts[order]
+    counts = numpy.bincount(groups, minlength=ngroups)
+    ends = numpy.cumsum(counts)
+    starts = ends - counts
+
+    # periods, leaving out the ones spanning two arbids
+    same = groups[1:] == groups[:-1]
+    deltas = numpy.diff(times)[same]
+    dgroups = groups[1:][same]
+    ndeltas = counts - 1
+    valid = ndeltas > 0
+    safe_n = numpy.maximum(ndeltas, 1)
+
+    mean = numpy.bincount(dgroups, weights=deltas, minlength=ngroups) / safe_n
+    dev = deltas - mean[dgroups]
+    stddev = numpy.sqrt(numpy.bincount(dgroups, weights=dev * dev, minlength=ngroups) / safe_n)
+
+    # jitter: consecutive periods of the same arbid
+    same = dgroups[1:] == dgroups[:-1]
+    jitter = numpy.bincount(dgroups[1:][same], weights=numpy.abs(numpy.diff(deltas))[same], minlength=ngroups)
+    jitter /= numpy.maximum(ndeltas - 1, 1)
+
+    # order statistics: sort the periods within each arbid
+    ordered = deltas[numpy.lexsort((deltas, dgroups))]
+    dstarts = numpy.cumsum(ndeltas) - ndeltas
+
+    def percentile(pct):
+        pos = pct / 100.0 * (safe_n - 1)
+        lo = numpy.floor(pos).astype(numpy.intp)
+        hi = numpy.minimum(lo + 1, safe_n - 1)
+        frac = pos - lo
+        if not len(ordered):
+            return numpy.zeros(ngroups)
+        lo = numpy.minimum(dstarts + lo, len(ordered) - 1)
+        hi = numpy.minimum(dstarts + hi, len(ordered) - 1)
+        return numpy.where(valid, ordered[lo] * (1 - frac) + ordered[hi] * frac, 0.0)
+
+    median = percentile(50)
+    lows = percentile(0)
+    highs = percentile(100)
+    pcts = [(p, percentile(p)) for p in percentiles]
+
+    # dlc histogram, one row per arbid
+    hist = numpy.bincount(codes * (MAX_DLC + 1) + numpy.minimum(dlcs, MAX_DLC),
+                          minlength=ngroups * (MAX_DLC + 1)).reshape(ngroups, MAX_DLC + 1)
+
+    stats = {}
+    for x, arbid in enumerate(keys):
+        if isinstance(arbid, numpy.integer):
+            arbid = int(arbid)
+        stat = _emptyStats(int(counts[x]), float(times[starts[x]]), float(times[ends[x] - 1]), percentiles)
+        stat['dlcs'] = dict((int(dlc), int(hist[x, dlc])) for dlc in numpy.flatnonzero(hist[x]))
+        stats[arbid] = stat
+        if not valid[x]:
+            continue
+
+        stat['mean'] = float(mean[x])
+        stat['median'] = float(median[x])
+        stat['stddev'] = float(stddev[x])
+        stat['min'] = float(lows[x])
+        stat['max'] = float(highs[x])
+        stat['jitter'] = float(jitter[x])
+        stat['percentiles'] = dict((p, float(vals[x])) for p, vals in pcts)
+
+    return stats
+
+
+def getArbidStats(ts, arbids, dlcs, percentiles=STATS_PERCENTILES, use_numpy=True):
+    '''
+    returns {arbid: stats dict} (see module doc) for a capture given as
+    timestamp, arbid and dlc columns (arrays, buffers or lists).  arbids
+    may be anything hashable.
+    '''
+    if not len(ts):
+        return {}
+
+    if numpy is not None and use_numpy:
+        return _arbidStatsNumpy(ts, arbids, dlcs, percentiles)
+
+    return _arbidStatsPython(ts, arbids, dlcs, percentiles)
+
+
+# LiveStats entry fields
+(LS_COUNT, LS_FIRST, LS_LAST, LS_MIN, LS_MAX, LS_MEAN, LS_M2, LS_DATA, LS_CHANGES) = range(9)
+
+
+class LiveStats(object):
+    '''
+    running per arbid stats, fed one frame at a time from the receive thread
+    '''
+    def __init__(self):
+        # arbid -> [count, first ts, last ts, min/max/mean/M2 of the period,
+        #           last data, number of times the data changed]
+        self._stats = {}
+
+    def update(self, ts, arbid, data):
+        entry = self._stats.get(arbid)
+        if entry is None:
+            self._stats[arbid] = [1, ts, ts, 0.0, 0.0, 0.0, 0.0, data, 0]
+            return
+
+        count = entry[LS_COUNT]
+        delta = ts - entry[LS_LAST]
+        if count == 1:
+            entry[LS_MIN] = entry[LS_MAX] = delta
+        elif delta < entry[LS_MIN]:
+            entry[LS_MIN] = delta
+        elif delta > entry[LS_MAX]:
+            entry[LS_MAX] = delta
+
+        # count frames so far means count periods with this one
+        diff = delta - entry[LS_MEAN]
+        entry[LS_MEAN] += diff / count
+        entry[LS_M2] += diff * (delta - entry[LS_MEAN])
+
+        if data != entry[LS_DATA]:
+            entry[LS_DATA] = data
+            entry[LS_CHANGES] += 1
+
+        entry[LS_LAST] = ts
+        entry[LS_COUNT] = count + 1
+
+    def clear(self):
+        self._stats = {}
+
+    def __len__(self):
+        return len(self._stats)
+
+    def getStats(self):
+        '''
+        returns {arbid: {count, first_ts, last_ts, mean, stddev, min, max,
+        last_data, changes}}, timestamps as received (time.time())
+        '''
+        stats = {}
+        for arbid, entry in list(self._stats.items()):
+            count, first, last, low, high, mean, m2, data, changes = entry
+            periods = max(count - 1, 1)
+            stats[arbid] = {'count': count,
+                            'first_ts': first,
+                            'last_ts': last,
+                            'mean': mean,
+                            'stddev': math.sqrt(m2 / periods),
+                            'min': low,
+                            'max': high,
+                            'last_data': data,
+                            'changes': changes,
+                            }
+        return stats
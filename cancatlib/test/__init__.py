@@ -59,6 +59,7 @@ CMD_CAN_SEND_ISOTP_RESULT      = 0x38
 CMD_CAN_RECV_ISOTP_RESULT      = 0x39
 CMD_CAN_SENDRECV_ISOTP_RESULT  = 0x3A
 CMD_PRINT_CAN_REGS             = 0x3C
+CMD_CAN_SEND_BATCH_RESULT      = 0x3D
 
 CMD_PING                = 0x41
 CMD_CHANGE_BAUD         = 0x42
@@ -71,6 +72,7 @@ CMD_CAN_MODE_CITM       = 0x02
 CMD_CAN_SEND_ISOTP      = 0x46
 CMD_CAN_RECV_ISOTP      = 0x47
 CMD_CAN_SENDRECV_ISOTP  = 0x48
+CMD_CAN_SEND_BATCH      = 0x49
 
 
 class FakeCanCat:
@@ -90,6 +92,10 @@ class FakeCanCat:
         self._fake_can_msgs = queue.Queue()
 
         self.start_ts = time.time()
+        # (arbid, extflag, data) of every frame sent in a CMD_CAN_SEND_BATCH,
+        # and the size of each batch
+        self.sent_frames = []
+        self.sent_batches = []
 
         self._go = True
         self._runner_sleep_delay = 0
@@ -105,7 +111,8 @@ class FakeCanCat:
         self._inq.put(packet)
 
     def log(self, msg):
-        self.CanCat_send(CMD_LOG, b"FakeCanCat: " + msg)
+        # packets have a one byte length, like the real thing
+        self.CanCat_send(CMD_LOG, (b"FakeCanCat: " + msg)[:254])
     def logHex(self, num):
         self.CanCat_send(CMD_LOG_HEX, struct.pack(b"<I", num))
     def logHexStr(self, num, prefix):
@@ -163,6 +170,11 @@ class FakeCanCat:
 
 
     #### FAKE SERIAL DEVICE (interface to Python)
+    @property
+    def in_waiting(self):
+        # mimic pyserial: bytes we can hand back without blocking
+        return len(self._inbuf)
+
     def read(self, count=1):
         if len(self._inbuf) < count:
             empty = False
@@ -214,7 +226,22 @@ class FakeCanCat:
         elif cmd == CMD_CAN_SEND:
             logger.info(b'=CMD_CAN_SEND:%r=' % data)
             self.log(b'=CMD_CAN_SEND:%r=' % data)
-            self.CanCat_send(CMD_CAN_SEND_RESULT, b'\x01')
+            arbid, extflag = struct.unpack('>IB', data[:5])
+            self.sent_frames.append((arbid, extflag, data[5:]))
+            self.CanCat_send(CMD_CAN_SEND_RESULT, b'\x00')
+
+        elif cmd == CMD_CAN_SEND_BATCH:
+            logger.info(b'=CMD_CAN_SEND_BATCH:%r=' % data)
+            self.log(b'=CMD_CAN_SEND_BATCH:%r=' % data)
+            # [count] then [arbid][extflag][len][data] per frame, one result each
+            count = data[0]
+            self.sent_batches.append(count)
+            idx = 1
+            for x in range(count):
+                arbid, extflag, dlc = struct.unpack('>IBB', data[idx:idx+6])
+                self.sent_frames.append((arbid, extflag, data[idx+6:idx+6+dlc]))
+                idx += 6 + dlc
+            self.CanCat_send(CMD_CAN_SEND_BATCH_RESULT, b'\x00' * count)
 
         elif cmd == CMD_SET_FILT_MASK:
             logger.info(b'=CMD_SET_FILT_MASK:%r=' % data)
@@ -1,8 +1,15 @@
+import os
+import time
+import shutil
+import tempfile
+import struct
+import threading
+import queue
 import logging
 import unittest
 
 from cancatlib import *
-from cancatlib import CanInterface
+from cancatlib import CanInterface, capture
 from cancatlib.test import test_messages
 from cancatlib.utils.types import ECUAddress
 
@@ -26,3 +33,567 @@ class CanCat_test(unittest.TestCase):
         msg = next(c.CANrecv())
 
         # test the rest of the CanCat interface
+
+    def test_rx_resync_on_garbage(self):
+        c = CanInterface(port='FakeCanCat')
+
+        # two CAN frames glued together with junk before, between and after
+        frame0 = b'\x00\x00\x07\xe8\x02\x50\x01'
+        frame1 = b'\x18\xda\xf1\x10\x03\x62\xf1\x90'
+        blob = b'junk' + b'@%c%c%s' % (len(frame0)+1, CMD_CAN_RECV, frame0)
+        blob += b'\x00@\x00' + b'@%c%c%s' % (len(frame1)+1, CMD_CAN_RECV, frame1) + b'tail'
+        c._io._inq.put(blob)
+
+        for x in range(20):
+            if c.getCanMsgCount() >= 2:
+                break
+            time.sleep(.1)
+
+        msgs = [(arbid, data) for idx, ts, arbid, data in c.genCanMsgs()]
+        self.assertEqual(msgs, [(0x7e8, b'\x02\x50\x01'), (0x18daf110, b'\x03\x62\xf1\x90')])
+
+        # and we're still in sync for the next command/response
+        self.assertEqual(c.ping(b'sync')[1], b'sync')
+
+    def test_isotp_get_msg_wakeup(self):
+        c = CanInterface(port='FakeCanCat')
+
+        def canpkt(arbid, data):
+            frame = struct.pack('>I', arbid) + data
+            return b'@%c%c%s' % (len(frame)+1, CMD_CAN_RECV, frame)
+
+        pending = canpkt(0x7e8, b'\x03\x7f\x22\x78\x00\x00\x00\x00')
+        vin = b'\x62\xf1\x901FTEW1EP5JKD12345'
+        response = canpkt(0x7e8, b'\x02\x7e\x00\x00\x00\x00\x00\x00')     # TesterPresent, ignored
+        response += canpkt(0x7e8, b'\x10%c' % len(vin) + vin[:6])
+        response += canpkt(0x7df, b'\x02\x3e\x00\x00\x00\x00\x00\x00')     # someone else
+        for seq, off in enumerate(range(6, len(vin), 7)):
+            response += canpkt(0x7e8, b'%c' % (0x21 + seq) + vin[off:off+7])
+
+        threading.Timer(.2, c._io._inq.put, (pending,)).start()
+        threading.Timer(.5, c._io._inq.put, (response,)).start()
+
+        msg, idx = c.ISOTPxmit_recv(0x7e0, 0x7e8, b'\x22\xf1\x90', service=0x22, timeout=3)
+        self.assertEqual(msg[:3], b'\x7f\x22\x78')
+
+        starttime = time.time()
+        msg, idx = c._isotp_get_msg(0x7e8, start_index=idx+1, service=0x62, timeout=3)
+        self.assertEqual(msg, vin)
+        self.assertLess(time.time() - starttime, 1)
+        self.assertEqual(c._isotp_waiters, {})
+
+        # nothing more is coming: times out
+        msg, nextidx = c._isotp_get_msg(0x7e8, start_index=idx+1, timeout=.2)
+        self.assertEqual(msg, None)
+
+    def test_session_file(self):
+        c = CanInterface(port='FakeCanCat')
+        c._io.queueCanMessages(test_messages.test_j1939_msgs_0)
+        total = len(test_messages.test_j1939_msgs_0)
+        for x in range(50):
+            if c.getCanMsgCount() >= total:
+                break
+            time.sleep(.1)
+
+        c.placeCanBookmark('first', 'before the second batch')
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, 'session.cancat')
+        c.saveSessionToFile(filename)
+
+        # loads in place from the file
+        s = CanInterface(load_filename=filename)
+        self.assertTrue(s._messages[CMD_CAN_RECV]._mapped)
+        self.assertEqual(list(s.genCanMsgs()), list(c.genCanMsgs()))
+        self.assertEqual(s.bookmarks, c.bookmarks)
+        self.assertEqual(s.bookmark_info, c.bookmark_info)
+
+        # keep capturing, saving again only appends the new frames
+        size = os.path.getsize(filename)
+        c._io.queueCanMessages(test_messages.test_j1939_msgs_1[:50])
+        for x in range(50):
+            if c.getCanMsgCount() >= total + 50:
+                break
+            time.sleep(.1)
+
+        self.assertEqual(c._sessionAppendFrom(filename, c._messages), {CMD_CAN_RECV: total})
+        c.saveSessionToFile()
+        self.assertLess(os.path.getsize(filename) - size, size)
+
+        s = CanInterface(load_filename=filename)
+        self.assertEqual(list(s.genCanMsgs()), list(c.genCanMsgs()))
+        arbids = [0x0cf00300, 0x18fef100]
+        self.assertEqual(list(s.genCanMsgs(arbids=arbids)), list(c.genCanMsgs(arbids=arbids)))
+
+        # and the old pickle format still loads
+        c.saveSessionToFile(filename + '.pkl', pickled=True)
+        s = CanInterface(load_filename=filename + '.pkl')
+        self.assertEqual(list(s.genCanMsgs()), list(c.genCanMsgs()))
+        shutil.rmtree(tmpdir)
+
+    def test_capture_segments(self):
+        c = CanInterface(port='FakeCanCat')
+        tmpdir = tempfile.mkdtemp()
+        basename = os.path.join(tmpdir, 'capture')
+        # flushed by hand rather than from the writer thread
+        writer = capture.CaptureWriter(c, basename, CMD_CAN_RECV, segment_bytes=1024, window=20)
+
+        total = 0
+        for batch in (test_messages.test_j1939_msgs_0, test_messages.test_j1939_msgs_1[:100]):
+            c._io.queueCanMessages(batch)
+            total += len(batch)
+            for x in range(50):
+                if c.getCanMsgCount() >= total:
+                    break
+                time.sleep(.1)
+            writer.flush()
+
+        writer._closeSegment()
+        store = c._messages[CMD_CAN_RECV]
+        self.assertEqual(len(store), total)
+        self.assertEqual(store.getFirstIndex(), total - 20)
+        self.assertGreater(len(writer.filenames), 1)
+
+        # evicted frames are read back from the segments, indexes unchanged
+        msgs = list(c.genCanMsgs())
+        self.assertEqual([idx for idx, ts, arbid, data in msgs], list(range(total)))
+        self.assertEqual([data for idx, ts, arbid, data in msgs[:10]],
+                         [raw[4:] for ts, raw in test_messages.test_j1939_msgs_0[:10]])
+        arbids = [0x0cf00300, 0x18fef100]
+        self.assertEqual(list(c.genCanMsgs(arbids=arbids)),
+                         [msg for msg in msgs if msg[2] in arbids])
+
+        # every segment is a session of its own, starting at its first index
+        firstidx, filename = writer.archive.getSegments()[1]
+        s = CanInterface(load_filename=filename)
+        self.assertEqual(next(s.genCanMsgs()), msgs[firstidx])
+
+        # and through the interface, with the writer thread
+        c.clearCanMsgs()
+        c.startCapture(basename + '2', window=5)
+        c._io.queueCanMessages(test_messages.test_j1939_msgs_0)
+        count = len(test_messages.test_j1939_msgs_0)
+        for x in range(50):
+            if c.getCanMsgCount() >= count:
+                break
+            time.sleep(.1)
+        self.assertEqual(c.stopCapture(), [basename + '2.0000.cancat'])
+        self.assertEqual(c._messages[CMD_CAN_RECV].getFirstIndex(), count - 5)
+        self.assertEqual(len(list(c.genCanMsgs())), count)
+
+        shutil.rmtree(tmpdir)
+
+    def test_max_msgs_ring(self):
+        c = CanInterface(port='FakeCanCat', max_msgs=50)
+        msgs = test_messages.test_j1939_msgs_0
+        c.placeCanBookmark('start')
+        c._io.queueCanMessages(msgs)
+        for x in range(50):
+            if c.getCanMsgCount() >= len(msgs):
+                break
+            time.sleep(.1)
+
+        # indexes keep counting, only the newest 50 are left
+        self.assertEqual(c.getCanMsgCount(), len(msgs))
+        self.assertEqual(c.getOldestMsgIndex(), len(msgs) - 50)
+        self.assertEqual(len(c._messages[CMD_CAN_RECV]._dlcs) - c._messages[CMD_CAN_RECV]._head, 50)
+
+        gen = list(c.genCanMsgs())
+        self.assertEqual([idx for idx, ts, arbid, data in gen], list(range(len(msgs) - 50, len(msgs))))
+        self.assertEqual(gen[-1][3], msgs[-1][1][4:])
+        self.assertEqual(list(c.genCanMsgs(10, 12)), [])
+        self.assertEqual(list(c.genCanMsgs(arbids=[0x0cf00300])), [msg for msg in gen if msg[2] == 0x0cf00300])
+        self.assertRaises(MsgEvictedError, c._messages[CMD_CAN_RECV].getFrame, 0)
+        self.assertEqual(c.getMsgIndexFromBookmark(0), 0)
+
+        # recv() takes the oldest without renumbering the rest
+        self.assertEqual(c.recv(CMD_CAN_RECV, wait=1)[1], msgs[-50][1])
+        self.assertEqual(c.getOldestMsgIndex(), len(msgs) - 49)
+        self.assertEqual(c.getCanMsgCount(), len(msgs))
+
+    def test_session_stats(self):
+        c = CanInterface(port='FakeCanCat')
+        c._io.queueCanMessages(test_messages.test_j1939_msgs_0)
+        total = len(test_messages.test_j1939_msgs_0)
+        for x in range(50):
+            if c.getCanMsgCount() >= total:
+                break
+            time.sleep(.1)
+
+        def brute(start, stop):
+            periods = {}
+            last = {}
+            for idx, ts, arbid, data in c.genCanMsgs(start, stop):
+                if arbid in last:
+                    periods.setdefault(arbid, []).append(ts - last[arbid])
+                else:
+                    periods.setdefault(arbid, [])
+                last[arbid] = ts
+            return periods
+
+        for start, stop in ((0, None), (100, 250)):
+            stats = c.getArbidStats(start, stop)
+            periods = brute(start, stop)
+            self.assertEqual(sorted(stats), sorted(periods))
+            for arbid, deltas in periods.items():
+                stat = stats[arbid]
+                self.assertEqual(stat['count'], len(deltas) + 1)
+                if not deltas:
+                    continue
+                deltas.sort()
+                mid = len(deltas) // 2
+                median = deltas[mid] if len(deltas) % 2 else (deltas[mid-1] + deltas[mid]) / 2
+                self.assertAlmostEqual(stat['median'], median)
+                self.assertAlmostEqual(stat['mean'], sum(deltas) / len(deltas))
+                self.assertAlmostEqual(stat['max'], deltas[-1])
+                self.assertAlmostEqual(stat['min'], deltas[0])
+                self.assertEqual(sum(stat['dlcs'].values()), stat['count'])
+
+        self.assertIn('Total Messages: %d' % total, c.getSessionStats())
+        c.placeCanBookmark('end')
+        self.assertEqual(c.getSessionStatsByBookmark(stop=0), c.getSessionStats(stop=total))
+
+    def test_live_stats(self):
+        c = CanInterface(port='FakeCanCat')
+        c._io.queueCanMessages(test_messages.test_j1939_msgs_0)
+        total = len(test_messages.test_j1939_msgs_0)
+        for x in range(50):
+            if c.getCanMsgCount() >= total:
+                break
+            time.sleep(.1)
+
+        # kept on receive, same numbers as working it out from the capture
+        live = c.getLiveStats()
+        stats = c.getArbidStats()
+        self.assertEqual(sorted(live), sorted(stats))
+        for arbid, stat in stats.items():
+            self.assertEqual(live[arbid]['count'], stat['count'])
+            for field in ('mean', 'stddev', 'min', 'max'):
+                self.assertAlmostEqual(live[arbid][field], stat[field])
+
+        changes = {}
+        last = {}
+        for idx, ts, arbid, data in c.genCanMsgs():
+            if arbid in last and data != last[arbid]:
+                changes[arbid] = changes.get(arbid, 0) + 1
+            last[arbid] = data
+        for arbid, stat in live.items():
+            self.assertEqual(stat['changes'], changes.get(arbid, 0))
+            self.assertEqual(stat['last_data'], last[arbid])
+
+        self.assertIn('Total Messages: %d' % total, c.reprLiveStats())
+        c.clearCanMsgs()
+        self.assertEqual(c.getLiveStats(), {})
+
+    def test_genCanMsgs_arbids(self):
+        c = getLoadedFakeCanCatInterface()
+        total = len(test_messages.test_j1939_msgs_0) + len(test_messages.test_j1939_msgs_1)
+        for x in range(50):
+            if c.getCanMsgCount() >= total:
+                break
+            time.sleep(.1)
+
+        arbids = [0x0cf00300, 0x18fef100]
+        everything = list(c.genCanMsgs())
+        expected = [msg for msg in everything if msg[2] in arbids]
+        self.assertTrue(len(expected))
+        self.assertEqual(list(c.genCanMsgs(arbids=arbids)), expected)
+        self.assertEqual(list(c.genCanMsgs(start=10, stop=100, arbids=arbids)),
+                         [msg for msg in expected if 10 <= msg[0] <= 100])
+
+        # the index goes away with the messages it indexed
+        c.clearCanMsgs()
+        self.assertEqual(list(c.genCanMsgs(arbids=arbids)), [])
+
+    def test_xmit_batch(self):
+        c = CanInterface(port='FakeCanCat')
+        fake = c._io
+        frames = [(0x700 + x % 7, struct.pack('>H', x) * (x % 5)) for x in range(300)]
+
+        # batches are opt-in: nothing is sent to find out whether they work
+        self.assertEqual(c.CANxmitBatch(frames[:5]), [CAN_RESP_OK] * 5)
+        self.assertEqual(fake.sent_batches, [])
+        fake.sent_frames[:] = []
+
+        # the fake takes batches: 128 + 128 + 44, a result for each frame
+        c.batch_xmit = True
+        results = c.CANxmitBatch(frames)
+        self.assertEqual(results, [CAN_RESP_OK] * len(frames))
+        self.assertEqual(fake.sent_batches, [128, 128, 44])
+        self.assertEqual([(arbid, data) for arbid, extflag, data in fake.sent_frames], frames)
+
+        # one CMD_CAN_SEND per frame, pipelined
+        sends = []
+        fake_write = fake.write
+        def write(msg):
+            if msg[2] == CMD_CAN_SEND:
+                sends.append(msg)
+            fake_write(msg)
+        fake.write = write
+
+        results = c.CANxmitBatch(frames[:20], extflag=1, batch=False, window=4)
+        self.assertEqual(results, [CAN_RESP_OK] * 20)
+        self.assertEqual(sends, [struct.pack('>HBIB', len(data) + 8, CMD_CAN_SEND, arbid, 1) + data
+                                 for arbid, data in frames[:20]])
+
+    def test_xmit_batch_late(self):
+        c = CanInterface(port='FakeCanCat')
+        c.ping(b'x')
+        fake = c._io
+        fake_write = fake.write
+        sends = []
+        late = queue.Queue()
+
+        def send_late():
+            # in order, like the transceiver
+            for when, result in iter(late.get, None):
+                time.sleep(max(0, when - time.time()))
+                fake.CanCat_send(CMD_CAN_SEND_RESULT, result)
+        sender = threading.Thread(target=send_late, daemon=True)
+        sender.start()
+
+        # each result is the number of the frame it's for.  from the 4th frame
+        # on the transceiver falls behind, past the timeout
+        def write(msg):
+            if msg[2] != CMD_CAN_SEND:
+                return fake_write(msg)
+            result = bytes([len(sends)])
+            sends.append(msg)
+            if len(sends) > 3:
+                late.put((time.time() + .3, result))
+            else:
+                fake.CanCat_send(CMD_CAN_SEND_RESULT, result)
+        fake.write = write
+
+        # another thread's CANxmit() while the burst is going waits its turn,
+        # and doesn't get one of the late results
+        xmit = []
+        t = threading.Timer(.1, lambda: xmit.append(c.CANxmit(0x123, b'next', timeout=1)))
+        t.start()
+
+        frames = [(0x700, struct.pack('>H', x)) for x in range(10)]
+        try:
+            results = c.CANxmitBatch(frames, timeout=.2, window=4)
+            t.join()
+        finally:
+            late.put(None)
+
+        # the late ones are waited for, and nothing more goes out after them
+        self.assertEqual(results, list(range(7)) + [None] * 3)
+        self.assertEqual(xmit, [7])
+        self.assertEqual(c.recv(CMD_CAN_SEND_RESULT, 0), (None, None))
+
+    def test_recv_wakeup(self):
+        c = CanInterface(port='FakeCanCat')
+        cmd = 0x60
+
+        # nothing there: times out
+        start = time.time()
+        self.assertEqual(c.recv(cmd, .1), (None, None))
+        self.assertGreaterEqual(time.time() - start, .1)
+
+        # woken by the message being filed, oldest first
+        def submit():
+            time.sleep(.1)
+            c._submitMessage(cmd, (1.0, b'one'))
+            c._submitMessage(cmd, (2.0, b'two'))
+        threading.Thread(target=submit).start()
+
+        self.assertEqual(c.recv(cmd, 5), (1.0, b'one'))
+        self.assertEqual(c.recv(cmd, 5), (2.0, b'two'))
+        self.assertEqual(len(c._messages[cmd]), 0)
+
+        # command/response exchanges through the receive thread
+        for x in range(5):
+            self.assertEqual(c.ping(b'%d' % x)[1], b'%d' % x)
+
+    def test_isotp_host(self):
+        from cancatlib import iso_tp
+
+        c = CanInterface(port='FakeCanCat')
+        c.host_isotp = True
+        fake = c._io
+        fake_write = fake.write
+        # two ECUs, which take 2 frames per flow control and answer late
+        ecus = {0x7e0: 0x7e8, 0x7e1: 0x7e9}
+        requests = {}
+        pending = {}
+        fcs = []
+        firmware = []
+
+        def frame(arbid, data):
+            fake.CanCat_send(CMD_CAN_RECV, struct.pack('>I', arbid) + data.ljust(8, b'\x00'))
+
+        def answer(tx_arbid, req):
+            resp = struct.pack('>BH', req[0] + 0x40, tx_arbid) + req[1:] + bytes(range(20))
+            frames = iso_tp.msg_encode(resp)
+            pending[tx_arbid] = frames[1:]
+            frame(ecus[tx_arbid], frames[0])
+
+        def write(msg):
+            fake_write(msg)
+            if msg[2] in (CMD_CAN_SEND_ISOTP, CMD_CAN_RECV_ISOTP, CMD_CAN_SENDRECV_ISOTP):
+                firmware.append(msg)
+            if msg[2] != CMD_CAN_SEND:
+                return
+
+            arbid, extflag, data = fake.sent_frames[-1]
+            if arbid not in ecus:
+                return
+
+            ftype = data[0] >> 4
+            if ftype == 0:
+                req = data[1:1+data[0]]
+            elif ftype == 1:
+                requests[arbid] = [struct.unpack('>H', data[:2])[0] & 0xfff, data[2:], 0]
+                frame(ecus[arbid], b'\x30\x02\x00')
+                return
+            elif ftype == 2:
+                length, req, count = requests[arbid]
+                req += data[1:]
+                count += 1
+                requests[arbid] = [length, req, count]
+                if len(req) < length:
+                    if count % 2 == 0:
+                        frame(ecus[arbid], b'\x30\x02\x00')
+                    return
+                req = req[:length]
+            elif ftype == 3:
+                # our flow control: the rest of the response
+                fcs.append(arbid)
+                for cf in pending.pop(arbid):
+                    frame(ecus[arbid], cf)
+                return
+
+            threading.Timer(.2, answer, (arbid, req)).start()
+
+        fake.write = write
+
+        msg, idx = c.ISOTPxmit_recv(0x7e0, 0x7e8, b'\x22\xf1\x90', timeout=2)
+        self.assertEqual(msg, b'\x62\x07\xe0\xf1\x90' + bytes(range(20)))
+        self.assertEqual(fcs, [0x7e0])
+
+        # a request that takes flow control too
+        data = bytes(range(0x30, 0x50))
+        msg, idx = c.ISOTPxmit_recv(0x7e1, 0x7e9, b'\x2e' + data, timeout=2)
+        self.assertEqual(msg, b'\x6e\x07\xe1' + data + bytes(range(20)))
+        self.assertEqual(fcs, [0x7e0, 0x7e1])
+
+        # both at once, neither mixes up the other's frames
+        results = {}
+        def exchange(tx_arbid):
+            results[tx_arbid] = c.ISOTPxmit_recv(tx_arbid, ecus[tx_arbid], b'\x22\xf1\x90', timeout=2)[0]
+        threads = [threading.Thread(target=exchange, args=(arbid,)) for arbid in ecus]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for arbid in ecus:
+            self.assertEqual(results[arbid], b'\x62' + struct.pack('>H', arbid) + b'\xf1\x90' + bytes(range(20)))
+        self.assertEqual(firmware, [])
+
+    def test_async_interface(self):
+        import asyncio
+        from cancatlib import iso_tp
+        from cancatlib.asynccan import AsyncCanInterface
+
+        c = CanInterface(port='FakeCanCat')
+        c.ping(b'x')
+        fake = c._io
+        fake_write = fake.write
+        ecus = dict((0x700 + x, 0x780 + x) for x in range(20))
+        requests = {}
+        pending = {}
+
+        def frame(arbid, data):
+            fake.CanCat_send(CMD_CAN_RECV, struct.pack('>I', arbid) + data.ljust(8, b'\x00'))
+
+        def answer(tx_arbid, req):
+            resp = struct.pack('>BH', req[0] + 0x40, tx_arbid) + req[1:] + bytes(range(20))
+            frames = iso_tp.msg_encode(resp)
+            pending[tx_arbid] = frames[1:]
+            frame(ecus[tx_arbid], frames[0])
+
+        def write(msg):
+            fake_write(msg)
+            if msg[2] != CMD_CAN_SEND:
+                return
+
+            arbid, extflag, data = fake.sent_frames[-1]
+            if arbid not in ecus:
+                return
+
+            ftype = data[0] >> 4
+            if ftype == 0:
+                req = data[1:1+data[0]]
+            elif ftype == 1:
+                requests[arbid] = [struct.unpack('>H', data[:2])[0] & 0xfff, data[2:], 0]
+                frame(ecus[arbid], b'\x30\x02\x00')
+                return
+            elif ftype == 2:
+                length, req, count = requests[arbid]
+                req += data[1:]
+                count += 1
+                requests[arbid] = [length, req, count]
+                if len(req) < length:
+                    if count % 2 == 0:
+                        frame(ecus[arbid], b'\x30\x02\x00')
+                    return
+                req = req[:length]
+            elif ftype == 3:
+                for cf in pending.pop(arbid):
+                    frame(ecus[arbid], cf)
+                return
+
+            threading.Timer(.1, answer, (arbid, req)).start()
+
+        fake.write = write
+
+        async def main():
+            ac = AsyncCanInterface(c)
+
+            # more transmits than the transceiver's window
+            results = await asyncio.gather(*[ac.CANxmit(0x100 + x, b'\x01\x02') for x in range(50)])
+            self.assertEqual(results, [CAN_RESP_OK] * 50)
+            self.assertEqual([arbid for arbid, extflag, data in fake.sent_frames[-50:]], list(range(0x100, 0x132)))
+
+            # all the ECUs at once, one of them with a request that needs flow control
+            data = bytes(range(0x30, 0x50))
+            with ac.subscribe([0x785]) as sub:
+                readers = list(ecus)
+                exchanges = [ac.ISOTPxmit_recv(arbid, ecus[arbid], b'\x22\xf1\x90', timeout=2, service=0x62) for arbid in readers]
+                ecus[0x720] = 0x7a0
+                exchanges.append(ac.ISOTPxmit_recv(0x720, 0x7a0, b'\x2e' + data, timeout=2))
+                responses = await asyncio.gather(*exchanges)
+
+                for arbid, (msg, idx) in zip(readers, responses):
+                    self.assertEqual(msg, b'\x62' + struct.pack('>H', arbid) + b'\xf1\x90' + bytes(range(20)))
+                self.assertEqual(responses[-1][0], b'\x6e\x07\x20' + data + bytes(range(20)))
+
+                # first frame and 3 consecutive frames
+                frames = []
+                while not sub.queue.empty():
+                    frames.append(await sub.get())
+                self.assertEqual([arbid for idx, ts, arbid, data in frames], [0x785] * 4)
+                self.assertEqual(frames[0][3][:2], b'\x10\x19')
+
+            self.assertEqual(ac._subs, {})
+
+            # nobody answers
+            msg, idx = await ac.ISOTPxmit_recv(0x7e0, 0x7e8, b'\x3e\x00', timeout=.2)
+            self.assertEqual(msg, None)
+
+            # tailing: what's already here, then what comes in
+            count = c.getCanMsgCount()
+            threading.Timer(.1, frame, (0x123, b'\x01')).start()
+            threading.Timer(.2, frame, (0x123, b'\x02')).start()
+            msgs = [msg async for msg in ac.genCanMsgs(count - 2, stop=count + 1, maxsecs=2)]
+            self.assertEqual([idx for idx, ts, arbid, data in msgs], list(range(count - 2, count + 2)))
+            self.assertEqual([data[0] for idx, ts, arbid, data in msgs[2:]], [1, 2])
+
+            msgs = [msg async for msg in ac.genCanMsgs(None, arbids=[0x123], maxsecs=.2)]
+            self.assertEqual(msgs, [])
+
+            ac.detach()
+
+        asyncio.run(main())
@@ -1,5 +1,7 @@
+import io
 import os
 import time
+import struct
 import logging
 import pathlib
 import tempfile
@@ -16,6 +18,8 @@ from cancatlib.utils.types import ECUAddress
 
 from binascii import unhexlify
 from cancatlib.utils import convert
+from cancatlib.utils import pcap
+from cancatlib.utils import candump
 
 
 logger = logging.getLogger(__name__)
@@ -36,6 +40,34 @@ class Convert_test(unittest.TestCase):
         # now convert back
         convert.cancat2candump(outf1[1], outf2[1])
 
+        frames = list(candump.readCandump(testdata.filedata.split(b'\n')))
+        self.assertEqual(list(convert.iterSessionFrames(outf1[1])), frames)
+        with open(outf2[1], 'rb') as f:
+            self.assertEqual(list(candump.readCandump(f)), frames)
+
+
+    def test_CanDump2CanCat_jobs(self):
+        # two logs cat'd together, so the pieces overlap in time
+        lines = testdata.filedata.split(b'\n')
+        shifted = [line.replace(b'(15435095', b'(15435094', 1) for line in lines]
+        logdata = b'\n'.join(lines + shifted) + b'\n'
+
+        outf0 = tempfile.mkstemp()
+        with open(outf0[1], 'wb') as outf:
+            outf.write(logdata)
+        outf1 = tempfile.mkstemp()
+
+        frames = sorted(candump.readCandump(logdata.split(b'\n')), key=lambda frame: frame[0])
+        for jobs in (1, 2):
+            count = convert.candump2cancat(outf0[1], outf1[1], jobs=jobs, chunk_bytes=1000)
+            self.assertEqual(count, len(frames))
+            self.assertEqual(list(convert.iterSessionFrames(outf1[1])), frames)
+
+        # in order pieces are just written as they come
+        with open(outf0[1], 'wb') as outf:
+            outf.write(testdata.filedata)
+        convert.candump2cancat(outf0[1], outf1[1], jobs=2, chunk_bytes=1000)
+        self.assertEqual(list(convert.iterSessionFrames(outf1[1])), list(candump.readCandump(lines)))
 
     def test_Pcap2CanCat(self):
         outf0 = tempfile.mkstemp()
@@ -51,8 +83,49 @@ class Convert_test(unittest.TestCase):
         convert.candump2cancat(outf0[1], outf1[1])
 
         # now convert to pcap
-        #convert.cancat2pcap(outf1[1], outf2[1])
+        convert.cancat2pcap(outf1[1], outf2[1])
 
         # now convert back
-        #convert.pcap2cancat(outf2[1], outf3[1])
+        convert.pcap2cancat(outf2[1], outf3[1])
+
+        frames = list(convert.iterSessionFrames(outf1[1]))
+        self.assertEqual(len(frames), testdata.filedata.count(b'\n') + 1)
+        for (ts0, arbid0, data0), (ts1, arbid1, data1) in zip(frames, convert.iterSessionFrames(outf3[1])):
+            self.assertAlmostEqual(ts0, ts1, places=6)
+            self.assertEqual((arbid0, data0), (arbid1, data1))
+
+        # bare SocketCAN frames too
+        convert.cancat2pcap(outf1[1], outf2[1], pcap.LINKTYPE_CAN_SOCKETCAN)
+        with open(outf2[1], 'rb') as f:
+            self.assertEqual([frame[1:] for frame in pcap.readPcap(f)], [frame[1:] for frame in frames])
+
+    def test_pcapng(self):
+        # SHB, an SLL interface with nanosecond timestamps, one CAN frame
+        # and one non-CAN packet
+        def block(btype, body):
+            body += b'\0' * (-len(body) % 4)
+            return struct.pack('<II', btype, len(body) + 12) + body + struct.pack('<I', len(body) + 12)
+
+        shb = block(0x0a0d0d0a, struct.pack('<IHHq', 0x1a2b3c4d, 1, 0, -1))
+        idb = block(1, struct.pack('<HHI', pcap.LINKTYPE_LINUX_SLL, 0, 0xffff) +
+                    struct.pack('<HHB3x', 9, 1, 9) + struct.pack('<HH', 0, 0))
+        ts = 1543509533000838123
+        canpkt = pcap.SLL_HDR.pack(1, pcap.ARPHRD_CAN, 0, b'', pcap.ETH_P_CAN) + \
+                struct.pack('<IB3x', 0x98fef100, 3) + b'\x01\x02\x03\0\0\0\0\0'
+        ippkt = pcap.SLL_HDR.pack(0, 1, 6, b'abcdef', 0x0800) + b'\x45' * 20
+        epbs = b''.join(block(6, struct.pack('<IIIII', 0, ts >> 32, ts & 0xffffffff, len(pkt), len(pkt)) + pkt)
+                        for pkt in (canpkt, ippkt))
+
+        frames = list(pcap.readPcap(io.BytesIO(shb + idb + epbs)))
+        self.assertEqual(len(frames), 1)
+        self.assertAlmostEqual(frames[0][0], ts / 1e9)
+        self.assertEqual(frames[0][1:], (0x18fef100, b'\x01\x02\x03'))
+
+    def test_candump_lines(self):
+        self.assertEqual(candump.parseCandumpLine(b'(1.5) can0 7DF#0201'), (1.5, 0x7df, b'\x02\x01'))
+        self.assertEqual(candump.parseCandumpLine(b'(1.5) can0 7DF#R'), (1.5, 0x7df, b''))
+        self.assertEqual(candump.parseCandumpLine(b'(1.5) can1 7E8##1' + b'11' * 12), (1.5, 0x7e8, b'\x11' * 12))
+        self.assertEqual(candump.parseCandumpLine(b'  \n'), None)
+        self.assertRaises(ValueError, candump.parseCandumpLine, b'can0 7DF#0201')
+        self.assertRaises(ValueError, candump.parseCandumpLine, b'(1.5) can0 7DF 0201')
 
@@ -48,7 +48,245 @@ class J1939_test(unittest.TestCase):
         self.assertEqual(data[-5:], unhexlify(b'0139040901'))
         self.assertEqual(len(data), 78)
 
+        # compiled filters, constant-set fast path and callables all agree
+        # with filtering by hand
+        everything = list(c.filterCanMsgs())
+        expected = [x for x in everything if x[2][4] in (0xf0, 0xfe) and x[2][6] == 0]
+        self.assertTrue(len(expected))
+        self.assertEqual(list(c.filterCanMsgs(advfilters=['pf in (0xf0, 0xfe)', 'sa==0'])), expected)
+        self.assertEqual(list(c.filterCanMsgs(advfilters=['pgn & 0xff00 == 0xf000 or pf == 0xfe',
+                                                          lambda idx, ts, arbtup, data: arbtup[6] == 0])),
+                         expected)
+
+        # compiled filters are cached, but not forever: a callable filter
+        # goes away once enough others have been compiled since
+        import gc
+        import weakref
+        from cancatlib.advfilters import ADVFILTER_CACHE_SIZE
+        func = lambda idx, ts, arbtup, data: True
+        ref = weakref.ref(func)
+        c._compileAdvFilters(['sa==0', func])
+        del func
+        for x in range(ADVFILTER_CACHE_SIZE):
+            c._compileAdvFilters(['sa==%d' % x])
+        gc.collect()
+        self.assertIsNone(ref())
+
         # now do destructive testing
         ts, arbtup, msg = c.J1939recv(pf=0xf0, ps=0x03, sa=0)[0]
         self.assertEqual(arbtup, (0xcf00300, 0x3, 0x0, 0x0, 0xf0, 0x3, 0x0))
         self.assertEqual(msg, b'\xda\xfe\x00\xff\xff\x0fc}')
+
+    def test_spn_decode(self):
+        from cancatlib import j1939
+        from cancatlib.j1939stack import parsePGNData
+
+        # CCVS1: wheel speed 0x3200 * 1/256 km/h, parking brake set (bits 2-3)
+        msg = b'\x04\x00\x32\xff\xff\xff\xff\xff'
+        values = j1939.getSPNValues(0xfef1, msg)
+        self.assertAlmostEqual(values[84], 0x3200 * 0.00242723046875)
+        self.assertEqual(values[70], 1)
+        self.assertEqual(values[69], 0)
+
+        # decoders are compiled once per PGN
+        self.assertIs(j1939.getPGNDecoder(0xfef1), j1939.getPGNDecoder(0xfef1))
+
+        # both stacks render the same thing
+        spns = parsePGNData(0xfe, 0xf1, msg)['spns']
+        self.assertEqual([(spnum, value) for spnum, spn, units, value, srepr in spns],
+                         [(spnum, value) for spnum, spn, units, value, srepr in j1939.decodePGN(0xfef1, msg)])
+        lines = j1939.reprSPNdata(j1939.J1939PGNdb[0xfef1]['SPNs'], msg, 0xfef1)
+        self.assertIn('      SPN(84): 31.069 mph', lines[-1])
+
+        # short data doesn't blow up
+        self.assertEqual(j1939.getSPNValues(0xfef1, msg[:2])[84], None)
+
+    def test_j1939_tables(self):
+        from cancatlib import j1939tables
+        from cancatlib import J1939db
+
+        # the on-demand tables serve exactly what's in J1939db.py
+        for name in j1939tables.__all__:
+            table = getattr(j1939tables, name)
+            source = getattr(J1939db, name)
+            self.assertEqual(len(table), len(source))
+            for key in list(source)[:50]:
+                self.assertEqual(table[key], source[key])
+
+        self.assertEqual(dict(j1939tables.mfg_lookup.items()), J1939db.mfg_lookup)
+        self.assertEqual(j1939tables.J1939PGNdb.get(0x1234567), None)
+        self.assertNotIn(0x1234567, j1939tables.J1939PGNdb)
+        self.assertRaises(KeyError, j1939tables.J1939SPNdb.__getitem__, -1)
+
+    def test_spn_columns(self):
+        from cancatlib.j1939stack import J1939MSGS, parseArbid, parsePGNData
+
+        c = J1939Interface(port='FakeCanCat')
+        ccvs = parseArbid(0x18fef100)
+        eec1 = parseArbid(0x0cf00403)
+        msgs = [(100.0 + x, ccvs, bytes([4, x, 0x32, 0xff, 0xff, 0xff, 0xff, 0xff])) for x in range(10)]
+        msgs += [(100.5 + x, eec1, bytes([0xf0, 0x7d, 0x7d, x, 0x20, 0, 0xf0, 0x7d])) for x in range(10)]
+        msgs.append((120.0, ccvs, b'\x04'))
+        msgs.sort()
+        c._messages[J1939MSGS] = msgs
+
+        for use_numpy in (True, False):
+            cols = c.getSPNColumns([84, 190, 70], use_numpy=use_numpy)
+            self.assertEqual(list(cols[84]['ts'])[:10], [float(x) for x in range(10)])
+            self.assertEqual(list(cols[84]['sa']), [0] * 11)
+            self.assertEqual(list(cols[190]['sa']), [3] * 10)
+            self.assertEqual(list(cols[70]['value'])[:10], [1.0] * 10)
+
+            # same values as decoding one message at a time
+            for x in range(10):
+                spns = dict((spnum, value) for spnum, spn, units, value, srepr in parsePGNData(0xfe, 0xf1, msgs[x*2][2])['spns'])
+                self.assertAlmostEqual(cols[84]['value'][x], spns[84])
+            self.assertAlmostEqual(cols[190]['value'][3], 0x2003 * 0.125)
+
+            # too short to hold the SPN
+            self.assertNotEqual(cols[84]['value'][10], cols[84]['value'][10])
+
+            # message range
+            cols = c.getSPNColumns([84], start=4, stop=7, use_numpy=use_numpy)
+            self.assertEqual(list(cols[84]['ts']), [2.0, 3.0])
+
+    def test_arbid_info(self):
+        from cancatlib import j1939
+        from cancatlib.j1939stack import parseArbid, getArbtupInfo, arbinfo_list_getter
+
+        self.assertEqual(parseArbid(0x18fef100), (0x18fef100, 6, 0, 0, 0xfe, 0xf1, 0x00))
+        self.assertIs(parseArbid(0x18fef100), parseArbid(0x18fef100))
+        self.assertEqual(j1939.parseArbid(0x0cea0bfe), (3, 0, 0, 0xea, 0x0b, 0xfe))
+
+        info = getArbtupInfo(parseArbid(0x0cea0bfe))
+        self.assertEqual((info['pgn'], info['da'], info['ge'], info['sa']), (0xea00, 0x0b, None, 0xfe))
+        self.assertEqual(getArbtupInfo((0x7df, 0, 0, 0, 0, 7, 0xdf))['pgn'], None)
+
+        # TP messages have no arbid
+        tp = (None, 6, 0, 0, 0xfe, 0xca, 0)
+        stats = [(1, parseArbid(0x18fef103), None), (2, tp, None), (3, parseArbid(0x18fef100), None),
+                 (4, parseArbid(0x0cf00400), None)]
+        ordered = sorted(stats, key=arbinfo_list_getter('pgn', 'sa'))
+        self.assertEqual([x[0] for x in ordered], [4, 2, 3, 1])
+
+    def test_j1939recv_wait(self):
+        import threading
+        from cancatlib.j1939stack import parseArbid
+
+        c = J1939Interface(port='FakeCanCat')
+        other = parseArbid(0x18fef100)
+        wanted = parseArbid(0x18ea0bfe)
+
+        def sender():
+            for x in range(20):
+                c._submitJ1939Message(other, b'\x00' * 8)
+            time.sleep(.2)
+            c._submitJ1939Message(wanted, b'\x01\x02\x03')
+
+        thread = threading.Thread(target=sender)
+        thread.start()
+        start = time.time()
+        msgs = c.J1939recv(0xea, 0x0b, 0xfe, timeout=5)
+        thread.join()
+
+        self.assertEqual([(arbtup, msg) for ts, arbtup, msg in msgs], [(wanted, b'\x01\x02\x03')])
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(c._last_recv_idx, 21)
+
+        # already there: straight from the pf index
+        self.assertEqual(len(c.J1939recv(0xfe, 0xf1, 0x00, msgcount=30, timeout=.1, start_msg=0)), 20)
+        self.assertEqual(len(c.J1939recv_loose(pf=[0xea, 0xfe], msgcount=30, timeout=.1, start_msg=5)), 16)
+        self.assertEqual(len(c.J1939recv_loose(pf=None, sa=0xfe, msgcount=30, timeout=.1, start_msg=0)), 1)
+        self.assertEqual(c.J1939recv(0xea, 0x0b, 0xfe, timeout=.1), [])
+
+    def test_tp_send(self):
+        import struct
+        from cancatlib.j1939stack import emitArbid, parseArbid, CM_RTS, CM_CTS, CM_EOM, CM_BAM, CM_ABORT
+
+        c = J1939Interface(port='FakeCanCat')
+        fake = c._io
+        fake_write = fake.write
+        sent = []
+        peer = {'window': 3, 'held': False, 'respond': True}
+        # TP.DT packets the transceiver fails to send
+        failing = set()
+
+        def reply(data):
+            # the peer (0x0b) talking back to us (0xfe)
+            fake.CanCat_send(0x30, struct.pack('>I', emitArbid(7, 0, 0, 0xec, 0xfe, 0x0b)) + data)
+
+        def write(msg):
+            if msg[2] == 0x44 and parseArbid(struct.unpack('>I', msg[3:7])[0])[4] == 0xeb and msg[8] in failing:
+                # CMD_CAN_SEND_RESULT: CAN_RESP_SENDMSGTIMEOUT
+                fake.CanCat_send(0x34, b'\x07')
+                return
+
+            fake_write(msg)
+            if msg[2] == 0x44:      # CMD_CAN_SEND
+                frames = [(struct.unpack('>I', msg[3:7])[0], msg[8:])]
+            elif msg[2] == 0x49:    # CMD_CAN_SEND_BATCH
+                frames = [(arbid, data) for arbid, extflag, data in fake.sent_frames[len(fake.sent_frames) - msg[3]:]]
+            else:
+                return
+
+            for arbid, data in frames:
+                sendFrame(arbid, data)
+
+        def sendFrame(arbid, data):
+            sent.append((parseArbid(arbid), data))
+            pf = parseArbid(arbid)[4]
+            if not peer['respond']:
+                return
+
+            if pf == 0xec and data[0] == CM_RTS:
+                reply(bytes([CM_CTS, peer['window'], 1, 0xff, 0xff]) + data[5:8])
+            elif pf == 0xeb:
+                seq = data[0]
+                if seq == 3 and not peer['held']:
+                    # make the sender hold, then continue
+                    peer['held'] = True
+                    reply(bytes([CM_CTS, 0, 0, 0xff, 0xff, 0, 0xea, 0]))
+                if seq == 6:
+                    reply(bytes([CM_EOM]) + struct.pack('<HBB', 40, 6, 0xff) + bytes([0, 0xea, 0]))
+                elif seq % peer['window'] == 0:
+                    reply(bytes([CM_CTS, peer['window'], seq + 1, 0xff, 0xff, 0, 0xea, 0]))
+
+        fake.write = write
+        message = bytes(range(40))
+
+        # RTS/CTS to 0x0b: the peer holds off with CTS(0) at first
+        sent[:] = []
+        self.assertTrue(c.J1939xmit(0xea, 0x0b, 0xfe, message))
+        cms = [data for arbtup, data in sent if arbtup[4] == 0xec]
+        dts = [data for arbtup, data in sent if arbtup[4] == 0xeb]
+        self.assertEqual(cms, [struct.pack('<BHBB', CM_RTS, 40, 6, 0xff) + b'\x00\xea\x00'])
+        self.assertEqual([dt[0] for dt in dts], [1, 2, 3, 4, 5, 6])
+        self.assertEqual(b''.join(dt[1:] for dt in dts), message + b'\xff\xff')
+        self.assertEqual(c._tp_tx_sessions, {})
+
+        # nobody answers: abort after T3
+        sent[:] = []
+        peer['respond'] = False
+        start = time.time()
+        self.assertFalse(c.J1939xmit(0xea, 0x0b, 0xfe, message))
+        self.assertGreater(time.time() - start, 1)
+        self.assertEqual(sent[-1][1][:2], bytes([CM_ABORT, 3]))
+
+        # BAM for PDU2: paced packets to 0xff
+        sent[:] = []
+        c.tp_bam_interval = .05
+        start = time.time()
+        self.assertTrue(c.J1939xmit(0xfe, 0xca, 0xfe, message))
+        self.assertGreaterEqual(time.time() - start, .3)
+        self.assertEqual(sent[0][1], struct.pack('<BHBB', CM_BAM, 40, 6, 0xff) + b'\xca\xfe\x00')
+        self.assertEqual([arbtup[5] for arbtup, data in sent], [0xff] * 7)
+
+        # a BAM packet that doesn't go out fails the transfer, and the rest
+        # aren't sent
+        sent[:] = []
+        failing.add(3)
+        self.assertFalse(c.J1939xmit(0xfe, 0xca, 0xfe, message))
+        self.assertEqual([data[0] for arbtup, data in sent[1:]], [1, 2])
+
+        # a single frame says whether it was sent too
+        self.assertTrue(c.J1939xmit(0xfe, 0xca, 0xfe, message[:8]))
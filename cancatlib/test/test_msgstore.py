@@ -0,0 +1,164 @@
+import sys
+import pickle
+import struct
+import logging
+import threading
+import unittest
+
+from cancatlib import msgstore
+from cancatlib.msgstore import CanMsgStore, MsgEvictedError
+from cancatlib.test import test_messages
+
+logger = logging.getLogger(__name__)
+
+
+class CanMsgStore_test(unittest.TestCase):
+    def test_list_compat(self):
+        msgs = test_messages.test_j1939_msgs_0
+        store = CanMsgStore(msgs)
+
+        self.assertEqual(len(store), len(msgs))
+        self.assertEqual(store[0], msgs[0])
+        self.assertEqual(store[-1], msgs[-1])
+        self.assertEqual(store[10:20], msgs[10:20])
+        self.assertEqual(list(store), msgs)
+
+        ts, arbid, data = store.getFrame(1)
+        self.assertEqual(ts, msgs[1][0])
+        self.assertEqual(arbid, 0x0cf00300)
+        self.assertEqual(data, msgs[1][1][4:])
+
+        frames = list(store.iterFrames(5, 8))
+        self.assertEqual([f[0] for f in frames], [5, 6, 7])
+
+        # old python2 sessions have str messages
+        store.append((1.0, '\x00\x00\x07\xe8\x02\x7e\x00'))
+        self.assertEqual(store[-1], (1.0, b'\x00\x00\x07\xe8\x02\x7e\x00'))
+
+    def test_pop(self):
+        msgs = test_messages.test_j1939_msgs_0[:50]
+        store = CanMsgStore(msgs)
+
+        self.assertEqual(store.pop(0), msgs[0])
+        self.assertEqual(store.pop(), msgs[-1])
+        self.assertEqual(store.pop(10), msgs[11])
+        self.assertEqual(list(store), msgs[1:11] + msgs[12:-1])
+
+        store._compact()
+        self.assertEqual(list(store), msgs[1:11] + msgs[12:-1])
+
+    def test_pickle(self):
+        store = CanMsgStore(test_messages.test_j1939_msgs_1)
+        store.pop(0)
+
+        restored = pickle.loads(pickle.dumps({'messages': store}))['messages']
+        self.assertEqual(list(restored), test_messages.test_j1939_msgs_1[1:])
+        self.assertLess(store.nbytes(), len(store) * 40)
+
+    def test_arbid_index(self):
+        msgs = test_messages.test_j1939_msgs_0
+        store = CanMsgStore(msgs)
+        arbids = store.getArbids()[:3]
+
+        def brute(start, stop):
+            return [f for f in store.iterFrames(start, stop) if f[2] in arbids]
+
+        self.assertEqual(list(store.iterArbidFrames(arbids)), brute(0, None))
+        self.assertEqual(list(store.iterArbidFrames(arbids, 7, 30)), brute(7, 30))
+        self.assertEqual(list(store.iterArbidFrames([0xdeadbeef])), [])
+
+        # still lines up after popping from both ends and compacting
+        store.pop(0)
+        store.pop()
+        self.assertEqual(list(store.iterArbidFrames(arbids, 3)), brute(3, None))
+        store._compact()
+        self.assertEqual(list(store.iterArbidFrames(arbids, 3)), brute(3, None))
+
+        store.append(msgs[0])
+        self.assertEqual(list(store.iterArbidFrames(arbids)), brute(0, None))
+
+    def test_evict(self):
+        msgs = test_messages.test_j1939_msgs_0
+        store = CanMsgStore(msgs[:100])
+        arbids = store.getArbids()[:3]
+        expected = [f for f in CanMsgStore(msgs).iterFrames() if f[2] in arbids]
+
+        # indexes don't move when the oldest frames are dropped
+        store.evict(40)
+        self.assertEqual(len(store), 100)
+        self.assertEqual(store.getFirstIndex(), 40)
+        self.assertEqual(store[40], msgs[40])
+        self.assertRaises(MsgEvictedError, store.getFrame, 10)
+        self.assertRaises(IndexError, store.__getitem__, 39)
+        self.assertEqual([f[0] for f in store.iterFrames(40, 43)], [40, 41, 42])
+        self.assertRaises(MsgEvictedError, list, store.iterFrames(0))
+
+        store.extend(msgs[100:])
+        store._compact()
+        self.assertEqual(store[-1], msgs[-1])
+        self.assertEqual(list(store.iterArbidFrames(arbids, 40)), [f for f in expected if f[0] >= 40])
+
+        restored = pickle.loads(pickle.dumps(store))
+        self.assertEqual(restored.getFirstIndex(), 40)
+        self.assertEqual(list(restored.iterFrames(40)), list(store.iterFrames(40)))
+
+    def test_evict_concurrent_readers(self):
+        # a ring buffer being filled (and compacted) while other threads read
+        # it.  every frame says which index it is, so a reader that mixes up
+        # old and new columns gets the wrong frame (or an IndexError)
+        store = CanMsgStore()
+        total = 40000
+        ring = 100
+        errors = []
+        done = threading.Event()
+
+        def frame(idx):
+            return float(idx), idx % 7, struct.pack('>I', idx)
+
+        def check(idx, ts, arbid, data):
+            if (ts, arbid, data) != frame(idx):
+                errors.append((idx, ts, arbid, data))
+
+        def writer():
+            try:
+                for idx in range(total):
+                    store.appendFrame(*frame(idx))
+                    store.evict(len(store) - store.getFirstIndex() - ring)
+            finally:
+                done.set()
+
+        def reader():
+            while not done.is_set() and len(errors) < 10:
+                first = store.getFirstIndex()
+                try:
+                    check(first, *store.getFrame(first))
+                    for f in store.iterFrames(first, first + 20):
+                        check(*f)
+                    for f in store.iterArbidFrames([1, 2], first):
+                        check(*f)
+                        if f[2] not in (1, 2):
+                            errors.append(f)
+                except MsgEvictedError:
+                    # lapped by the writer, which is fine
+                    pass
+                except Exception as e:
+                    errors.append(e)
+
+        compact_min = msgstore.COMPACT_MIN
+        interval = sys.getswitchinterval()
+        msgstore.COMPACT_MIN = 16
+        sys.setswitchinterval(1e-5)
+        try:
+            threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for x in range(3)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            msgstore.COMPACT_MIN = compact_min
+            sys.setswitchinterval(interval)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(store), total)
+        self.assertLess(len(store._dlcs), 2 * ring + 16)
+        self.assertEqual(list(store.iterFrames(total - ring)), [(x,) + frame(x) for x in range(total - ring, total)])
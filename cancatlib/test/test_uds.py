@@ -64,3 +64,295 @@ class UDStest(unittest.TestCase):
 
             for did in test['dids'].keys():
                 self.assertEqual(test['dids'][did], ecu._sessions[1]['dids'][did]['resp'])
+
+    def test_ecu_scan_parallel(self):
+        import struct
+        import cancatlib
+        from cancatlib.test import CMD_CAN_RECV, CMD_CAN_SEND_BATCH, CMD_CAN_SENDRECV_ISOTP
+
+        c = cancatlib.CanInterface(port='FakeCanCat')
+        c.batch_xmit = True
+        fake = c._io
+        fake_write = fake.write
+        # tx arbid -> the arbid it answers on (0x733 doesn't use tx + 8)
+        responders = {0x711: 0x719, 0x7e0: 0x7e8, 0x733: 0x7a5}
+        probes = []
+
+        def frame(arbid, data):
+            fake.CanCat_send(CMD_CAN_RECV, struct.pack('>I', arbid) + data)
+
+        def answer(tx_arbid, req):
+            rx_arbid = responders.get(tx_arbid)
+            if rx_arbid is None:
+                return
+            if tx_arbid == 0x7e0:
+                # 0x31:'RequestOutOfRange'
+                resp = struct.pack('>BBB', 0x7f, req[0], 0x31)
+            else:
+                resp = struct.pack('>B', req[0] + 0x40) + req[1:]
+            frame(rx_arbid, (struct.pack('>B', len(resp)) + resp).ljust(8, b'\x00'))
+
+        def write(msg):
+            fake_write(msg)
+            if msg[2] == CMD_CAN_SEND_BATCH:
+                # the probes: echoed like the transceiver does, then answered
+                for arbid, extflag, data in fake.sent_frames[len(fake.sent_frames) - msg[3]:]:
+                    probes.append(arbid)
+                    frame(arbid, data)
+                    answer(arbid, data[1:1+data[0]])
+            elif msg[2] == CMD_CAN_SENDRECV_ISOTP:
+                # confirming through UDS
+                tx_arbid, rx_arbid, extflag = struct.unpack('>IIB', msg[3:12])
+                if responders.get(tx_arbid) == rx_arbid:
+                    answer(tx_arbid, msg[12:])
+
+        fake.write = write
+        expected = [
+            ECUAddress(0x711, 0x719, 0),
+            ECUAddress(0x7e0, 0x7e8, 0),
+            ECUAddress(0x733, 0x7a5, 0),
+        ]
+
+        ecus = ecu_did_scan(c, range(0, 0x100), timeout=.5, parallel=0x100)
+        self.assertEqual(expected, ecus)
+        self.assertEqual(probes, list(range(0x700, 0x800)))
+
+        probes[:] = []
+        ecus = ecu_session_scan(c, range(0, 0x100), timeout=.5, parallel=0x40)
+        self.assertEqual(expected, ecus)
+        self.assertEqual(probes, list(range(0x700, 0x800)))
+
+    def test_ecu_scan_parallel_late(self):
+        import struct
+        import threading
+        import cancatlib
+        from cancatlib.test import CMD_CAN_RECV, CMD_CAN_SEND_BATCH, CMD_CAN_SENDRECV_ISOTP
+
+        c = cancatlib.CanInterface(port='FakeCanCat')
+        c.ping(b'x')
+        c.batch_xmit = True
+        fake = c._io
+        fake_write = fake.write
+        # tx arbid -> (the arbid it answers on, how long it takes to answer a
+        # probe).  0x744 is too busy to answer its probe in time, but does
+        # while the rest are still waiting
+        responders = {0x711: (0x719, .03), 0x733: (0x7a5, .03), 0x744: (0x74c, .6)}
+        timers = []
+
+        def answer(tx_arbid, req):
+            resp = struct.pack('>B', req[0] + 0x40) + req[1:]
+            fake.CanCat_send(CMD_CAN_RECV, struct.pack('>I', responders[tx_arbid][0]) +
+                             (struct.pack('>B', len(resp)) + resp).ljust(8, b'\x00'))
+
+        def write(msg):
+            fake_write(msg)
+            if msg[2] == CMD_CAN_SEND_BATCH:
+                # the whole batch goes out (and is echoed) before anything answers
+                batch = fake.sent_frames[len(fake.sent_frames) - msg[3]:]
+                for arbid, extflag, data in batch:
+                    fake.CanCat_send(CMD_CAN_RECV, struct.pack('>I', arbid) + data)
+                for arbid, extflag, data in batch:
+                    if arbid in responders:
+                        t = threading.Timer(responders[arbid][1], answer, (arbid, data[1:1+data[0]]))
+                        timers.append(t)
+                        t.start()
+            elif msg[2] == CMD_CAN_SENDRECV_ISOTP:
+                tx_arbid, rx_arbid, extflag = struct.unpack('>IIB', msg[3:12])
+                if tx_arbid in responders and responders[tx_arbid][0] == rx_arbid:
+                    answer(tx_arbid, msg[12:])
+
+        fake.write = write
+        try:
+            ecus = ecu_did_scan(c, range(0, 0x100), timeout=.5, parallel=0x100, max_busload=.15)
+        finally:
+            for t in timers:
+                t.cancel()
+
+        self.assertEqual([
+            ECUAddress(0x711, 0x719, 0),
+            ECUAddress(0x733, 0x7a5, 0),
+            ECUAddress(0x744, 0x74c, 0),
+        ], ecus)
+
+    def test_scan_ecus_parallel(self):
+        import threading
+        from cancatlib.scripts.canmap import scan_ecus
+
+        c = CanInterface('')
+        addrs = [ECUAddress(0x711, 0x719, 0), ECUAddress(0x7e0, 0x7e8, 0), ECUAddress(0x7e1, 0x7e9, 0)]
+        serial = [ECU(c, addr, scancls=FakeUDS) for addr in addrs]
+        parallel = [ECU(c, addr, scancls=FakeUDS) for addr in addrs]
+
+        scan_ecus(serial, lambda ecu: ecu.did_read_scan(range(0, 0x10000)))
+
+        threads = set()
+        def scan(ecu):
+            threads.add(threading.current_thread())
+            ecu.did_read_scan(range(0, 0x10000))
+        scan_ecus(parallel, scan, 3)
+
+        self.assertEqual(len(threads), 3)
+        self.assertEqual([e.export() for e in serial], [e.export() for e in parallel])
+        self.assertEqual(list(parallel[1].export()['sessions'][1]['dids']), [0xE010, 0xF190])
+
+        # the first failure is raised once the others are done
+        def fail(ecu):
+            raise ValueError(ecu._addr)
+        self.assertRaises(ValueError, scan_ecus, parallel, fail, 2)
+
+    def test_adaptive_timeout(self):
+        import time
+        import struct
+        import threading
+        import cancatlib
+        from cancatlib.test import CMD_CAN_RECV, CMD_CAN_SENDRECV_ISOTP
+
+        c = cancatlib.CanInterface(port='FakeCanCat')
+        fake = c._io
+        fake_write = fake.write
+
+        def frame(data):
+            fake.CanCat_send(CMD_CAN_RECV, struct.pack('>I', 0x7e8) + (struct.pack('>B', len(data)) + data).ljust(8, b'\x00'))
+
+        def write(msg):
+            fake_write(msg)
+            if msg[2] != CMD_CAN_SENDRECV_ISOTP:
+                return
+            req = msg[12:]
+            did, = struct.unpack('>H', req[1:3])
+            if did < 0x10:
+                frame(b'\x62' + req[1:3] + b'ok')
+            elif did == 0x10:
+                # ResponsePending, then the answer long after the learned timeout
+                frame(b'\x7f\x22\x78')
+                threading.Timer(.5, frame, (b'\x62' + req[1:3] + b'slow',)).start()
+            # anything else is ignored
+
+        fake.write = write
+        # past the receive thread's startup, so the first response isn't slow
+        c.ping(b'x')
+        ecu = ECU(c, ECUAddress(0x7e0, 0x7e8, 0))
+
+        # learns from the DIDs that answer, then doesn't wait 3 seconds for each of the rest
+        start = time.time()
+        ecu.did_read_scan(range(0x20))
+        self.assertLess(time.time() - start, 10)
+
+        dids = ecu._sessions[1]['dids']
+        self.assertEqual(sorted(dids), list(range(0x11)))
+        self.assertEqual(dids[0x10]['resp'], b'\x62\x00\x10slow')
+
+        latency = ecu.export()['latency']
+        self.assertEqual(latency['responses'], 0x11)
+        self.assertEqual(latency['pending'], 1)
+        # each ignored DID timed out, and was tried once more
+        self.assertEqual(latency['timeouts'], 0xf * 2)
+        self.assertEqual(latency['retries'], 0xf)
+
+        # the counts carry over into the next run
+        again = ECU(c, ECUAddress(0x7e0, 0x7e8, 0), **ecu.export())
+        self.assertEqual(again.export()['latency']['timeouts'], 0xf * 2)
+        self.assertEqual(again._sessions[1]['dids'], dids)
+
+    def test_adaptive_timeout_multiframe(self):
+        import struct
+        import threading
+        import cancatlib
+        from cancatlib import iso_tp
+        from cancatlib.test import CMD_CAN_RECV, CMD_CAN_SENDRECV_ISOTP
+
+        c = cancatlib.CanInterface(port='FakeCanCat')
+        fake = c._io
+        fake_write = fake.write
+
+        def frame(data):
+            fake.CanCat_send(CMD_CAN_RECV, struct.pack('>I', 0x7e8) + data.ljust(8, b'\x00'))
+
+        def write(msg):
+            fake_write(msg)
+            if msg[2] != CMD_CAN_SENDRECV_ISOTP:
+                return
+            req = msg[12:]
+            did, = struct.unpack('>H', req[1:3])
+            if did < 0x10:
+                frame(b'\x05\x62' + req[1:3] + b'ok')
+            elif did == 0x10:
+                # starts right away, but takes far longer than the learned timeout to finish
+                frames = iso_tp.msg_encode(b'\x62' + req[1:3] + bytes(range(40)))
+                frame(frames[0])
+                for x, cf in enumerate(frames[1:]):
+                    threading.Timer(.1 * (x + 1), frame, (cf,)).start()
+
+        fake.write = write
+        c.ping(b'x')
+        ecu = ECU(c, ECUAddress(0x7e0, 0x7e8, 0))
+
+        ecu.did_read_scan(range(0x10))
+        self.assertLess(ecu._latency.getTimeout(3.0), .2)
+
+        ecu.did_read_scan([0x10, 0x11], rescan=True)
+        dids = ecu._sessions[1]['dids']
+        self.assertEqual(dids[0x10]['resp'], b'\x62\x00\x10' + bytes(range(40)))
+        self.assertNotIn(0x11, dids)
+
+        # learned from when the response started, not when it was all in
+        latency = ecu.export()['latency']
+        self.assertEqual(latency['responses'], 0x11)
+        self.assertLess(latency['p99'], .2)
+
+    def test_resume_scan(self):
+        from cancatlib.utils.types import ScanBitmap
+
+        c = CanInterface('')
+        addr = ECUAddress(0x7e0, 0x7e8, 0)
+        queried = []
+
+        class Interrupted(Exception):
+            pass
+
+        class CountingUDS(FakeUDS):
+            stop_at = None
+
+            def ReadDID(self, did):
+                if did == CountingUDS.stop_at:
+                    raise Interrupted()
+                queried.append(did)
+                return FakeUDS.ReadDID(self, did)
+
+        did_range = list(range(0xe000, 0xe100)) + list(range(0xf180, 0xf1a0))
+        CountingUDS.stop_at = 0xf190
+        ecu = ECU(c, addr, scancls=CountingUDS)
+        self.assertRaises(Interrupted, ecu.did_read_scan, did_range)
+
+        # everything up to the chunk that was cut short is checkpointed
+        saved = ecu.export()
+        scanned = ScanBitmap(saved['scanned']['dids'][1])
+        self.assertEqual(list(scanned), did_range[:len(scanned)])
+        self.assertEqual(len(scanned) % 16, 0)
+        self.assertIn(0xe010, saved['sessions'][1]['dids'])
+
+        # resuming only asks for what's left
+        queried[:] = []
+        CountingUDS.stop_at = None
+        ecu = ECU(c, addr, scancls=CountingUDS, **saved)
+        ecu.did_read_scan(did_range, resume=True)
+        self.assertEqual(queried, did_range[len(scanned):])
+        self.assertEqual(sorted(ecu._sessions[1]['dids']), [0xe010, 0xf190])
+        self.assertEqual(str(ecu._scanned['dids'][1]), 'e000-e0ff,f180-f19f')
+
+        # and then there's nothing left to do
+        queried[:] = []
+        ecu.did_read_scan(did_range, resume=True)
+        self.assertEqual(queried, [])
+
+        # without resume, results already there mean the phase is done
+        ecu.did_read_scan(range(0x10000))
+        self.assertEqual(queried, [])
+
+        # the scan is bookmarked once, not once per chunk
+        marks = []
+        c.placeCanBookmark = lambda name=None, comment=None: marks.append(name)
+        ecu = ECU(c, addr, scancls=CountingUDS)
+        ecu.did_read_scan(did_range)
+        self.assertEqual(len([m for m in marks if m.startswith('did_read_scan(')]), 1)
+        self.assertEqual(len([m for m in marks if m.startswith('ReadDID(')]), len(did_range))
@@ -2,9 +2,11 @@ from __future__ import print_function
 from builtins import input
 
 import sys
+import math
 import time
 import struct
 import threading
+from collections import deque
 
 import cancatlib.iso_tp as cisotp
 
@@ -160,6 +162,17 @@ RESP_CODES = {}
 RESP_CODES.update(NEG_RESP_REPR)
 RESP_CODES.update(POS_RESP_CODES)
 
+# adaptive timeouts (see ResponseLatency): how many response times to keep,
+# how many before they're trusted, and the timeout is the 99th percentile
+# times LATENCY_MARGIN but never less than the ISO14229 P2 server time
+LATENCY_SAMPLES = 256
+LATENCY_MIN_SAMPLES = 8
+LATENCY_PERCENTILE = .99
+LATENCY_MARGIN = 2.0
+LATENCY_MIN_TIMEOUT = .05
+# an ECU that sent ResponsePending (0x78) has P2* (5 seconds) to answer
+P2_STAR_TIMEOUT = 5.0
+
 
 class UDSTimeout(Exception):
     pass
@@ -182,6 +195,60 @@ class NegativeResponseException(Exception):
             (self.svc, UDS_SVCS.get(self.svc), self.neg_code, negresprepr, self.msg)
 
 
+class ResponseLatency(object):
+    """
+    How quickly one ECU answers, learned from the responses it sends, for
+    picking a timeout that fits it instead of always waiting the worst case.
+
+    Set it as UDS.latency (several UDS objects for the same ECU can share
+    one).  Requests that time out on the learned timeout are sent again
+    with the timeout doubled, up to retries times, and the timeouts, retries
+    and ResponsePending (0x78) answers are counted for the scan results.
+    """
+    def __init__(self, retries=1, timeouts=0, retried=0, pending=0, **kwargs):
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.retries = retries
+        self.timeouts = timeouts
+        self.retried = retried
+        self.pending = pending
+        self._p99 = None
+
+    def addSample(self, secs):
+        self.samples.append(secs)
+        self._p99 = None
+
+    def percentile(self, pct):
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        idx = int(math.ceil(pct * len(samples))) - 1
+        return samples[max(0, min(idx, len(samples) - 1))]
+
+    def getTimeout(self, max_timeout, attempt=0):
+        """
+        the timeout for the attempt'th try of a request, never more than
+        max_timeout.  until enough responses have been seen it's max_timeout
+        """
+        if len(self.samples) < LATENCY_MIN_SAMPLES:
+            return max_timeout
+
+        if self._p99 is None:
+            self._p99 = self.percentile(LATENCY_PERCENTILE)
+
+        timeout = max(self._p99 * LATENCY_MARGIN, LATENCY_MIN_TIMEOUT) * (2 ** attempt)
+        return min(timeout, max_timeout)
+
+    def export(self):
+        return {
+            'responses': len(self.samples),
+            'p50': self.percentile(.5),
+            'p99': self.percentile(LATENCY_PERCENTILE),
+            'timeouts': self.timeouts,
+            'retries': self.retried,
+            'pending': self.pending,
+        }
+
+
 class UDS(object):
     def __init__(self, c, tx_arbid, rx_arbid=None, verbose=True, extflag=0, timeout=3.0):
         self.c = c
@@ -189,6 +256,9 @@ class UDS(object):
         self.verbose = verbose
         self.extflag = extflag
         self.timeout = timeout
+        # a ResponseLatency to use adaptive timeouts, timeout is then the most
+        # we'll wait for a response
+        self.latency = None
 
         if rx_arbid is None:
             rx_arbid = tx_arbid + 8  # by UDS spec
@@ -196,8 +266,52 @@ class UDS(object):
         self.tx_arbid = tx_arbid
         self.rx_arbid = rx_arbid
 
+    def _first_frame_ts(self, start_idx, idx):
+        """
+        when the first frame of the response that ended with CAN message idx
+        came in (None if it can't be found)
+        """
+        msgs = self.c.getCanMsgQueue()
+        if not hasattr(msgs, 'iterArbidFrames'):
+            return None
+
+        first_ts = None
+        for fidx, ts, arbid, fdata in msgs.iterArbidFrames([self.rx_arbid], start_idx, idx + 1):
+            if len(fdata) and fdata[0] >> 4 in (0, 1):
+                first_ts = ts
+        return first_ts
+
     def xmit_recv(self, data, extflag=0, count=1, service=None):
-        msg, idx = self.c.ISOTPxmit_recv(self.tx_arbid, self.rx_arbid, data, extflag, self.timeout, count, service)
+        latency = self.latency
+        timeout = self.timeout
+        first_timeout = None
+        attempt = 0
+        while True:
+            if latency is not None:
+                # the learned timeout is only for the response to start, a long
+                # multi-frame one still gets the whole timeout to come in
+                first_timeout = latency.getTimeout(self.timeout, attempt)
+                start_idx = self.c.getCanMsgCount()
+
+            start = time.time()
+            msg, idx = self.c.ISOTPxmit_recv(self.tx_arbid, self.rx_arbid, data, extflag, timeout, count, service,
+                                             first_timeout=first_timeout)
+            if latency is None:
+                break
+
+            if msg is not None:
+                first_ts = self._first_frame_ts(start_idx, idx)
+                latency.addSample((first_ts or time.time()) - start)
+                break
+
+            latency.timeouts += 1
+            if attempt >= latency.retries or first_timeout >= self.timeout or time.time() - start >= self.timeout:
+                # no quicker to try again
+                break
+
+            # maybe just slower than usual, try again with longer to wait
+            attempt += 1
+            latency.retried += 1
 
         # Process response
         svc = data[0]
@@ -226,8 +340,15 @@ class UDS(object):
                 # Don't throw an exception for
                 # ResponseCorrectlyReceivedResponsePending
                 if errcode == 0x78:
+                    if latency is not None:
+                        # the learned timeout is for the first answer, from now on
+                        # the ECU has P2* to come up with the real one
+                        latency.pending += 1
+                        timeout = max(self.timeout, P2_STAR_TIMEOUT)
+
                     # Try again but increment the start index
-                    msg, idx = self.c._isotp_get_msg(self.rx_arbid, start_index=idx+1, service=service, timeout=self.timeout)
+                    msg, idx = self.c._isotp_get_msg(self.rx_arbid, start_index=idx+1, service=service, timeout=timeout,
+                                                     tx_arbid=self.tx_arbid, extflag=extflag)
                 else:
                     raise NegativeResponseException(errcode, svc, msg)
 
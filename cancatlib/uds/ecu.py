@@ -1,9 +1,17 @@
 # ECU class
 
+import copy
 import time
+import functools
+import threading
 
-from cancatlib.uds import utils, UDS, SVC_SECURITY_ACCESS, NegativeResponseException
+from cancatlib.uds import utils, UDS, ResponseLatency, SVC_SECURITY_ACCESS, NegativeResponseException
 from cancatlib.utils import log
+from cancatlib.utils.types import ScanBitmap
+
+# the scans go through this many values at a time, results and scan progress
+# are merged into the ECU after each chunk
+CHECKPOINT_CHUNK = 16
 
 
 class ScanClass(UDS):
@@ -37,7 +45,8 @@ class ScanClass(UDS):
 class ECU(object):
     # Add the kwargs param so we can construct an ECUAddress out of a dictionary
     # that has extra stuff in it
-    def __init__(self, c, addr, scancls=None, timeout=3.0, delay=None, sessions=None, **kwargs):
+    def __init__(self, c, addr, scancls=None, timeout=3.0, delay=None, sessions=None,
+                 adaptive_timeout=True, latency=None, scanned=None, **kwargs):
         self._addr = addr  # (arb_id, resp_id, extflag)
         if scancls is None:
             self._scancls = ScanClass
@@ -46,6 +55,17 @@ class ECU(object):
         self._timeout = timeout
         self._delay = delay
         self.c = c
+        # the scans update the results while canmap may be saving them (or
+        # scanning other ECUs at the same time), see export()
+        self._lock = threading.RLock()
+
+        # learn how fast this ECU answers, so the scans don't have to wait the
+        # whole timeout for requests it ignores (the timeouts become the most
+        # they'll wait).  carry the counts over from earlier results
+        if adaptive_timeout:
+            self._latency = ResponseLatency(**(latency or {}))
+        else:
+            self._latency = None
 
         if sessions is not None:
             # TODO: probably need to validate/massage this object instead of
@@ -54,91 +74,165 @@ class ECU(object):
         else:
             self._sessions = {1: {'dids': {}}}
 
+        # what has been scanned so far, so an interrupted scan can be resumed:
+        # {phase: {session: ScanBitmap}}
+        self._scanned = {}
+        if scanned:
+            for phase, bitmaps in scanned.items():
+                self._scanned[phase] = dict((sess, ScanBitmap(val)) for sess, val in bitmaps.items())
+
     def export(self):
         import collections
         data = collections.OrderedDict()
         data['tx_arbid'] = self._addr.tx_arbid
         data['rx_arbid'] = self._addr.rx_arbid
         data['extflag'] = self._addr.extflag
-        data['sessions'] = self._sessions
+        with self._lock:
+            data['sessions'] = copy.deepcopy(self._sessions)
+            data['scanned'] = dict((phase, dict((sess, str(bitmap)) for sess, bitmap in bitmaps.items()))
+                                   for phase, bitmaps in self._scanned.items())
+        if self._latency is not None:
+            data['latency'] = self._latency.export()
         return data
 
-    def did_read_scan(self, did_range, rescan=False):
+    def _uds(self, timeout):
+        arb, resp, ext = self._addr
+        u = self._scancls(self.c, arb, resp, extflag=ext, verbose=False, timeout=timeout)
+        u.latency = self._latency
+        return u
+
+    def _scan_todo(self, phase, sess, values, results, resume):
+        # When resuming, only the values that haven't been scanned (or don't
+        # have results already) are left to do, otherwise the phase starts over
+        with self._lock:
+            bitmaps = self._scanned.setdefault(phase, {})
+            if not resume or sess not in bitmaps:
+                bitmaps[sess] = ScanBitmap()
+            scanned = bitmaps[sess]
+
+        if not resume:
+            return list(values)
+        return [v for v in values if v not in scanned and v not in results]
+
+    def _scan_chunks(self, phase, sess, values, scan, results):
+        # scan(chunk) returns the results for a chunk of values, they're merged
+        # in together with the progress so a saved checkpoint never says more
+        # has been scanned than there are results for
+        scanned = self._scanned[phase][sess]
+        for i in range(0, len(values), CHECKPOINT_CHUNK):
+            chunk = values[i:i+CHECKPOINT_CHUNK]
+            chunk_results = scan(chunk)
+            with self._lock:
+                results.update(chunk_results)
+                scanned.update(chunk)
+
+    def did_read_scan(self, did_range, rescan=False, resume=False):
         # Only do a scan if we don't already have data, unless rescan is set
-        if not self._sessions[1]['dids'] or rescan:
-            arb, resp, ext = self._addr
+        # or we're picking up where an earlier scan left off
+        if not self._sessions[1]['dids'] or rescan or resume:
+            dids = self._sessions[1]['dids']
+            todo = self._scan_todo('dids', 1, did_range, dids, resume and not rescan)
+            if not todo:
+                return
+
             log.msg('{} starting DID scan'.format(self._addr))
             # The DID scan is more reliable using the standard UDS timeout
             # because of the length of time that block transfers can take
-            u = self._scancls(self.c, arb, resp, extflag=ext, verbose=False, timeout=3.0)
-            self._sessions[1]['dids'].update(utils.did_read_scan(u, did_range, delay=self._delay))
+            # (with adaptive timeouts that's only the most it will wait)
+            u = self._uds(3.0)
+            utils.did_read_scan_start(u, did_range, self._delay)
+            self._scan_chunks('dids', 1, todo,
+                              lambda chunk: utils.did_read_scan(u, chunk, delay=self._delay, bookmark=False), dids)
 
     def did_write_scan(self, did_range, rescan=False):
         # Only do a scan if we don't already have data, unless rescan is set
         if not self._sessions[1]['write_dids'] or rescan:
             # Attempt to write an empty array, which probably won't succeed?
             # but if it does we're pretty screwed.
-            arb, resp, ext = self._addr
             log.msg('{} starting DID write scan'.format(self._addr))
-            u = self._scancls(self.c, arb, resp, extflag=ext, verbose=False, timeout=self._timeout)
-            self._write_dids.update(utils.did_write_scan(u, did_range, b'', delay=self._delay))
+            u = self._uds(self._timeout)
+            results = utils.did_write_scan(u, did_range, b'', delay=self._delay)
+            with self._lock:
+                self._write_dids.update(results)
 
-    def session_scan(self, session_range, rescan=False, rescan_did_range=None, recursive_scan=True):
-        arb, resp, ext = self._addr
+    def session_scan(self, session_range, rescan=False, rescan_did_range=None, recursive_scan=True, resume=False):
         # Unfortunately session scanning (and the later DID scanning) is more
         # reliable with the standard 3 second timeout
-        u = self._scancls(self.c, arb, resp, extflag=ext, verbose=False, timeout=3.0)
+        u = self._uds(3.0)
 
         log.msg('{} starting session scan'.format(self._addr))
 
-        # Only scan for new sessions if the session list consists only of session 1
-        if len(self._sessions) == 1:
+        # Only scan for new sessions if the session list consists only of session
+        # 1, or an earlier scan didn't finish.  The (recursive) session scan
+        # resets the ECU between sessions, so it's checkpointed as a whole
+        with self._lock:
+            scanned = self._scanned.setdefault('sessions', {}).get(1)
+        if len(self._sessions) == 1 or \
+                (resume and (scanned is None or any(s not in scanned for s in session_range))):
             new_sessions = utils.session_scan(u, session_range, delay=self._delay,
                                               recursive_scan=recursive_scan)
-            self._sessions.update(new_sessions)
+            with self._lock:
+                self._sessions.update(new_sessions)
+                self._scanned['sessions'][1] = ScanBitmap()
+                self._scanned['sessions'][1].update(session_range)
 
         # For each session that was found, go through the list of DIDs and
         # identify which DIDs can be read in this session
         for sess in self._sessions:
             if sess != 1 and 'resp' in self._sessions[sess] and \
-                    (rescan or 'dids' not in self._sessions[sess] or len(self._sessions[sess]['dids']) == 0):
+                    (rescan or resume or 'dids' not in self._sessions[sess] or len(self._sessions[sess]['dids']) == 0):
+                # If rescan is set do a full DID scan instead of the short
+                # scan of only existing DIDs
+                if rescan:
+                    did_range = rescan_did_range
+                else:
+                    did_range = [d for d in self._sessions[1]['dids']]
+
+                with self._lock:
+                    if rescan or not resume:
+                        self._sessions[sess]['dids'] = {}
+                    dids = self._sessions[sess].setdefault('dids', {})
+                todo = self._scan_todo('dids', sess, did_range, dids, resume and not rescan)
+                if not todo:
+                    continue
+
                 try:
                     with utils.new_session(u, sess, self._sessions[sess]['prereqs'], True):
                         log.debug('{} session {} ({}) re-reading DIDs'.format(
                             self._addr, sess, self._sessions[sess]['prereqs']))
 
-                        self._sessions[sess]['dids'] = {}
-                        # If rescan is set do a full DID scan instead of the short
-                        # scan of only existing DIDs
-                        if rescan:
-                            results = utils.did_read_scan(u, rescan_did_range, delay=self._delay)
-                            self._sessions[sess]['dids'].update(results)
-                        else:
-                            valid_did_range = [d for d in self._sessions[1]['dids']]
-                            results = utils.did_read_scan(u, valid_did_range, delay=self._delay)
-                            self._sessions[sess]['dids'].update(results)
+                        utils.did_read_scan_start(u, did_range, self._delay)
+                        self._scan_chunks('dids', sess, todo,
+                                          lambda chunk: utils.did_read_scan(u, chunk, delay=self._delay,
+                                                                            bookmark=False),
+                                          dids)
                 except NegativeResponseException as e:
                     log.error('Failed to enter session {} ({}) to re-scan DIDs, try again later: {}'.format(
                         sess, self._sessions[sess]['prereqs'], e))
 
-    def auth_scan(self, auth_range, rescan=False):
-        arb, resp, ext = self._addr
-        u = self._scancls(self.c, arb, resp, extflag=ext, verbose=False, timeout=self._timeout)
+    def auth_scan(self, auth_range, rescan=False, resume=False):
+        u = self._uds(self._timeout)
         u.StartTesterPresent(request_response=False)
 
         for sess in self._sessions:
             if sess != 1 and \
                     ('auth' not in self._sessions[sess] or
-                     len(self._sessions[sess]['auth']) == 0 or rescan):
+                     len(self._sessions[sess]['auth']) == 0 or rescan or resume):
+                with self._lock:
+                    auth = self._sessions[sess].setdefault('auth', {})
+                todo = self._scan_todo('auth', sess, auth_range, auth, resume and not rescan)
+                if not todo:
+                    continue
+
                 log.msg('{} session {} starting auth scan'.format(self._addr, sess))
                 with utils.new_session(u, sess, self._sessions[sess]['prereqs'], True):
                     # Pass the get_key() function in the UDS scan class through
-                    results = utils.auth_scan(u, auth_range, lambda x: u.get_key(sess, x), delay=self._delay)
-
-                    if 'auth' in self._sessions[sess]:
-                        self._sessions[sess]['auth'].update(results)
-                    else:
-                        self._sessions[sess]['auth'] = results
+                    key_func = functools.partial(u.get_key, sess)
+                    utils.auth_scan_start(u, auth_range, key_func, self._delay)
+                    self._scan_chunks('auth', sess, todo,
+                                      lambda chunk: utils.auth_scan(u, chunk, key_func, delay=self._delay,
+                                                                    bookmark=False),
+                                      auth)
 
     def _try_key(self, u, auth_level, key):
         resp = utils.try_auth(u, auth_level, key)
@@ -173,8 +267,7 @@ class ECU(object):
         log.msg('{} starting key/seed length scan {}'.format(self._addr, len_range))
         self.c.placeCanBookmark('canmap key_length_scan({}, delay={})'.format(len_range, self._delay))
 
-        arb, resp, ext = self._addr
-        u = self._scancls(self.c, arb, resp, extflag=ext, verbose=False, timeout=self._timeout)
+        u = self._uds(self._timeout)
         u.StartTesterPresent(request_response=False)
 
         # I can't think of a good way to turn this into a more generic utility
@@ -189,16 +282,17 @@ class ECU(object):
                     if not self._found_key_len(sess, lvl) or rescan:
                         # TODO: For now, we delete the old scan data, not sure how
                         # best to track to new vs. old key key scans otherwise
-                        self._sessions[sess]['auth'][lvl] = {'seeds': []}
+                        with self._lock:
+                            self._sessions[sess]['auth'][lvl] = {'seeds': []}
                         log.msg('{} session {} auth {} starting key length scan'.format(self._addr, sess, lvl))
                         for keylen in len_range:
                             key = '\x00' * keylen
                             log.detail('Trying session {}, auth {}, key \'{}\''.format(sess, lvl, key))
                             self.c.placeCanBookmark('SecurityAccess({}, {})'.format(sess, repr(key)))
                             resp = self._try_key(u, lvl, key)
-                            self._sessions[sess]['auth'][lvl].update(resp)
-
-                            self._sessions[sess]['auth'][lvl]['seeds'].append(dict(u.seed))
+                            with self._lock:
+                                self._sessions[sess]['auth'][lvl].update(resp)
+                                self._sessions[sess]['auth'][lvl]['seeds'].append(dict(u.seed))
 
                             if 'resp' in resp:
                                 # Get the key attempted from the recorded seed data
@@ -3,6 +3,7 @@
 import time
 import string
 import struct
+from bisect import bisect_left, bisect_right
 from contextlib import contextmanager
 
 from cancatlib import uds, ARBID_29BIT
@@ -10,6 +11,15 @@ from cancatlib.uds import UDS
 from cancatlib.utils import log
 from cancatlib.utils.types import ECUAddress, _range_func
 
+# ecu_probe_scan(): addresses waiting on a response at once, the share of the
+# bus the probes may take (and most probes sent back to back), the bitrate to
+# assume if it isn't known, and bits on the wire per 8 byte probe frame
+# (11-bit, 29-bit; with worst case stuffing)
+PROBE_WINDOW = 64
+PROBE_MAX_BUSLOAD = .3
+PROBE_BURST = 16
+PROBE_DEFAULT_BITRATE = 500000
+PROBE_FRAME_BITS = (135, 160)
 
 def get_uds_29bit_srcid(arbid):
     consts = uds.ARBID_CONSTS[ARBID_29BIT]
@@ -70,16 +80,20 @@ def enter_session(u, session, prereq_sessions=None):
 @contextmanager
 def new_session(u, session, prereq_sessions=None, tester_present=False):
     try:
-        # Enter any required preq sessions
-        if prereq_sessions:
-            for prereq in prereq_sessions:
-                enter_session(u, prereq)
+        try:
+            # Enter any required preq sessions
+            if prereq_sessions:
+                for prereq in prereq_sessions:
+                    enter_session(u, prereq)
 
-        msg = u.DiagnosticSessionControl(session)
+            msg = u.DiagnosticSessionControl(session)
 
-        # Start tester present again
-        if tester_present:
-            u.StartTesterPresent(request_response=False)
+            # Start tester present again
+            if tester_present:
+                u.StartTesterPresent(request_response=False)
+        except uds.UDSTimeout as e:
+            # no answer, let the caller see None
+            msg = None
 
         yield msg
     except uds.UDSTimeout as e:
@@ -153,21 +167,7 @@ def did_str(did):
         return hex(did)
 
 
-def ecu_did_scan(c, arb_id_range, ext=0, did=0xf190, udscls=None, timeout=3.0,  # noqa: C901
-                 delay=None, verbose_flag=False):
-    scan_type = ''
-    if ext:
-        scan_type = ' ext'
-
-    if udscls is None:
-        udscls = UDS
-
-    log.debug('Starting{} DID read ECU scan for range: {}'.format(scan_type, arb_id_range))
-    c.placeCanBookmark('ecu_did_scan({}, ext={}, did={}, timeout={}, delay={})'.format(
-        arb_id_range, ext, did, timeout, delay))
-
-    ecus = []
-    possible_ecus = []
+def gen_scan_addrs(arb_id_range, ext=0):
     for i in arb_id_range:
         tester_id = uds.ARBID_CONSTS[ext]['tester']
         if i == tester_id:
@@ -177,64 +177,179 @@ def ecu_did_scan(c, arb_id_range, ext=0, did=0xf190, udscls=None, timeout=3.0,
             continue
 
         arb_id, resp_id = gen_arbids(i, ext)
-        addr = ECUAddress(arb_id, resp_id, ext)
-        u = udscls(c, addr.tx_arbid, addr.rx_arbid, extflag=addr.extflag,
-                   verbose=verbose_flag, timeout=timeout)
-        log.detail('Trying {}'.format(addr))
-
-        try:
-            start_index = u.c.getCanMsgCount()
-            msg = u.ReadDID(did)
-            if msg is not None:
-                log.debug('{} DID {}: {}'.format(addr, hex(did), repr(msg)))
-                log.msg('found {}'.format(addr))
-
-                ecus.append(addr)
-            else:
-                tx_msg, responses = find_possible_resp(u, start_index, arb_id, uds.SVC_READ_DATA_BY_IDENTIFIER, did, timeout)
-                if responses:
-                    log.warn('Possible non-standard responses for {} found:'.format(hex(addr.tx_arbid)))
-                    for rx_arbid, msg in responses:
-                        log.warn('{}: {}'.format(hex(rx_arbid), msg.hex()))
-                    possible_ecus.append(ECUAddress(arb_id, rx_arbid, ext))
-        except uds.UDSTimeout as e:
-            pass
-        except uds.NegativeResponseException as e:
-            log.debug('{} DID {}: {}'.format(addr, hex(did), e))
-            log.msg('found {}'.format(addr))
-
-            # If a negative response happened, that means an ECU is present
-            # to respond at this address.
-            ecus.append(addr)
-
-        if delay:
-            time.sleep(delay)
-
-    # Double check any non-standard responses that were found
-    if possible_ecus:
-        log.detail('Retrying possible non-standard ECU addresses')
-    for addr in possible_ecus:
+        yield ECUAddress(arb_id, resp_id, ext)
+
+
+def _probe_payload(data):
+    # The UDS payload of a single or first ISO-TP frame
+    ftype = data[0] >> 4 if data else None
+    if ftype == 0:
+        return data[1:1+(data[0] & 0xf)]
+    elif ftype == 1:
+        return data[2:]
+    return b''
+
+
+def ecu_probe_scan(c, addrs, request, response, timeout=3.0, window=PROBE_WINDOW,
+                   max_busload=PROBE_MAX_BUSLOAD):
+    """
+    Send a single frame UDS request to each ECUAddress in addrs, keeping up
+    to window of them waiting on a response at once, and watch every rx
+    arbid in the same pass.  Probes are paced so they take no more than
+    max_busload of the bus bitrate.
+
+    An address is found if its rx arbid answers with response (the start of
+    the positive response) or a negative response to the service.
+
+    With many probes out at once there's no telling which one an answer on
+    some other arbid in the response range (or a standard answer that came
+    after its probe gave up) belongs to.  Every address probed within
+    timeout before it is a possible ECU on that arbid, the likeliest first:
+    its own probe for a late answer, then the ones sent about as long
+    before it as the standard answers took.  These need checking one at a
+    time (see _verify_ecus(), first_per_rx).
+
+    Returns (found, possible) ECUAddress lists, found in addrs order.
+    """
+    addrs = list(addrs)
+    service = request[0]
+    neg_match = struct.pack('>BB', uds.SVC_NEGATIVE_RESPONSE, service)
+    probe = (struct.pack('>B', len(request)) + request).ljust(8, b'\x00')
+
+    bitrate = c.getCanBitrate() or PROBE_DEFAULT_BITRATE
+    rates = [max_busload * bitrate / bits for bits in PROBE_FRAME_BITS]
+
+    # arbids a non-standard response could come back on
+    resp_ranges = {}
+    for addr in addrs:
+        if addr.tx_arbid not in resp_ranges:
+            resp_ranges[addr.tx_arbid] = gen_uds_resp_range(addr.tx_arbid)
+    watch = set()
+    for rx_range in set(resp_ranges.values()):
+        watch.update(rx_range)
+
+    found = set()
+    answered = set()    # rx arbids that belong to a found address
+    possible = []
+    delays = []         # how long the standard answers took
+    waiting = {}        # rx arbid -> (addr, deadline)
+    probed = {}         # rx arbid -> (addr, sent) of its last probe, even once it's given up
+    sent_idx = []       # message count when each probe went out
+    sent_ts = []
+    sent_addrs = []
+    sent_tx = set()     # to spot the echoes
+    pos = 0
+    credit = 1.0        # probes the bus-load cap allows right now
+    last = time.time()
+    idx = c.getCanMsgCount()
+
+    while pos < len(addrs) or waiting:
+        now = time.time()
+        for rx_arbid, (addr, deadline) in list(waiting.items()):
+            if deadline <= now:
+                del waiting[rx_arbid]
+
+        if pos < len(addrs):
+            rate = rates[addrs[pos].extflag]
+            credit = min(credit + (now - last) * rate, PROBE_BURST)
+        last = now
+
+        # send as many new probes as the window and the bus-load cap allow.
+        # an rx arbid can only be waited on by one probe at a time
+        batch = []
+        sendidx = c.getCanMsgCount()
+        while pos < len(addrs) and len(waiting) < window and credit >= 1:
+            addr = addrs[pos]
+            if addr.rx_arbid in waiting or (batch and addr.extflag != batch[0].extflag):
+                break
+
+            log.detail('Trying {}'.format(addr))
+            waiting[addr.rx_arbid] = (addr, now + timeout)
+            probed[addr.rx_arbid] = (addr, now)
+            sent_idx.append(sendidx)
+            sent_ts.append(now)
+            sent_addrs.append(addr)
+            sent_tx.add(addr.tx_arbid)
+            batch.append(addr)
+            credit -= 1
+            pos += 1
+
+        if batch:
+            c.CANxmitBatch([(addr.tx_arbid, probe) for addr in batch], extflag=batch[0].extflag)
+
+        # sort out whatever has come back
+        count = c.getCanMsgCount()
+        if count > idx:
+            # genCanMsgs() timestamps are relative to the first message
+            startts = c.getCanMsgQueue().getStartTimestamp()
+            for fidx, ts, arbid, data in c.genCanMsgs(start=idx, stop=count-1):
+                if data == probe and arbid in sent_tx:
+                    continue
+
+                payload = _probe_payload(data)
+                if payload[:len(response)] != response and payload[:2] != neg_match:
+                    continue
+
+                ts += startts
+                if arbid in waiting:
+                    addr = waiting.pop(arbid)[0]
+                    log.debug('{} answered: {}'.format(addr, data.hex()))
+                    found.add(addr)
+                    answered.add(arbid)
+                    delays.append(ts - probed[arbid][1])
+
+                elif arbid in watch and sent_idx and arbid not in answered:
+                    log.warn('Possible non-standard response found:')
+                    log.warn('{}: {}'.format(hex(arbid), data.hex()))
+
+                    # the probes that went out in the timeout before this came in
+                    lo = bisect_left(sent_ts, ts - timeout)
+                    hi = bisect_right(sent_idx, fidx)
+                    delay = sorted(delays)[len(delays) // 2] if delays else 0
+                    window_addrs = [(abs(ts - sent_ts[x] - delay), sent_addrs[x]) for x in range(lo, hi)
+                                    if arbid in resp_ranges[sent_addrs[x].tx_arbid]]
+                    candidates = [addr for dist, addr in sorted(window_addrs, key=lambda x: x[0])]
+                    if arbid in probed and arbid not in waiting:
+                        # its own probe, given up on too soon?
+                        candidates.insert(0, probed[arbid][0])
+
+                    for addr in candidates:
+                        possible_addr = ECUAddress(addr.tx_arbid, arbid, addr.extflag)
+                        if possible_addr not in possible:
+                            possible.append(possible_addr)
+            idx = count
+
+        # sleep until something comes in, the next probe can go, or a probe times out
+        wake = [deadline for addr, deadline in waiting.values()]
+        if pos < len(addrs) and len(waiting) < window:
+            wake.append(now + max(0, 1 - credit) / rates[addrs[pos].extflag])
+        if wake:
+            c.waitForCanMsgs(idx, max(0, min(wake) - time.time()))
+
+    return [addr for addr in addrs if addr in found], possible
+
+
+def _verify_ecus(c, addrs, check, udscls, timeout, delay, verbose_flag, skip_obd2=True, first_per_rx=False):
+    # Confirm addresses with a real request through udscls.  With
+    # first_per_rx, addrs are candidates for the arbids they'd answer on,
+    # likeliest first, and the rest are skipped once one is confirmed
+    ecus = []
+    confirmed = set()
+    for addr in addrs:
         # if the TX ID is the OBD2 request ID, skip it
-        if addr.tx_arbid == uds.ARBID_CONSTS[addr.extflag]['obd2_broadcast']:
+        if skip_obd2 and addr.tx_arbid == uds.ARBID_CONSTS[addr.extflag]['obd2_broadcast']:
             log.detail('Skipping OBD2 broadcast address ECU {}'.format(addr))
             continue
+        if first_per_rx and addr.rx_arbid in confirmed:
+            continue
 
         u = udscls(c, addr.tx_arbid, addr.rx_arbid, extflag=addr.extflag,
                    verbose=verbose_flag, timeout=timeout)
         log.detail('Checking for possible ECU {}'.format(addr))
-        try:
-            msg = u.ReadDID(did)
-            if msg is not None:
-                log.debug('{} DID {}: {}'.format(addr, hex(did), repr(msg)))
-                log.msg('found {}'.format(addr))
-                ecus.append(addr)
-        except uds.NegativeResponseException as e:
-            log.debug('{} DID {}: {}'.format(addr, hex(did), e))
+        if check(u, addr):
             log.msg('found {}'.format(addr))
-
-            # If a negative response happened, that means an ECU is present
-            # to respond at this address.
             ecus.append(addr)
+            confirmed.add(addr.rx_arbid)
 
         if delay:
             time.sleep(delay)
@@ -242,8 +357,13 @@ def ecu_did_scan(c, arb_id_range, ext=0, did=0xf190, udscls=None, timeout=3.0,
     return ecus
 
 
-def ecu_session_scan(c, arb_id_range, ext=0, session=1, udscls=None, timeout=3.0,  # noqa: C901
-                     delay=None, verbose_flag=False):
+def ecu_did_scan(c, arb_id_range, ext=0, did=0xf190, udscls=None, timeout=3.0,  # noqa: C901
+                 delay=None, verbose_flag=False, parallel=None, max_busload=PROBE_MAX_BUSLOAD):
+    """
+    Find ECUs by reading a DID from every address in arb_id_range.  With
+    parallel=N, N addresses are probed at once (see ecu_probe_scan) and the
+    ones that answer are confirmed with a ReadDID through udscls
+    """
     scan_type = ''
     if ext:
         scan_type = ' ext'
@@ -251,81 +371,154 @@ def ecu_session_scan(c, arb_id_range, ext=0, session=1, udscls=None, timeout=3.0
     if udscls is None:
         udscls = UDS
 
-    log.debug('Starting{} Session ECU scan for range: {}'.format(scan_type, arb_id_range))
-    c.placeCanBookmark('ecu_session_scan({}, ext={}, session={}, timeout={}, delay={})'.format(
-        arb_id_range, ext, session, timeout, delay))
-
-    ecus = []
-    possible_ecus = []
-    for i in arb_id_range:
-        tester_id = uds.ARBID_CONSTS[ext]['tester']
-        if i == tester_id:
-            # Skip i == 0xF1 because in that case the sender and receiver IDs
-            # are the same
-            log.detail('Skipping {} in ext ECU scan: invalid ECU address'.format(hex(tester_id)))
-            continue
-
-        arb_id, resp_id = gen_arbids(i, ext)
-        addr = ECUAddress(arb_id, resp_id, ext)
-        u = udscls(c, addr.tx_arbid, addr.rx_arbid, extflag=addr.extflag,
-                   verbose=verbose_flag, timeout=timeout)
-        log.detail('Trying {}'.format(addr))
+    log.debug('Starting{} DID read ECU scan for range: {}'.format(scan_type, arb_id_range))
+    c.placeCanBookmark('ecu_did_scan({}, ext={}, did={}, timeout={}, delay={}, parallel={})'.format(
+        arb_id_range, ext, did, timeout, delay, parallel))
 
+    def check(u, addr):
         try:
-            start_index = u.c.getCanMsgCount()
-            with new_session(u, session) as msg:
+            msg = u.ReadDID(did)
+            if msg is not None:
+                log.debug('{} DID {}: {}'.format(addr, hex(did), repr(msg)))
+                return True
+        except uds.UDSTimeout as e:
+            pass
+        except uds.NegativeResponseException as e:
+            log.debug('{} DID {}: {}'.format(addr, hex(did), e))
+
+            # If a negative response happened, that means an ECU is present
+            # to respond at this address.
+            return True
+        return False
+
+    if parallel:
+        found, possible_ecus = ecu_probe_scan(
+                c, gen_scan_addrs(arb_id_range, ext), struct.pack('>BH', uds.SVC_READ_DATA_BY_IDENTIFIER, did),
+                struct.pack('>BH', uds.SVC_READ_DATA_BY_IDENTIFIER + 0x40, did), timeout, parallel, max_busload)
+        ecus = _verify_ecus(c, found, check, udscls, timeout, delay, verbose_flag, skip_obd2=False)
+        possible_ecus = [addr for addr in possible_ecus if addr not in ecus]
+    else:
+        ecus = []
+        possible_ecus = []
+        for addr in gen_scan_addrs(arb_id_range, ext):
+            u = udscls(c, addr.tx_arbid, addr.rx_arbid, extflag=addr.extflag,
+                       verbose=verbose_flag, timeout=timeout)
+            log.detail('Trying {}'.format(addr))
+
+            try:
+                start_index = u.c.getCanMsgCount()
+                msg = u.ReadDID(did)
                 if msg is not None:
-                    log.debug('{} session {}: {}'.format(addr, session, repr(msg)))
+                    log.debug('{} DID {}: {}'.format(addr, hex(did), repr(msg)))
                     log.msg('found {}'.format(addr))
 
                     ecus.append(addr)
                 else:
-                    tx_msg, responses = find_possible_resp(
-                            u, start_index, arb_id, uds.SVC_DIAGNOSTICS_SESSION_CONTROL, session, timeout)
+                    tx_msg, responses = find_possible_resp(u, start_index, addr.tx_arbid, uds.SVC_READ_DATA_BY_IDENTIFIER, did, timeout)
                     if responses:
                         log.warn('Possible non-standard responses for {} found:'.format(hex(addr.tx_arbid)))
                         for rx_arbid, msg in responses:
                             log.warn('{}: {}'.format(hex(rx_arbid), msg.hex()))
-                        possible_ecus.append(ECUAddress(arb_id, rx_arbid, ext))
-        except uds.NegativeResponseException as e:
-            log.debug('{} session {}: {}'.format(addr, session, e))
-            log.msg('found {}'.format(addr))
+                        possible_ecus.append(ECUAddress(addr.tx_arbid, rx_arbid, ext))
+            except uds.UDSTimeout as e:
+                pass
+            except uds.NegativeResponseException as e:
+                log.debug('{} DID {}: {}'.format(addr, hex(did), e))
+                log.msg('found {}'.format(addr))
 
-            # If a negative response happened, that means an ECU is present
-            # to respond at this address.
-            ecus.append(addr)
+                # If a negative response happened, that means an ECU is present
+                # to respond at this address.
+                ecus.append(addr)
 
-        if delay:
-            time.sleep(delay)
+            if delay:
+                time.sleep(delay)
 
     # Double check any non-standard responses that were found
     if possible_ecus:
         log.detail('Retrying possible non-standard ECU addresses')
-    for addr in possible_ecus:
-        # if the TX ID is the OBD2 request ID, skip it
-        if addr.tx_arbid == uds.ARBID_CONSTS[addr.extflag]['obd2_broadcast']:
-            log.detail('Skipping OBD2 broadcast address ECU {}'.format(addr))
-            continue
+    ecus.extend(_verify_ecus(c, possible_ecus, check, udscls, timeout, delay, verbose_flag,
+                             first_per_rx=bool(parallel)))
 
-        u = udscls(c, addr.tx_arbid, addr.rx_arbid, extflag=addr.extflag,
-                   verbose=verbose_flag, timeout=timeout)
-        log.detail('Trying {}'.format(addr))
+    return ecus
+
+
+def ecu_session_scan(c, arb_id_range, ext=0, session=1, udscls=None, timeout=3.0,  # noqa: C901
+                     delay=None, verbose_flag=False, parallel=None, max_busload=PROBE_MAX_BUSLOAD):
+    """
+    Find ECUs by requesting a diagnostic session from every address in
+    arb_id_range.  parallel=N works like it does for ecu_did_scan
+    """
+    scan_type = ''
+    if ext:
+        scan_type = ' ext'
+
+    if udscls is None:
+        udscls = UDS
+
+    log.debug('Starting{} Session ECU scan for range: {}'.format(scan_type, arb_id_range))
+    c.placeCanBookmark('ecu_session_scan({}, ext={}, session={}, timeout={}, delay={}, parallel={})'.format(
+        arb_id_range, ext, session, timeout, delay, parallel))
+
+    def check(u, addr):
         try:
             with new_session(u, session) as msg:
                 if msg is not None:
                     log.debug('{} session {}: {}'.format(addr, session, repr(msg)))
-                    log.msg('found {}'.format(addr))
-                    ecus.append(addr)
+                    return True
         except uds.NegativeResponseException as e:
             log.debug('{} session {}: {}'.format(addr, session, e))
-            log.msg('found {}'.format(addr))
 
             # If a negative response happened, that means an ECU is present
             # to respond at this address.
-            ecus.append(addr)
+            return True
+        return False
+
+    if parallel:
+        found, possible_ecus = ecu_probe_scan(
+                c, gen_scan_addrs(arb_id_range, ext), struct.pack('>BB', uds.SVC_DIAGNOSTICS_SESSION_CONTROL, session),
+                struct.pack('>BB', uds.SVC_DIAGNOSTICS_SESSION_CONTROL + 0x40, session), timeout, parallel, max_busload)
+        ecus = _verify_ecus(c, found, check, udscls, timeout, delay, verbose_flag, skip_obd2=False)
+        possible_ecus = [addr for addr in possible_ecus if addr not in ecus]
+    else:
+        ecus = []
+        possible_ecus = []
+        for addr in gen_scan_addrs(arb_id_range, ext):
+            u = udscls(c, addr.tx_arbid, addr.rx_arbid, extflag=addr.extflag,
+                       verbose=verbose_flag, timeout=timeout)
+            log.detail('Trying {}'.format(addr))
+
+            try:
+                start_index = u.c.getCanMsgCount()
+                with new_session(u, session) as msg:
+                    if msg is not None:
+                        log.debug('{} session {}: {}'.format(addr, session, repr(msg)))
+                        log.msg('found {}'.format(addr))
+
+                        ecus.append(addr)
+                    else:
+                        tx_msg, responses = find_possible_resp(
+                                u, start_index, addr.tx_arbid, uds.SVC_DIAGNOSTICS_SESSION_CONTROL, session, timeout)
+                        if responses:
+                            log.warn('Possible non-standard responses for {} found:'.format(hex(addr.tx_arbid)))
+                            for rx_arbid, msg in responses:
+                                log.warn('{}: {}'.format(hex(rx_arbid), msg.hex()))
+                            possible_ecus.append(ECUAddress(addr.tx_arbid, rx_arbid, ext))
+            except uds.NegativeResponseException as e:
+                log.debug('{} session {}: {}'.format(addr, session, e))
+                log.msg('found {}'.format(addr))
 
-        if delay:
-            time.sleep(delay)
+                # If a negative response happened, that means an ECU is present
+                # to respond at this address.
+                ecus.append(addr)
+
+            if delay:
+                time.sleep(delay)
+
+    # Double check any non-standard responses that were found
+    if possible_ecus:
+        log.detail('Retrying possible non-standard ECU addresses')
+    ecus.extend(_verify_ecus(c, possible_ecus, check, udscls, timeout, delay, verbose_flag,
+                             first_per_rx=bool(parallel)))
 
     return ecus
 
@@ -346,9 +539,16 @@ def try_read_did(u, did):
     return data
 
 
-def did_read_scan(u, did_range, delay=None):
+def did_read_scan_start(u, did_range, delay=None):
     log.debug('Starting DID read scan for range: {}'.format(did_range))
     u.c.placeCanBookmark('did_read_scan({}, delay={})'.format(did_range, delay))
+
+
+def did_read_scan(u, did_range, delay=None, bookmark=True):
+    # bookmark=False when did_range is one piece of a bigger scan, which the
+    # caller marks once with did_read_scan_start()
+    if bookmark:
+        did_read_scan_start(u, did_range, delay)
     dids = {}
     for i in did_range:
         log.detail('Trying DID read {}'.format(hex(i)))
@@ -529,9 +729,15 @@ def try_auth(u, level, secret):
     return auth_data
 
 
-def auth_scan(u, auth_range, key_func=None, delay=None):
+def auth_scan_start(u, auth_range, key_func=None, delay=None):
     log.debug('Starting auth scan for range: {}'.format(auth_range))
     u.c.placeCanBookmark('auth_scan({}, key_func={}, delay={})'.format(auth_range, key_func, delay))
+
+
+def auth_scan(u, auth_range, key_func=None, delay=None, bookmark=True):
+    # bookmark=False for a piece of a bigger scan, like did_read_scan()
+    if bookmark:
+        auth_scan_start(u, auth_range, key_func, delay)
     auth_levels = {}
     for i in auth_range:
         if key_func:
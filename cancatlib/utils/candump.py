@@ -0,0 +1,137 @@
+# Streaming candump log reader and writer
+#
+# Lines look like:
+#   (1543509533.000838) can0 10FDA300#FFFF07FFFFFFFFFF ; optional comment
+#   (1543509533.000838) can0 7E8##1112233          CAN FD (flags nibble first)
+#   (1543509533.000838) can0 7DF#R                 remote request
+#
+# Frames are (timestamp, arbid, data) tuples, like CanMsgStore.appendFrame().
+
+from array import array
+from binascii import unhexlify
+
+
+def parseCandumpLine(line):
+    '''
+    returns (timestamp, arbid, data) for one candump log line (bytes), or None
+    for a blank one.  raises ValueError if it isn't candump format
+    '''
+    line = line.strip()
+    if not line:
+        return None
+
+    try:
+        if line[:1] != b'(':
+            raise ValueError()
+
+        close = line.index(b')')
+        ts = float(line[1:close])
+        # iface, frame, and maybe a comment
+        frame = line[close+1:].split(None, 2)[1]
+
+        arbid, sep, data = frame.partition(b'#')
+        if not sep:
+            raise ValueError()
+
+        if data[:1] == b'#':
+            # CAN FD: ##<flags><data>
+            data = data[2:]
+        elif data[:1] in (b'R', b'r'):
+            data = b''
+
+        return ts, int(arbid, 16), unhexlify(data)
+
+    except (ValueError, IndexError, TypeError):
+        raise ValueError('Invalid candump format: %r' % line)
+
+
+def readCandump(f):
+    '''
+    generator of (timestamp, arbid, data) for every frame in a candump log
+    (opened 'rb'), read a line at a time
+    '''
+    for line in f:
+        # fast path for plain classic CAN lines, anything else gets the full parse
+        try:
+            tspart, iface, frame = line.split(None, 3)[:3]
+            arbid, data = frame.split(b'#')
+            if tspart[:1] == b'(' and tspart[-1:] == b')':
+                yield float(tspart[1:-1]), int(arbid, 16), unhexlify(data)
+                continue
+        except ValueError:
+            pass
+
+        frame = parseCandumpLine(line)
+        if frame is not None:
+            yield frame
+
+
+def formatCandumpLine(ts, arbid, data, iface='vcan0'):
+    return '(%.6f) %s %08x#%s\n' % (ts, iface, arbid, data.hex())
+
+
+def writeCandump(f, frames, iface='vcan0'):
+    '''
+    write (timestamp, arbid, data) for every frame in an iterable to a
+    candump log opened 'w'.  returns how many were written
+    '''
+    count = 0
+    for ts, arbid, data in frames:
+        f.write(formatCandumpLine(ts, arbid, data, iface))
+        count += 1
+    return count
+
+
+def parseCandumpChunk(data):
+    '''
+    parse a piece of a candump log (bytes holding whole lines) into columns:
+    (timestamps, arbids, dlcs, offsets, payload), sorted by timestamp.
+    see convert.candump2cancat(), which hands these out to worker processes
+    '''
+    ts = array('d')
+    arbids = array('I')
+    dlcs = array('H')
+    offsets = array('Q')
+    payload = bytearray()
+    ordered = True
+    last = float('-inf')
+
+    for line in data.split(b'\n'):
+        try:
+            tspart, iface, frame = line.split(None, 3)[:3]
+            arbid, msg = frame.split(b'#')
+            if tspart[:1] != b'(' or tspart[-1:] != b')':
+                raise ValueError()
+            tstamp = float(tspart[1:-1])
+            arbid = int(arbid, 16)
+            msg = unhexlify(msg)
+
+        except ValueError:
+            frame = parseCandumpLine(line)
+            if frame is None:
+                continue
+            tstamp, arbid, msg = frame
+
+        if tstamp < last:
+            ordered = False
+        last = tstamp
+
+        ts.append(tstamp)
+        arbids.append(arbid)
+        dlcs.append(len(msg))
+        offsets.append(len(payload))
+        payload += msg
+
+    if not ordered:
+        order = sorted(range(len(ts)), key=ts.__getitem__)
+        sts = array('d', (ts[x] for x in order))
+        sarbids = array('I', (arbids[x] for x in order))
+        sdlcs = array('H', (dlcs[x] for x in order))
+        soffsets = array('Q')
+        spayload = bytearray()
+        for x in order:
+            soffsets.append(len(spayload))
+            spayload += payload[offsets[x]:offsets[x]+dlcs[x]]
+        ts, arbids, dlcs, offsets, payload = sts, sarbids, sdlcs, soffsets, spayload
+
+    return ts, arbids, dlcs, offsets, payload
@@ -1,124 +1,249 @@
 # Utility functions for CanCat
+#
+# Conversions stream frames from the input straight to the output, a chunk
+# at a time, so huge logs convert at disk speed in constant memory.  CanCat
+# sessions are written in the binary session format (see cancatlib.sessionfile).
+
+import os
+import heapq
+import multiprocessing
+from array import array
+from operator import itemgetter
 
-import re
-import pickle
 import cancatlib
-import struct
+from cancatlib import sessionfile
+from cancatlib.msgstore import CanMsgStore
+from cancatlib.utils import pcap
+from cancatlib.utils import candump
+
+# frames buffered before they're written out as one session chunk
+CHUNK_FRAMES = 0x10000
+IO_BUFSIZE = 1 << 20
+# candump logs are split into pieces this big for the worker processes
+CANDUMP_CHUNK_BYTES = 16 << 20
+
+
+def iterSessionFrames(session):
+    '''
+    generator of (timestamp, arbid, data) for the CAN messages of a CanCat
+    session file.  binary sessions are read straight from the file
+    '''
+    if sessionfile.isSessionFile(session):
+        for frame in sessionfile.iterSessionFrames(session, cancatlib.CMD_CAN_RECV):
+            yield frame
+        return
+
+    sess = cancatlib.loadCanSession(session)
+    msgs = sess['messages'].get(cancatlib.CMD_CAN_RECV)
+    if msgs is None:
+        return
+
+    if not isinstance(msgs, CanMsgStore):
+        msgs = CanMsgStore(msgs)
+
+    for idx, ts, arbid, data in msgs.iterFrames(msgs.getOldestIndex()):
+        yield ts, arbid, data
+
+
+def _newColumns():
+    return array('d'), array('I'), array('H'), array('Q'), bytearray()
+
+
+def _frameColumns(frames):
+    '''
+    (timestamp, arbid, data) frames to chunks of CHUNK_FRAMES columns
+    '''
+    cols = _newColumns()
+    ts, arbids, dlcs, offsets, payload = cols
+    for tstamp, arbid, data in frames:
+        ts.append(tstamp)
+        arbids.append(arbid)
+        dlcs.append(len(data))
+        offsets.append(len(payload))
+        payload += data
+
+        if len(ts) >= CHUNK_FRAMES:
+            yield cols
+            cols = _newColumns()
+            ts, arbids, dlcs, offsets, payload = cols
+
+    if len(ts):
+        yield cols
+
+
+def writeSessionColumns(output, chunks):
+    '''
+    write chunks of (timestamps, arbids, dlcs, offsets, payload) columns to a
+    new CanCat session file as they come.  returns a list of (first index,
+    count) of each chunk written
+    '''
+    cmd = cancatlib.CMD_CAN_RECV
+    count = 0
+    start_ts = None
+    runs = []
+    writer = sessionfile.SessionFileWriter(output)
+    try:
+        for cols in chunks:
+            if not len(cols[0]):
+                continue
+            if start_ts is None:
+                start_ts = cols[0][0]
+            written = writer.writeFrames(cmd, CanMsgStore.fromColumns(*cols, first_idx=count))
+            runs.append((count, written))
+            count += written
+
+        # loaders take the last META, so it can go at the end
+        writer.writeMeta({
+            'bookmark_info': {},
+            'bookmarks': [],
+            'comments': [],
+            'messages': {},
+            'file_version': float(sessionfile.SESSION_VERSION),
+            'first_idx': {cmd: 0},
+            'start_ts': {cmd: start_ts},
+        })
+
+    finally:
+        writer.close()
+
+    return runs
+
+
+def writeCanSession(output, frames):
+    '''
+    write (timestamp, arbid, data) frames from an iterable to a new CanCat
+    session file, CHUNK_FRAMES at a time.  returns the number of frames
+    '''
+    return sum(count for first, count in writeSessionColumns(output, _frameColumns(frames)))
 
-from binascii import unhexlify
 
 def cancat2candump(session, output):
-    with open(session, 'rb') as f:
-        sess = pickle.load(f, encoding='latin1')
-
-    with open(output, 'w') as f:
-        for msg_time, msg in sess['messages'].get(cancatlib.CMD_CAN_RECV, None):
-            if isinstance(msg, str):
-                msg = bytes(msg, 'latin1')
-
-            line = '({:.6f}) vcan0 {}#{}\n'.format(
-                msg_time,
-                msg[0:4].hex(),
-                msg[4:].hex(),
-            )
-            f.write(line)
-
-
-def cancat2pcap(session, output):
-    import scapy.layers.l2
-    import scapy.packet
-    import scapy.utils
-
-    with open(session, 'rb') as f:
-        sess = pickle.load(f, encoding='latin1')
-
-    msgs = []
-    for msg_time, msg in sess['messages'].get(cancatlib.CMD_CAN_RECV, None):
-        if isinstance(msg, str):
-            msg = bytes(msg, 'latin1')
-
-        arb = struct.unpack_from('>L', msg)[0] | 0x80000000
-        msg_data = msg[4:]
-        msg_len = len(msg_data)
-        raw = struct.pack('<LL', arb, msg_len) + msg_data + b'\x00' * (8 - msg_len)
+    with open(output, 'w', buffering=IO_BUFSIZE) as f:
+        candump.writeCandump(f, iterSessionFrames(session))
 
-        pkt = scapy.layers.l2.CookedLinux(
-                pkttype=1,
-                lladdrtype=0x118,
-                lladdrlen=0,
-                src='',
-                proto=0xc
-              ) / scapy.packet.Raw(
-                load=raw
-              )
-        pkt.time = msg_time
 
-        msgs.append(pkt)
+def cancat2pcap(session, output, linktype=pcap.LINKTYPE_LINUX_SLL):
+    with open(output, 'wb', buffering=IO_BUFSIZE) as f:
+        pcap.PcapWriter(f, linktype).writeFrames(iterSessionFrames(session))
 
-    scapy.utils.wrpcap(output, msgs)
-
-
-def _import_candump(filename):
-    msgs = []
-    with open(filename, 'rb') as f:
-        pat = re.compile(br'\(([0-9]+\.[0-9]+)\) [A-Za-z0-9]+ ([A-Fa-f0-9]+)#([A-Fa-f0-9]*)( *;.*)*')
-        for line in f.readlines():
-            match = pat.match(line.strip())
-            if match is None:
-                raise ValueError('Invalid candump format: %s' % line)
-
-            time, arb_id, data, comment = match.groups()
-
-            # Ensure that the arbid is padded out to 4 bytes
-            if len(arb_id) < 8:
-                arb_id = ('0' * (8 - len(arb_id))) + arb_id
-
-            msgs.append((float(time), unhexlify(arb_id) + unhexlify(data)))
 
+def _import_frames(frames):
     sess = {
         'bookmark_info': {},
         'bookmarks': [],
         'comments': [],
         'messages': {
-            cancatlib.CMD_CAN_RECV: msgs,
+            cancatlib.CMD_CAN_RECV: CanMsgStore(),
         },
     }
 
-    return sess
+    store = sess['messages'][cancatlib.CMD_CAN_RECV]
+    for ts, arbid, data in frames:
+        store.appendFrame(ts, arbid, data)
 
+    return sess
 
-def _import_pcap(filename):
-    import scapy.layers.l2
-    import scapy.packet
-    import scapy.utils
 
-    msgs = []
-    can_pkts = [p for p in scapy.utils.rdpcap(filename)
-                if scapy.layers.l2.CookedLinux in p and p.proto == 12]
-    for pkt in can_pkts:
-        [arb_id, data_len] = struct.unpack_from('<LL', pkt.load)
+def _import_candump(filename):
+    with open(filename, 'rb', buffering=IO_BUFSIZE) as f:
+        return _import_frames(candump.readCandump(f))
 
-        # Clear any flags in the arbitration ID field that might be set
-        arb_id &= 0x1FFFFFFF
-        msgs.append((pkt.time, struct.pack('>L', arb_id) + pkt.load[8:8+data_len]))
 
-    sess = {
-        'bookmark_info': {},
-        'bookmarks': [],
-        'comments': [],
-        'messages': {
-            cancatlib.CMD_CAN_RECV: msgs,
-        },
-    }
-
-    return sess
+def _import_pcap(filename):
+    with open(filename, 'rb', buffering=IO_BUFSIZE) as f:
+        return _import_frames(pcap.readPcap(f))
 
 
-def candump2cancat(candumplog, output):
-    with open(output, 'wb') as f:
-        pickle.dump(_import_candump(candumplog), f)
+def _candumpRanges(filename, chunk_bytes=CANDUMP_CHUNK_BYTES):
+    '''
+    split a candump log into (start, end) byte ranges of about chunk_bytes,
+    ending on line boundaries
+    '''
+    size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def _parseCandumpRange(args):
+    '''
+    worker: parse one byte range of a candump log into sorted columns
+    '''
+    filename, start, end = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    return candump.parseCandumpChunk(data)
+
+
+def _iterColumns(store, first, count):
+    for idx, ts, arbid, data in store.iterFrames(first, first + count):
+        yield ts, arbid, data
+
+
+def candump2cancat(candumplog, output, jobs=1, chunk_bytes=CANDUMP_CHUNK_BYTES):
+    '''
+    convert a candump log to a CanCat session.  the log is split into
+    chunk_bytes pieces on line boundaries, which are parsed by jobs worker
+    processes (None: one per cpu) and written out in order as they finish.
+
+    each piece comes back sorted by timestamp.  if the pieces overlap in time
+    (eg. several logs cat'd together), they're merged into timestamp order
+    once they're all parsed.  returns the number of frames
+    '''
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    tasks = [(candumplog, start, end) for start, end in _candumpRanges(candumplog, chunk_bytes)]
+
+    pool = None
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        chunks = pool.imap(_parseCandumpRange, tasks)
+    else:
+        chunks = map(_parseCandumpRange, tasks)
+
+    ordered = [True]
+    def checkOrder(chunks):
+        last = float('-inf')
+        for cols in chunks:
+            if len(cols[0]):
+                if cols[0][0] < last:
+                    ordered[0] = False
+                last = max(last, cols[0][-1])
+            yield cols
+
+    try:
+        runs = writeSessionColumns(output, checkOrder(chunks))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if not ordered[0]:
+        # every run is sorted, merge them
+        unsorted = output + '.unsorted'
+        os.replace(output, unsorted)
+        try:
+            store = sessionfile.loadSession(unsorted)['messages'][cancatlib.CMD_CAN_RECV]
+            frames = heapq.merge(*[_iterColumns(store, first, count) for first, count in runs], key=itemgetter(0))
+            writeCanSession(output, frames)
+            del store, frames
+        finally:
+            os.remove(unsorted)
+
+    return sum(count for first, count in runs)
 
 
 def pcap2cancat(pcapfile, output):
-    with open(output, 'wb') as f:
-        pickle.dump(_import_pcap(pcapfile), f)
+    with open(pcapfile, 'rb', buffering=IO_BUFSIZE) as f:
+        return writeCanSession(output, pcap.readPcap(f))
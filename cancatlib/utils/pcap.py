@@ -0,0 +1,270 @@
+# Streaming pcap/pcapng reader and pcap writer for CAN frames
+#
+# Only struct, no scapy: frames are read and written one at a time, so
+# converting a huge capture runs at disk speed in constant memory.
+#
+# Frames are (timestamp, arbid, data) tuples, like CanMsgStore.appendFrame().
+#
+# Supported link types:
+#   LINKTYPE_LINUX_SLL      "Linux cooked" header then a SocketCAN frame in
+#                           host (little endian) order, what candump/tcpdump
+#                           on a can interface write
+#   LINKTYPE_LINUX_SLL2     same, with the v2 cooked header
+#   LINKTYPE_CAN_SOCKETCAN  bare SocketCAN frame, can_id in network order
+
+import struct
+
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_CAN_SOCKETCAN = 227
+LINKTYPE_LINUX_SLL2 = 276
+
+# SLL protocol types
+ETH_P_CAN = 0x000c
+ETH_P_CANFD = 0x000d
+ARPHRD_CAN = 0x118
+
+# can_id flags
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_EFF_MASK = 0x1FFFFFFF
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+PCAPNG_IDB = 1
+PCAPNG_SPB = 3
+PCAPNG_EPB = 6
+PCAPNG_OPT_TSRESOL = 9
+
+PCAP_HDR = struct.Struct('<IHHiIII')
+SLL_HDR = struct.Struct('>HHH8sH')
+SLL2_HDR = struct.Struct('>HHIHBB8s')
+CAN_HDR_LE = struct.Struct('<IB3x')
+CAN_HDR_BE = struct.Struct('>IB3x')
+
+SNAPLEN = 0xffff
+
+
+def _parseCanFrame(frame, hdr):
+    '''
+    returns (arbid, data) from a SocketCAN (or CAN FD) frame, or None for error
+    frames
+    '''
+    if len(frame) < hdr.size:
+        return None
+
+    can_id, length = hdr.unpack_from(frame)
+    if can_id & CAN_ERR_FLAG:
+        return None
+
+    if can_id & CAN_RTR_FLAG:
+        length = 0
+
+    # clear any flags in the arbitration ID field
+    return can_id & CAN_EFF_MASK, bytes(frame[hdr.size:hdr.size+length])
+
+
+def _parseLinkFrame(linktype, pkt):
+    if linktype == LINKTYPE_LINUX_SLL:
+        if len(pkt) < SLL_HDR.size:
+            return None
+        pkttype, hatype, halen, addr, proto = SLL_HDR.unpack_from(pkt)
+        if proto not in (ETH_P_CAN, ETH_P_CANFD):
+            return None
+        return _parseCanFrame(pkt[SLL_HDR.size:], CAN_HDR_LE)
+
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        if len(pkt) < SLL2_HDR.size:
+            return None
+        proto = SLL2_HDR.unpack_from(pkt)[0]
+        if proto not in (ETH_P_CAN, ETH_P_CANFD):
+            return None
+        return _parseCanFrame(pkt[SLL2_HDR.size:], CAN_HDR_LE)
+
+    elif linktype == LINKTYPE_CAN_SOCKETCAN:
+        return _parseCanFrame(pkt, CAN_HDR_BE)
+
+    return None
+
+
+def _readPcap(f, magic):
+    hdr = f.read(PCAP_HDR.size - 4)
+    if len(hdr) < PCAP_HDR.size - 4:
+        return
+
+    if struct.unpack('<I', magic)[0] in (PCAP_MAGIC, PCAP_MAGIC_NSEC):
+        endian = '<'
+    else:
+        endian = '>'
+    magicval, = struct.unpack(endian + 'I', magic)
+    if magicval == PCAP_MAGIC_NSEC:
+        tsdiv = 1e9
+    else:
+        tsdiv = 1e6
+
+    linktype = struct.unpack(endian + 'HHiIII', hdr)[-1] & 0xffff
+    rechdr = struct.Struct(endian + 'IIII')
+
+    while True:
+        rec = f.read(rechdr.size)
+        if len(rec) < rechdr.size:
+            return
+
+        secs, frac, caplen, origlen = rechdr.unpack(rec)
+        pkt = f.read(caplen)
+        if len(pkt) < caplen:
+            # cut off mid-packet
+            return
+
+        frame = _parseLinkFrame(linktype, pkt)
+        if frame is not None:
+            yield (secs + frac / tsdiv, frame[0], frame[1])
+
+
+def _tsresol(opts, endian):
+    '''
+    timestamp units per second from an IDB's options
+    '''
+    pos = 0
+    while pos + 4 <= len(opts):
+        code, length = struct.unpack_from(endian + 'HH', opts, pos)
+        if code == 0:
+            break
+        if code == PCAPNG_OPT_TSRESOL and length >= 1:
+            val = opts[pos+4]
+            if val & 0x80:
+                return 2 ** (val & 0x7f)
+            return 10 ** val
+        pos += 4 + length + (-length % 4)
+
+    return 10 ** 6
+
+
+def _readPcapng(f, first):
+    endian = '<'
+    interfaces = []
+    block = first
+
+    while True:
+        hdr = block + f.read(8 - len(block))
+        if len(hdr) < 8:
+            return
+
+        if struct.unpack('<I', hdr[:4])[0] == PCAPNG_SHB:
+            # section header: (re)learn the byte order, interfaces start over
+            bom = f.read(4)
+            if len(bom) < 4:
+                return
+            endian = '<' if struct.unpack('<I', bom)[0] == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            btype, blen = struct.unpack(endian + 'II', hdr)
+            body = bom + f.read(blen - 12)
+            interfaces = []
+
+        else:
+            btype, blen = struct.unpack(endian + 'II', hdr)
+            body = f.read(blen - 8)
+
+        block = b''
+        if len(body) < blen - 8 or blen < 12:
+            return
+
+        # drop the trailing block length
+        body = memoryview(body)[:-4]
+
+        if btype == PCAPNG_IDB:
+            linktype, reserved, snaplen = struct.unpack_from(endian + 'HHI', body)
+            interfaces.append((linktype, _tsresol(body[8:], endian)))
+
+        elif btype == PCAPNG_EPB:
+            ifid, tshi, tslo, caplen, origlen = struct.unpack_from(endian + 'IIIII', body)
+            if ifid >= len(interfaces):
+                continue
+            linktype, tsresol = interfaces[ifid]
+            frame = _parseLinkFrame(linktype, body[20:20+caplen])
+            if frame is not None:
+                yield (((tshi << 32) | tslo) / tsresol, frame[0], frame[1])
+
+        elif btype == PCAPNG_SPB:
+            # no timestamp, no interface id (it's interface 0)
+            if not interfaces:
+                continue
+            origlen, = struct.unpack_from(endian + 'I', body)
+            frame = _parseLinkFrame(interfaces[0][0], body[4:4+origlen])
+            if frame is not None:
+                yield (0.0, frame[0], frame[1])
+
+
+def readPcap(f):
+    '''
+    generator of (timestamp, arbid, data) for every CAN frame in a pcap or
+    pcapng file (opened 'rb').  other packets and error frames are skipped
+    '''
+    magic = f.read(4)
+    if len(magic) < 4:
+        return iter(())
+
+    if struct.unpack('<I', magic)[0] == PCAPNG_SHB:
+        return _readPcapng(f, magic)
+
+    if struct.unpack('<I', magic)[0] not in (PCAP_MAGIC, PCAP_MAGIC_NSEC) and \
+            struct.unpack('>I', magic)[0] not in (PCAP_MAGIC, PCAP_MAGIC_NSEC):
+        raise ValueError('Not a pcap or pcapng file')
+
+    return _readPcap(f, magic)
+
+
+class PcapWriter(object):
+    '''
+    writes CAN frames to a (classic, microsecond) pcap file opened 'wb'
+    '''
+    def __init__(self, f, linktype=LINKTYPE_LINUX_SLL):
+        if linktype not in (LINKTYPE_LINUX_SLL, LINKTYPE_CAN_SOCKETCAN):
+            raise ValueError('Unsupported link type for writing: %r' % linktype)
+
+        self._f = f
+        self.linktype = linktype
+        self._rechdr = struct.Struct('<IIII')
+        if linktype == LINKTYPE_LINUX_SLL:
+            # pkttype 1 (broadcast), ARPHRD_CAN, no address
+            self._sll = SLL_HDR.pack(1, ARPHRD_CAN, 0, b'', ETH_P_CAN)
+            self._sllfd = SLL_HDR.pack(1, ARPHRD_CAN, 0, b'', ETH_P_CANFD)
+            self._canhdr = CAN_HDR_LE
+        else:
+            self._sll = self._sllfd = b''
+            self._canhdr = CAN_HDR_BE
+
+        f.write(PCAP_HDR.pack(PCAP_MAGIC, 2, 4, 0, 0, SNAPLEN, linktype))
+
+    def write(self, ts, arbid, data):
+        if len(data) > 8:
+            sll = self._sllfd
+            padlen = 64
+        else:
+            sll = self._sll
+            padlen = 8
+
+        # CanCat doesn't know 11 bit from 29 bit ids, mark them all extended
+        pkt = b''.join((sll, self._canhdr.pack(arbid | CAN_EFF_FLAG, len(data)),
+                        data, b'\x00' * (padlen - len(data))))
+
+        secs = int(ts)
+        usecs = int(round((ts - secs) * 1e6))
+        if usecs >= 1000000:
+            secs += 1
+            usecs -= 1000000
+
+        self._f.write(self._rechdr.pack(secs, usecs, len(pkt), len(pkt)))
+        self._f.write(pkt)
+
+    def writeFrames(self, frames):
+        '''
+        write (timestamp, arbid, data) for every frame in an iterable.
+        returns how many were written
+        '''
+        count = 0
+        for ts, arbid, data in frames:
+            self.write(ts, arbid, data)
+            count += 1
+        return count
@@ -65,6 +65,65 @@ class SparseHexRange(SparseRange):
         return super(SparseRange, cls).__new__(cls, (_hex_range(v, increment) for v in val.split(',')))
 
 
+class ScanBitmap(object):
+    '''
+    The set of (non-negative integer) values a scan has been through, as a
+    bitmap.  str() gives them as hex ranges, in the format SparseHexRange
+    takes, and a ScanBitmap can be made back from that string.
+    '''
+    def __init__(self, val=None):
+        self._bits = bytearray()
+        self._count = 0
+        if val:
+            self.update(SparseHexRange(val))
+
+    def add(self, val):
+        byte = val >> 3
+        bit = 1 << (val & 7)
+        if byte >= len(self._bits):
+            self._bits.extend(bytearray(byte + 1 - len(self._bits)))
+        if not self._bits[byte] & bit:
+            self._bits[byte] |= bit
+            self._count += 1
+
+    def update(self, vals):
+        for val in vals:
+            self.add(val)
+
+    def __contains__(self, val):
+        byte = val >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << (val & 7)))
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for byte, bits in enumerate(self._bits):
+            if bits:
+                for bit in range(8):
+                    if bits & (1 << bit):
+                        yield (byte << 3) | bit
+
+    def ranges(self):
+        '''
+        the values as a list of (first, last) runs
+        '''
+        runs = []
+        for val in self:
+            if runs and runs[-1][1] == val - 1:
+                runs[-1][1] = val
+            else:
+                runs.append([val, val])
+        return [tuple(run) for run in runs]
+
+    def __repr__(self):
+        return 'ScanBitmap({!r})'.format(str(self))
+
+    def __str__(self):
+        return ','.join('{:x}'.format(first) if first == last else '{:x}-{:x}'.format(first, last)
+                        for first, last in self.ranges())
+
+
 class ECUAddress(object):
     # Add the kwargs param so we can construct an ECUAddress out of a dictionary
     # that has extra stuff in it
@@ -5,7 +5,7 @@ import setuptools
 
 VERSION = open('VERSION').read().strip()
 mods = []
-pkgdata = {'cancatlib': ['cancatlib/test/data/candump_example.txt']}
+pkgdata = {'cancatlib': ['cancatlib/test/data/candump_example.txt', 'J1939db.sqlite']}
 scripts = ['CanCat', 'J1939Cat', 'canmap', 'cancat2candump', 'cancat2pcap', 'candump2cancat', 'pcap2cancat']
 
 dirn = os.path.abspath(os.path.dirname(__file__))
@@ -34,6 +34,11 @@ setuptools.setup  (name  = 'cancat',
                 "future",
                 "six",
             ],
+        extras_require   = {
+                # vectorized session stats and bulk J1939 SPN decoding
+                # (cancatlib.sessionstats, cancatlib.j1939columns)
+                "stats": ["numpy"],
+            },
         classifiers      = [
                             'Development Status :: 5 - Production/Stable',
                             'Intended Audience :: Telecommunications Industry',
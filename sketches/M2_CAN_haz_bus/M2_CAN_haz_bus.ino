@@ -28,6 +28,8 @@ uint16_t serial_buf_count = 0;
 uint8_t initialized = 0;
 uint8_t mode = CMD_CAN_MODE_SNIFF_CAN0;
 static void printCanRegs(void);
+static void pumpFrames(void);
+static void SendFrameBatch(uint8_t *buf, uint16_t len);
 
 
 uint32_t baud_rates_table[NUM_BAUD_RATES] = {
@@ -88,11 +90,9 @@ void setup()
   while(!Serial);
 }
 
-void loop()
+/* Send one enqueued frame per bus and push received frames back up */
+static void pumpFrames(void)
 {
-    uint8_t results = 0;
-    uint32_t mask;
-    uint32_t filter;
     CAN_FRAME frame = {0};
     /* Send enqueued frames */
     if(!can_tx_frames0.isEmpty())
@@ -143,6 +143,16 @@ void loop()
         if(mode == CMD_CAN_MODE_CITM)
             send(buf, CMD_ISO_RECV, frame.length + 4);
     }
+}
+
+void loop()
+{
+    uint8_t results = 0;
+    uint32_t mask;
+    uint32_t filter;
+    CAN_FRAME frame = {0};
+
+    pumpFrames();
 
     /* Process any pending IsoTP transactions */
     process_isotp();
@@ -260,6 +270,10 @@ void loop()
                 send(&results, CMD_CAN_SENDRECV_ISOTP_RESULT, 1);
                 break;
 
+            case CMD_CAN_SEND_BATCH:
+                SendFrameBatch(serial_buffer+3, serial_buf_count-3);
+                break;
+
             case CMD_PRINT_CAN_REGS:
                 printCanRegs();
                 break;
@@ -347,6 +361,66 @@ uint8_t SendFrame(CAN_FRAME frame)
     return results;
 }
 
+/* Is there room in the tx queue(s) for the current mode? */
+static bool txQueueFull(void)
+{
+    if (mode == CMD_CAN_MODE_SNIFF_CAN0)
+        return can_tx_frames0.isFull();
+    if (mode == CMD_CAN_MODE_SNIFF_CAN1)
+        return can_tx_frames1.isFull();
+    return can_tx_frames0.isFull() || can_tx_frames1.isFull();
+}
+
+/* Send a batch of frames from one CMD_CAN_SEND_BATCH command:
+ *   [count] then count x [arbid (4 bytes, big endian)][extended][len][data]
+ * and answer with one CMD_CAN_SEND_BATCH_RESULT holding a SendFrame() result
+ * per frame.  When the tx queue fills up, the bus is kept going here (and
+ * received frames pushed up) until there's room again. */
+static void SendFrameBatch(uint8_t *buf, uint16_t len)
+{
+    uint8_t batch_results[CAN_SEND_BATCH_MAX];
+    uint8_t count = len ? buf[0] : 0;
+    uint16_t idx = 1;
+    uint32_t start;
+    CAN_FRAME frame = {0};
+
+    if(count > CAN_SEND_BATCH_MAX)
+        count = CAN_SEND_BATCH_MAX;
+
+    for(uint8_t f = 0; f < count; f++)
+    {
+        if(idx + 6 > len || buf[idx+5] > 8 || idx + 6 + buf[idx+5] > len)
+        {
+            // malformed, fail this frame and the rest
+            log("Bad frame in batch", 18);
+            for(; f < count; f++)
+                batch_results[f] = 0xff;
+            break;
+        }
+
+        frame.id = (uint32_t)buf[idx+3] |
+                   ((uint32_t)buf[idx+2] << 8) |
+                   ((uint32_t)buf[idx+1] << 16) |
+                   ((uint32_t)buf[idx] << 24);
+        frame.extended = buf[idx+4];
+        frame.length = buf[idx+5];
+        for(uint8_t i = 0; i < frame.length; i++)
+        {
+            frame.data.bytes[i] = buf[idx+6+i];
+        }
+        idx += 6 + frame.length;
+
+        start = millis();
+        while(txQueueFull() && millis() - start < CAN_SEND_BATCH_WAIT)
+            pumpFrames();
+
+        batch_results[f] = SendFrame(frame);
+        pumpFrames();
+    }
+
+    send(batch_results, CMD_CAN_SEND_BATCH_RESULT, count);
+}
+
 // Print all of the configuration registers for the CAN peripheral with log messages
 static void printCanRegs(void)
 {
@@ -24,6 +24,7 @@
 #define CMD_CAN_RECV_ISOTP_RESULT       0x39
 #define CMD_CAN_SENDRECV_ISOTP_RESULT   0x3A
 #define CMD_PRINT_CAN_REGS              0x3C
+#define CMD_CAN_SEND_BATCH_RESULT       0x3D
 
 #define CMD_PING                 0x41
 #define CMD_CHANGE_BAUD          0x42
@@ -36,6 +37,12 @@
 #define CMD_CAN_SEND_ISOTP       0x46
 #define CMD_CAN_RECV_ISOTP       0x47
 #define CMD_CAN_SENDRECV_ISOTP   0x48
+#define CMD_CAN_SEND_BATCH       0x49
+
+/* CMD_CAN_SEND_BATCH: most frames in one command, and how long to wait (ms)
+ * for room in the tx queue before giving up on a frame */
+#define CAN_SEND_BATCH_MAX       128
+#define CAN_SEND_BATCH_WAIT      100
 
 /* constants for setting baudrate for the CAN bus */
 #define NUM_BAUD_RATES 19
@@ -14,6 +14,7 @@ class Queue {
    public:
       ~Queue() { delete items; }
       bool isEmpty() { return head == tail; }
+      bool isFull() { return (tail + 1) % num_items == head; }
 
       Queue(uint32_t num);
       bool enqueue(T const*);